@@ -2,21 +2,50 @@
 
 import os
 import json
-from google import genai
+import threading
+import time
 from src.config.config import CURSOS
+from src import metrics
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# El cliente (y el import de google.genai, que es pesado) se crean en el
+# primer uso o en el warmup del arranque, no al importar el módulo
 client = None
-if GEMINI_API_KEY:
-    client = genai.Client(api_key=GEMINI_API_KEY)
+_client_lock = threading.Lock()
+
+
+def obtener_cliente():
+    """Retorna el cliente de Gemini, creándolo una sola vez de forma thread-safe."""
+    global client
+    if client is None and GEMINI_API_KEY:
+        with _client_lock:
+            if client is None:
+                from google import genai
+                client = genai.Client(api_key=GEMINI_API_KEY)
+    return client
+
+
+def calentar():
+    """Crea el cliente y abre la conexión HTTPS con la API (sin generar contenido)."""
+    inicio = time.perf_counter()
+    client = obtener_cliente()
+    if not client:
+        return
+    try:
+        client.models.get(model='gemini-2.0-flash')
+        print(f"✅ Cliente de Gemini listo ({(time.perf_counter() - inicio) * 1000:.0f} ms).")
+    except Exception as e:
+        print(f"⚠️ Warmup de Gemini falló: {e}")
 
 
+@metrics.instrumentar("gemini")
 def generar_reto_con_ia(nivel, tipo_reto, dificultad, tematica=None):
     """
     Genera un reto de programación validado por IA.
     Incluye un campo 'tiempo_estimado' oculto para detectar copy-paste.
     """
+    client = obtener_cliente()
     if not client: return {"error": "IA no configurada."}
 
     model = 'gemini-2.0-flash'
@@ -42,7 +71,9 @@ def generar_reto_con_ia(nivel, tipo_reto, dificultad, tematica=None):
         return {"error": f"No pude generar el reto. Error de IA: {e}"}
 
 
+@metrics.instrumentar("gemini")
 def evaluar_solucion_con_ia(reto_enunciado, solucion_usuario, tipo_reto):
+    client = obtener_cliente()
     if not client: return "❌ *INCORRECTO:* La evaluación no está configurada."
 
     model = 'gemini-2.0-flash'
@@ -63,7 +94,9 @@ def evaluar_solucion_con_ia(reto_enunciado, solucion_usuario, tipo_reto):
         return f"❌ Error de IA: {e}"
 
 
+@metrics.instrumentar("gemini")
 def chat_conversacional_con_ia(mensaje_usuario, historial_chat, tema_actual=None):
+    client = obtener_cliente()
     if not client: return "Lo siento, el chat no está disponible."
 
     model = 'gemini-2.0-flash'
@@ -100,7 +133,9 @@ def chat_conversacional_con_ia(mensaje_usuario, historial_chat, tema_actual=None
         return "No estoy seguro de cómo responder. Intenta con un comando como `menu`."
 
 
+@metrics.instrumentar("gemini")
 def explicar_tema_con_ia(tema):
+    client = obtener_cliente()
     if not client: return "Lo siento, no puedo generar la explicación."
 
     model = 'gemini-2.0-flash'
@@ -116,8 +151,10 @@ def explicar_tema_con_ia(tema):
         return f"Error: {e}"
 
 
+@metrics.instrumentar("gemini")
 def generar_introduccion_tema(tema):
     """Genera una mini-clase introductoria antes del reto."""
+    client = obtener_cliente()
     if not client: return f"Vamos a aprender sobre {tema}."
 
     model = 'gemini-2.0-flash'
@@ -142,8 +179,10 @@ def generar_introduccion_tema(tema):
 
 
 # --- ✅ NUEVA FUNCIÓN PARA COLECCIONABLES ---
+@metrics.instrumentar("gemini")
 def generar_cheat_sheet(tema):
     """Genera una ficha de resumen técnica y útil sobre un tema."""
+    client = obtener_cliente()
     if not client: return f"Ficha de {tema} no disponible por el momento."
 
     model = 'gemini-2.0-flash'
@@ -179,8 +218,10 @@ def generar_cheat_sheet(tema):
 
 # --- ✅ NUEVAS FUNCIONES FASE 3 (ANTI-PLAGIO Y DEPURACIÓN) ---
 
+@metrics.instrumentar("gemini")
 def generar_reto_depuracion(nivel, tematica):
     """Genera un código que PARECE correcto pero tiene un bug lógico o de sintaxis."""
+    client = obtener_cliente()
     if not client: return {"error": "IA no configurada"}
 
     model = 'gemini-2.0-flash'
@@ -207,8 +248,10 @@ def generar_reto_depuracion(nivel, tematica):
         return {"error": f"Error generando debug: {e}"}
 
 
+@metrics.instrumentar("gemini")
 def generar_pregunta_defensa(enunciado, solucion_usuario):
     """Genera una pregunta socrática para validar comprensión."""
+    client = obtener_cliente()
     if not client: return "Explícame tu código paso a paso."
 
     model = 'gemini-2.0-flash'
@@ -228,8 +271,10 @@ def generar_pregunta_defensa(enunciado, solucion_usuario):
         return "¿Podrías explicarme la lógica de tu solución?"
 
 
+@metrics.instrumentar("gemini")
 def evaluar_defensa(pregunta, respuesta_usuario, contexto_reto):
     """Evalúa si la justificación del estudiante tiene sentido."""
+    client = obtener_cliente()
     if not client: return True  # Fallback
 
     model = 'gemini-2.0-flash'
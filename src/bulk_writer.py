@@ -0,0 +1,217 @@
+# bulk_writer.py
+# Escritura en lotes de los documentos de analítica (logs de retos y alertas
+# de seguridad). El turno solo los encola y responde al estudiante; un hilo
+# en segundo plano los escribe en WriteBatch de hasta BULK_WRITER_LOTE cuando
+# se llena el lote, cuando el más viejo cumple BULK_WRITER_FLUSH_SEGUNDOS o
+# al apagar el proceso.
+#
+# La memoria está acotada: si hay BULK_WRITER_MAX_PENDIENTES documentos en
+# espera, o si un lote no se pudo escribir, los documentos se derraman a un
+# archivo JSONL en BULK_WRITER_DERRAME_DIR y se reintentan más tarde, de a
+# un lote y recordando la posición (el archivo puede ser más grande que la
+# memoria). Cada documento lleva su ID desde que se encola, así que
+# reintentarlo nunca lo duplica.
+
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from src import metrics
+from src.config.config import (
+    BULK_WRITER_LOTE, BULK_WRITER_FLUSH_SEGUNDOS, BULK_WRITER_MAX_PENDIENTES, BULK_WRITER_DERRAME_DIR
+)
+
+# (encolado_en, coleccion, doc_id, datos)
+_pendientes = deque()
+_cond = threading.Condition()
+_hilo = None
+# Serializa las escrituras del archivo de derrame de este proceso
+_lock_derrame = threading.Lock()
+# Buckets del histograma de documentos por lote
+_BUCKETS_LOTE = (1, 5, 10, 50, 100, 250, 500, float("inf"))
+
+
+def encolar(coleccion, datos):
+    """Agrega un documento de `coleccion` a la cola de escritura. Nunca bloquea en el backend."""
+    item = (time.monotonic(), coleccion, uuid.uuid4().hex, datos)
+    with _cond:
+        lleno = len(_pendientes) >= BULK_WRITER_MAX_PENDIENTES
+        if not lleno:
+            _pendientes.append(item)
+            if len(_pendientes) >= BULK_WRITER_LOTE:
+                _cond.notify()
+    if lleno:
+        _derramar([item])
+    _iniciar()
+
+
+def _iniciar():
+    global _hilo
+    with _cond:
+        if _hilo:
+            return
+        _hilo = threading.Thread(target=_bucle, name="bulk-writer", daemon=True)
+        _hilo.start()
+
+
+def _bucle():
+    while True:
+        with _cond:
+            if len(_pendientes) < BULK_WRITER_LOTE:
+                desde = _pendientes[0][0] if _pendientes else time.monotonic()
+                _cond.wait(max(0, desde + BULK_WRITER_FLUSH_SEGUNDOS - time.monotonic()))
+        try:
+            # Solo se recupera lo derramado si el backend está respondiendo
+            if vaciar():
+                recuperar_derrames()
+        except Exception as e:
+            print(f"⚠️ Error en la escritura en lotes: {e}")
+
+
+def vaciar():
+    """
+    Escribe todo lo pendiente en lotes. Si un lote falla, ese y los que
+    quedan se derraman a disco. Retorna True si todo se escribió.
+    """
+    exito = True
+    while True:
+        with _cond:
+            lote = [_pendientes.popleft() for _ in range(min(BULK_WRITER_LOTE, len(_pendientes)))]
+        if not lote:
+            return exito
+        if exito and _escribir(lote):
+            metrics.incrementar("bulk_writer_documentos_total", len(lote), {"resultado": "escrito"})
+        else:
+            exito = False
+            _derramar(lote)
+
+
+def _escribir(items):
+    import src.database as db
+
+    metrics.observar("bulk_writer_lote_documentos", len(items), buckets=_BUCKETS_LOTE)
+    return db.escribir_registros([(coleccion, doc_id, datos) for _, coleccion, doc_id, datos in items])
+
+
+# --- DERRAME A DISCO ---
+
+def _archivo_derrame(pid):
+    return os.path.join(BULK_WRITER_DERRAME_DIR, f"derrame-{pid}.jsonl")
+
+
+def _derramar(items):
+    """Agrega los documentos al archivo de derrame de este proceso."""
+    try:
+        os.makedirs(BULK_WRITER_DERRAME_DIR, exist_ok=True)
+        with _lock_derrame, open(_archivo_derrame(os.getpid()), "a", encoding="utf-8") as archivo:
+            for _, coleccion, doc_id, datos in items:
+                archivo.write(json.dumps({"coleccion": coleccion, "id": doc_id, "datos": datos},
+                                         ensure_ascii=False, default=str) + "\n")
+        metrics.incrementar("bulk_writer_documentos_total", len(items), {"resultado": "derramado"})
+        print(f"💾 {len(items)} documento(s) de analítica derramados a disco")
+    except OSError as e:
+        metrics.incrementar("bulk_writer_documentos_total", len(items), {"resultado": "perdido"})
+        print(f"❌ No se pudieron derramar {len(items)} documento(s) de analítica: {e}")
+
+
+def _archivos_recuperables():
+    """El derrame de este proceso y los de procesos que ya terminaron."""
+    archivos = []
+    for ruta in sorted(glob.glob(os.path.join(BULK_WRITER_DERRAME_DIR, "derrame-*.jsonl*"))):
+        if ".posicion" in ruta:
+            continue  # va con su archivo (ver recuperar_derrames)
+        try:
+            pid = int(os.path.basename(ruta).split("-", 1)[1].split(".", 1)[0])
+        except ValueError:
+            continue
+        if pid == os.getpid() or not metrics.proceso_vivo(pid):
+            archivos.append(ruta)
+    return archivos
+
+
+def recuperar_derrames():
+    """
+    Reescribe en el backend un archivo de derrame por llamada, leyéndolo en
+    lotes de BULK_WRITER_LOTE (nunca entero en memoria). Tras cada lote
+    escrito guarda hasta dónde llegó; si uno falla, el archivo queda
+    reclamado y la próxima llamada sigue desde ahí.
+    """
+    # Un archivo reclamado que quedó a medias (error anterior) se retoma primero
+    reclamado = f"{_archivo_derrame(os.getpid())}.recuperando"
+    if not os.path.exists(reclamado):
+        for ruta in _archivos_recuperables():
+            # Renombrarlo lo reclama: otro proceso que lo vea ya no lo toma
+            try:
+                with _lock_derrame:
+                    os.replace(ruta, reclamado)
+                # Si lo dejó a medias un proceso que murió, se sigue desde su posición
+                if os.path.exists(f"{ruta}.posicion"):
+                    os.replace(f"{ruta}.posicion", f"{reclamado}.posicion")
+                elif os.path.exists(f"{reclamado}.posicion"):
+                    os.remove(f"{reclamado}.posicion")
+                break
+            except OSError:
+                continue
+        else:
+            return
+
+    posicion = _leer_posicion(reclamado)
+    recuperados = 0
+    with open(reclamado, "rb") as archivo:
+        archivo.seek(posicion)
+        while True:
+            lote, fin = _leer_lote(archivo)
+            if lote and not _escribir(lote):
+                if recuperados:
+                    print(f"💾 Recuperados {recuperados} documento(s) de analítica; el resto se reintenta luego")
+                return
+            recuperados += len(lote)
+            if lote:
+                metrics.incrementar("bulk_writer_documentos_total", len(lote), {"resultado": "recuperado"})
+            if fin:
+                break
+            _guardar_posicion(reclamado, archivo.tell())
+    os.remove(reclamado)
+    try:
+        os.remove(f"{reclamado}.posicion")
+    except OSError:
+        pass
+    if recuperados:
+        print(f"💾 Recuperados {recuperados} documento(s) de analítica derramados a disco")
+
+
+def _leer_lote(archivo):
+    """Hasta BULK_WRITER_LOTE documentos desde la posición actual. Retorna (lote, llegó_al_final)."""
+    lote = []
+    while len(lote) < BULK_WRITER_LOTE:
+        linea = archivo.readline()
+        if not linea:
+            return lote, True
+        try:
+            d = json.loads(linea)
+        except ValueError:
+            continue  # línea cortada por la caída del proceso
+        lote.append((0, d["coleccion"], d["id"], d["datos"]))
+    return lote, False
+
+
+def _leer_posicion(reclamado):
+    try:
+        with open(f"{reclamado}.posicion", encoding="utf-8") as archivo:
+            return int(archivo.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _guardar_posicion(reclamado, posicion):
+    temporal = f"{reclamado}.posicion.tmp"
+    with open(temporal, "w", encoding="utf-8") as archivo:
+        archivo.write(str(posicion))
+    os.replace(temporal, f"{reclamado}.posicion")
+
+
+metrics.registrar_gauge("bulk_writer_pendientes", lambda: len(_pendientes))
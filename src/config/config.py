@@ -1,5 +1,8 @@
 # config.py
 
+import os
+import tempfile
+
 # Umbral de fallos antes de ofrecer ayuda teórica
 UMBRAL_DE_FALLOS = 2
 
@@ -92,4 +95,141 @@ CURSOS = {
             "Clases y Objetos (OOP)"
         ]
     }
-}
\ No newline at end of file
+}
+
+# --- ALMACENAMIENTO ---
+# Backend de persistencia (ver src/storage/):
+#   "firestore" (producción), "sqlite" (un solo servidor / cohortes chicas)
+#   o "memoria" (benchmarks y desarrollo local; se pierde al reiniciar)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore")
+# Archivo de la base SQLite; lo comparten todos los workers de gunicorn
+STORAGE_SQLITE_RUTA = os.getenv("STORAGE_SQLITE_RUTA", "logicbot.sqlite3")
+
+# --- PROCESAMIENTO DE TURNOS EN SEGUNDO PLANO ---
+# El webhook solo valida y encola; estos workers ejecutan el pipeline completo
+TURN_WORKERS = int(os.getenv("TURN_WORKERS", "8"))
+# Workers del carril rápido: comandos sin IA (menú, perfil, logros, fichas...).
+# Los turnos que llaman a Gemini usan los TURN_WORKERS de arriba.
+TURN_WORKERS_RAPIDOS = int(os.getenv("TURN_WORKERS_RAPIDOS", "4"))
+# Máximo de turnos en espera por proceso. Si se llena, el webhook responde 503
+# y Meta reintenta la entrega más tarde.
+TURN_QUEUE_MAX = int(os.getenv("TURN_QUEUE_MAX", "500"))
+
+# --- DEDUPLICACIÓN DE MENSAJES RE-ENTREGADOS ---
+# Tiempo que recordamos un messages[].id (Meta reintenta durante varias horas)
+DEDUP_TTL_SEGUNDOS = int(os.getenv("DEDUP_TTL_SEGUNDOS", str(6 * 3600)))
+# Máximo de IDs en memoria por proceso
+DEDUP_MAX_IDS = int(os.getenv("DEDUP_MAX_IDS", "50000"))
+# "memoria" (solo este proceso) o "compartido" (entre los workers de gunicorn,
+# en el backend de STORAGE_BACKEND). "firestore" se acepta como "compartido".
+DEDUP_STORE = os.getenv("DEDUP_STORE", "memoria")
+
+# --- BUZONES POR USUARIO ---
+# Dentro de un proceso los mensajes de un usuario siempre se procesan en orden.
+# "compartido" además toma un lease por usuario (en el backend de
+# STORAGE_BACKEND) para que dos procesos de gunicorn nunca atiendan al mismo
+# estudiante a la vez, y el turno relee al usuario una vez que lo tiene.
+# Viene activado salvo con "memoria" porque el Procfile levanta varios
+# procesos. "firestore" se acepta como "compartido".
+MAILBOX_LEASE = os.getenv("MAILBOX_LEASE", "ninguno" if STORAGE_BACKEND == "memoria" else "compartido")
+# Si un proceso muere con el lease tomado, otro puede reclamarlo tras este tiempo
+MAILBOX_LEASE_TTL_SEGUNDOS = int(os.getenv("MAILBOX_LEASE_TTL_SEGUNDOS", "120"))
+
+# --- CACHÉ DE USUARIOS (por proceso) ---
+# Documentos de usuario recordados en memoria para no releerlos fuera de los
+# turnos. Se escriben al guardar (write-through) y se revalidan con el
+# update_time de Firestore en la lectura batch de cada entrega. Con un backend
+# compartido entre procesos los turnos no la usan (ver db.obtener_usuario).
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "5000"))
+# Vida máxima de una entrada; acota cuánto puede durar una copia desactualizada
+# si otro proceso escribe al mismo usuario (0 = caché desactivada)
+USER_CACHE_TTL_SEGUNDOS = float(os.getenv("USER_CACHE_TTL_SEGUNDOS", "60"))
+
+# --- SINCRONIZACIÓN CON EL DASHBOARD ---
+# Los campos públicos que cambian se acumulan por usuario durante esta ventana
+# y se escriben juntos en users_sync (solo los que cambiaron).
+# 0 = se escriben en el mismo WriteBatch que el usuario, al final de cada turno.
+DASHBOARD_SYNC_VENTANA_SEGUNDOS = float(os.getenv("DASHBOARD_SYNC_VENTANA_SEGUNDOS", "5"))
+
+# --- ESTADÍSTICAS POR CLASE (class_stats) ---
+# Los cambios de los alumnos de una misma clase se combinan durante esta
+# ventana y se escriben juntos en su documento (0 = se escriben al momento)
+ESTADISTICAS_CLASE_VENTANA_SEGUNDOS = float(os.getenv("ESTADISTICAS_CLASE_VENTANA_SEGUNDOS", "5"))
+
+# --- ESCRITURA EN LOTES (logs de retos y alertas de seguridad) ---
+# Los documentos de analítica se acumulan en memoria y se escriben en
+# WriteBatch de hasta BULK_WRITER_LOTE (máximo de Firestore: 500) cuando se
+# llena el lote o el más viejo cumple BULK_WRITER_FLUSH_SEGUNDOS.
+BULK_WRITER_LOTE = min(int(os.getenv("BULK_WRITER_LOTE", "500")), 500)
+BULK_WRITER_FLUSH_SEGUNDOS = float(os.getenv("BULK_WRITER_FLUSH_SEGUNDOS", "2"))
+# Documentos en memoria por proceso; los que no entran (o cuyo lote falla) se
+# derraman a disco y se reintentan luego
+BULK_WRITER_MAX_PENDIENTES = int(os.getenv("BULK_WRITER_MAX_PENDIENTES", "5000"))
+BULK_WRITER_DERRAME_DIR = os.getenv("BULK_WRITER_DERRAME_DIR",
+                                    os.path.join(tempfile.gettempdir(), "logicbot-derrame"))
+
+# --- DIARIO DE ESCRITURAS (cambios de usuario ante caídas del backend) ---
+# Cada cambio de usuario se anota en disco antes de enviarse y se confirma
+# cuando el backend responde; si falla, se reintenta en orden (también lo que
+# dejó un proceso que murió). Vacío = desactivado.
+DIARIO_DIR = os.getenv("DIARIO_DIR", os.path.join(tempfile.gettempdir(), "logicbot-diario"))
+# Tamaño de cada segmento y tope del diario del proceso: lleno, los cambios se
+# escriben sin anotar (como sin diario)
+DIARIO_SEGMENTO_BYTES = int(os.getenv("DIARIO_SEGMENTO_BYTES", str(4 * 1024 * 1024)))
+DIARIO_MAX_BYTES = int(os.getenv("DIARIO_MAX_BYTES", str(256 * 1024 * 1024)))
+DIARIO_REINTENTO_SEGUNDOS = float(os.getenv("DIARIO_REINTENTO_SEGUNDOS", "5"))
+# 1 = fsync por anotación (sobrevive a un corte de la máquina, no solo del proceso)
+DIARIO_FSYNC = os.getenv("DIARIO_FSYNC", "0") == "1"
+# Al escribir a un usuario se borran las marcas diario_aplicado de otros
+# procesos sin escrituras en estos días; acota cuántas acumula el documento
+# (0 = no se borran)
+DIARIO_MARCA_DIAS = float(os.getenv("DIARIO_MARCA_DIAS", "7"))
+
+# --- RETENCIÓN DE LOGS Y ALERTAS (challenge_logs, alerts) ---
+# Los logs de retos más viejos que esto se resumen por día, alumno y tema en
+# challenge_logs_diarios y se borran (0 = se conservan para siempre)
+RETENCION_LOGS_DIAS = int(os.getenv("RETENCION_LOGS_DIAS", "0"))
+# Ídem para las alertas, que se resumen por día y alumno en alerts_diarias
+RETENCION_ALERTAS_DIAS = int(os.getenv("RETENCION_ALERTAS_DIAS", "0"))
+# Cada cuánto compacta el servidor (un solo proceso a la vez; 0 = solo con
+# src/scripts/compactar_registros.py, ej. desde un cron)
+RETENCION_INTERVALO_HORAS = float(os.getenv("RETENCION_INTERVALO_HORAS", "24"))
+# Si se define, los documentos se copian a JSONL (uno por colección y mes)
+# antes de borrarlos
+RETENCION_ARCHIVO_DIR = os.getenv("RETENCION_ARCHIVO_DIR", "")
+
+# --- EXPORTACIÓN DE LOGS (GET /export/challenge_logs) ---
+# Token que debe enviarse como "Authorization: Bearer <token>".
+# Vacío = endpoint desactivado (404); el script exportar_logs no lo necesita.
+EXPORTACION_TOKEN = os.getenv("EXPORTACION_TOKEN", "")
+
+# --- MÉTRICAS DE ENTREGA (callbacks sent/delivered/read de Meta) ---
+# Cada cuánto se resumen las latencias en el log (0 = desactivado)
+DELIVERY_METRICS_FLUSH_SEGUNDOS = int(os.getenv("DELIVERY_METRICS_FLUSH_SEGUNDOS", "300"))
+
+# --- BENCHMARK ---
+# Si se define, el webhook agrega cada entrega recibida a este archivo JSONL
+# para reproducirla luego con src/scripts/benchmark_webhook.py --replay.
+# ⚠️ Contiene mensajes reales de estudiantes: usar solo en entornos controlados.
+WEBHOOK_GRABAR_EN = os.getenv("WEBHOOK_GRABAR_EN")
+
+# --- MÉTRICAS (GET /metrics, formato Prometheus) ---
+# Cada proceso de gunicorn vuelca sus métricas en este directorio y /metrics
+# las suma; debe ser compartido por todos los workers de la misma máquina.
+# Vacío = solo se exponen las métricas del proceso que atiende el scrape.
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "logicbot-metrics"))
+# Cada cuánto vuelca cada proceso sus métricas al directorio compartido
+METRICS_FLUSH_SEGUNDOS = float(os.getenv("METRICS_FLUSH_SEGUNDOS", "5"))
+
+# --- TRAZAS POR TURNO (formato OTLP/JSON) ---
+# Destino de las trazas: ruta de un archivo JSONL o URL de un collector
+# OpenTelemetry (ej: http://localhost:4318/v1/traces). Vacío = desactivado.
+TRACING_EXPORTAR = os.getenv("TRACING_EXPORTAR", "")
+# Fracción de turnos que se trazan (1.0 = todos)
+TRACING_MUESTREO = float(os.getenv("TRACING_MUESTREO", "1.0"))
+TRACING_SERVICIO = os.getenv("TRACING_SERVICIO", "logicbot")
+
+# --- ARRANQUE ---
+# Tiempo máximo que el startup espera a que Firestore, Gemini y la Graph API
+# abran sus conexiones antes de aceptar tráfico (0 = sin warmup, todo perezoso)
+WARMUP_TIMEOUT_SEGUNDOS = float(os.getenv("WARMUP_TIMEOUT_SEGUNDOS", "10"))
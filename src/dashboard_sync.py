@@ -0,0 +1,98 @@
+# dashboard_sync.py
+# Sincronización diferida de la copia pública de cada usuario
+# (artifacts/.../users_sync) que lee el Dashboard Web.
+#
+# database.guardar_cambios_usuario calcula qué campos públicos cambiaron de
+# verdad y los entrega aquí. Durante DASHBOARD_SYNC_VENTANA_SEGUNDOS los
+# cambios de un mismo usuario se combinan (el último valor gana y los
+# Incremento se suman) y al vencer la ventana se escriben solo esos campos,
+# varios usuarios por WriteBatch.
+# Con ventana 0 no se usa este módulo: la copia va en el batch del usuario.
+
+import threading
+import time
+
+from src import metrics
+from src.config.config import DASHBOARD_SYNC_VENTANA_SEGUNDOS
+from src.storage.base import combinar
+
+_lock = threading.Lock()
+# numero -> {campo: valor} aún no escritos en users_sync
+_pendientes = {}
+# numero -> instante (monotonic) en que vence su ventana; como la ventana es
+# fija, el orden de inserción es también el orden de vencimiento
+_vencen = {}
+_despertar = threading.Event()
+_hilo = None
+
+
+def diferido():
+    """True si los cambios del dashboard se acumulan en vez de ir en el batch del usuario."""
+    return DASHBOARD_SYNC_VENTANA_SEGUNDOS > 0
+
+
+def programar(numero_telefono, cambios):
+    """Acumula campos públicos cambiados; se escriben cuando vence la ventana del usuario."""
+    numero = str(numero_telefono)
+    with _lock:
+        pendiente = _pendientes.get(numero)
+        if pendiente is None:
+            _pendientes[numero] = dict(cambios)
+            _vencen[numero] = time.monotonic() + DASHBOARD_SYNC_VENTANA_SEGUNDOS
+        else:
+            combinar(pendiente, cambios)
+            metrics.incrementar("dashboard_sync_coalescidas_total")
+    _iniciar()
+    _despertar.set()
+
+
+def _iniciar():
+    global _hilo
+    with _lock:
+        if _hilo:
+            return
+        _hilo = threading.Thread(target=_bucle, name="dashboard-sync", daemon=True)
+        _hilo.start()
+
+
+def _bucle():
+    while True:
+        with _lock:
+            proximo = next(iter(_vencen.values()), None)
+        if proximo is None:
+            _despertar.wait()
+            _despertar.clear()
+            continue
+        time.sleep(max(0, proximo - time.monotonic()))
+        try:
+            vaciar(solo_vencidos=True)
+        except Exception as e:
+            print(f"⚠️ Error sincronizando con el dashboard: {e}")
+
+
+def vaciar(solo_vencidos=False):
+    """
+    Escribe los cambios acumulados (todos, o solo los de ventanas vencidas).
+    Si la escritura falla se vuelven a encolar sin pisar valores más nuevos.
+    """
+    ahora = time.monotonic()
+    with _lock:
+        numeros = [n for n, vence in _vencen.items() if not solo_vencidos or vence <= ahora]
+        lote = {n: _pendientes.pop(n) for n in numeros}
+        for numero in numeros:
+            del _vencen[numero]
+    if not lote:
+        return
+
+    import src.database as db
+
+    if db.escribir_dashboard(lote):
+        return
+    with _lock:
+        for numero, cambios in lote.items():
+            _pendientes[numero] = combinar(cambios, _pendientes.get(numero, {}))
+            _vencen.setdefault(numero, time.monotonic() + DASHBOARD_SYNC_VENTANA_SEGUNDOS)
+    _despertar.set()
+
+
+metrics.registrar_gauge("dashboard_sync_pendientes", lambda: len(_pendientes))
@@ -1,70 +1,353 @@
-# database.py (Versión Firebase Firestore)
-
-import os
+# database.py
+# Lógica de persistencia del bot: caché de usuarios, unidad de trabajo y qué
+# se copia al dashboard. La lectura y escritura la hace el backend elegido con
+# STORAGE_BACKEND (Firestore, SQLite o memoria; ver src/storage/).
+#
+# Las funciones *_async hacen lo mismo que su par bloqueante sin detener el
+# event loop (AsyncClient en Firestore); los hilos de los turnos y los
+# scripts siguen usando las bloqueantes.
+#
+# Los cambios de usuario se anotan en el diario de escrituras (diario.py)
+# antes de enviarse: si el backend falla quedan diferidos y se reintentan en
+# orden, en vez de perderse.
+
+import copy
 import json
+import threading
+import time
+from collections import OrderedDict
 from datetime import date, datetime
-import firebase_admin
-from firebase_admin import credentials, firestore
-from src.config.config import CURSOS
+from src.config.config import CURSOS, USER_CACHE_MAX, USER_CACHE_TTL_SEGUNDOS
+from src import bulk_writer, dashboard_sync, diario, estadisticas_clase, metrics
+from src.storage import Incremento, Maximo, UnionArreglo, obtener_almacen
+from src.storage.base import es_transformacion, raiz, resolver
+from src.unit_of_work import unidad_actual
 
-# --- CONFIGURACIÓN DE FIREBASE ---
 
-CREDENTIALS_FILE = "firebase_credentials.json"
+# --- FUNCIONES DE BASE DE DATOS ---
 
-if not firebase_admin._apps:
+def inicializar_db():
+    """
+    Crea el backend y abre su conexión (en Firestore, una lectura mínima que
+    abre el canal gRPC) antes de que llegue el primer webhook.
+    """
+    inicio = time.perf_counter()
     try:
-        if os.path.exists(CREDENTIALS_FILE):
-            cred = credentials.Certificate(CREDENTIALS_FILE)
-            firebase_admin.initialize_app(cred)
-            print("🔥 Firebase inicializado con archivo local.")
-        else:
-            print("⚠️ No se encontró firebase_credentials.json. Intentando credenciales por defecto...")
-            firebase_admin.initialize_app()
-            print("🔥 Firebase inicializado (Default Credentials).")
+        almacen = obtener_almacen()
+        almacen.calentar()
+        print(f"✅ Almacenamiento '{almacen.nombre}' activo ({(time.perf_counter() - inicio) * 1000:.0f} ms).")
     except Exception as e:
-        print(f"❌ Error inicializando Firebase: {e}")
+        print(f"❌ Error inicializando el almacenamiento: {e}")
+
+
+# --- ESQUEMA DEL DOCUMENTO DE USUARIO ---
+# Versión 1: historial, progreso, logros y pistas guardados como strings JSON.
+# Versión 2: mapas y arreglos nativos ('schema_version': 2), que se actualizan
+# por ruta (ej: solo progreso_temas.<tema>.puntos) sin reescribir el campo.
+# Los documentos v1 se decodifican al leerlos y se migran en su primera
+# escritura; src/scripts/migrar_esquema.py migra al resto en lotes.
+ESQUEMA_USUARIO = 2
+CAMPOS_ESTRUCTURADOS = {
+    "historial_chat": list,
+    "progreso_temas": dict,
+    "logros_desbloqueados": list,
+    "reto_actual_pistas": list
+}
+
+
+def normalizar_usuario(datos):
+    """Decodifica (in situ) los campos que un documento v1 guarda como JSON."""
+    if datos is None or datos.get("schema_version", 1) >= ESQUEMA_USUARIO:
+        return datos
+    for campo, tipo in CAMPOS_ESTRUCTURADOS.items():
+        valor = datos.get(campo)
+        if isinstance(valor, str):
+            try:
+                valor = json.loads(valor)
+            except ValueError:
+                valor = None
+            datos[campo] = valor if isinstance(valor, tipo) else tipo()
+    return datos
+
+
+def cambios_de_migracion(datos):
+    """Campos a escribir para llevar un documento (ya normalizado) al esquema actual."""
+    cambios = {campo: datos[campo] for campo in CAMPOS_ESTRUCTURADOS if campo in datos}
+    cambios["schema_version"] = ESQUEMA_USUARIO
+    return cambios
+
+
+def _copiar(datos):
+    # Los mapas y arreglos se copian: quien recibe el documento puede modificarlos
+    copia = dict(datos)
+    for campo in CAMPOS_ESTRUCTURADOS:
+        if isinstance(copia.get(campo), (list, dict)):
+            copia[campo] = copy.deepcopy(copia[campo])
+    return copia
+
+
+# --- CACHÉ DE USUARIOS ---
+# numero -> (expira_en, version, datos | None). LRU acotada a USER_CACHE_MAX
+# entradas con vida USER_CACHE_TTL_SEGUNDOS. Guarda el documento tal como está
+# en el backend (sin los cambios pendientes de la unidad de trabajo); None
+# recuerda que el usuario no existe.
+_cache_usuarios = OrderedDict()
+_cache_lock = threading.Lock()
+_SIN_CACHE = object()
+
+
+def _cache_activa():
+    return USER_CACHE_MAX > 0 and USER_CACHE_TTL_SEGUNDOS > 0
+
+
+def _cache_leer(numero, copiar=True):
+    """
+    Retorna el usuario en caché, None si no existe o _SIN_CACHE. Sin `copiar`
+    retorna el documento guardado, que no debe modificarse.
+    """
+    if not _cache_activa():
+        return _SIN_CACHE
+    with _cache_lock:
+        entrada = _cache_usuarios.get(numero)
+        if entrada is not None and entrada[0] <= time.monotonic():
+            del _cache_usuarios[numero]
+            entrada = None
+        if entrada is not None:
+            _cache_usuarios.move_to_end(numero)
+    metrics.incrementar("user_cache_total", etiquetas={"resultado": "hit" if entrada else "miss"})
+    if entrada is None:
+        return _SIN_CACHE
+    return _copiar(entrada[2]) if entrada[2] is not None and copiar else entrada[2]
+
+
+def _cache_guardar(numero, datos, version):
+    """
+    Guarda el documento leído o escrito con su versión (update_time en
+    Firestore). Nunca reemplaza una versión más nueva por una más vieja
+    (lectura que llegó tarde); si la versión difiere de la que había, otro
+    proceso modificó al usuario.
+    """
+    if not _cache_activa():
+        return
+    with _cache_lock:
+        actual = _cache_usuarios.get(numero)
+        if actual is not None and actual[1] is not None and version is not None:
+            if version < actual[1]:
+                return
+            if version != actual[1] and actual[0] > time.monotonic():
+                metrics.incrementar("user_cache_obsoletos_total")
+        _cache_usuarios[numero] = (time.monotonic() + USER_CACHE_TTL_SEGUNDOS, version,
+                                   _copiar(datos) if datos is not None else None)
+        _cache_usuarios.move_to_end(numero)
+        while len(_cache_usuarios) > USER_CACHE_MAX:
+            _cache_usuarios.popitem(last=False)
+
+
+def _cache_aplicar(numero, datos, usuario_base, version):
+    """
+    Write-through tras guardar `datos`: la entrada queda como base + datos
+    (los Incremento se suman a la base; si otro proceso sumó a la vez, la
+    lectura batch de la próxima entrega trae el valor del servidor).
+    Sin base ni entrada previa no hay documento completo que cachear.
+    """
+    if not _cache_activa():
+        return
+    with _cache_lock:
+        actual = _cache_usuarios.get(numero)
+    base = usuario_base if usuario_base is not None else (actual[2] if actual else None)
+    if base is None:
+        invalidar_cache_usuario(numero)
+        return
+    _cache_guardar(numero, resolver(base, datos), version)
+
+
+def _cache_documento(numero):
+    """Copia del documento en caché (sin contar hit/miss) o None."""
+    with _cache_lock:
+        entrada = _cache_usuarios.get(numero)
+    if entrada is None or entrada[2] is None or entrada[0] <= time.monotonic():
+        return None
+    return _copiar(entrada[2])
 
-try:
-    db = firestore.client()
-except Exception:
-    db = None
-    print("❌ No se pudo conectar a Firestore. Verifica las credenciales.")
 
-COLLECTION_USERS = "usuarios"
-# ID de la app para sincronización con el Dashboard Web
-# Debe coincidir con el usado en el frontend React
-APP_ID_DASHBOARD = "default-logicbot"
+def invalidar_cache_usuario(numero_telefono):
+    with _cache_lock:
+        _cache_usuarios.pop(str(numero_telefono), None)
 
 
-# --- FUNCIONES DE BASE DE DATOS ---
+def tasa_aciertos_cache():
+    """Fracción de lecturas de usuario resueltas sin ir al backend."""
+    hits = metrics.leer_contador("user_cache_total", {"resultado": "hit"})
+    total = hits + metrics.leer_contador("user_cache_total", {"resultado": "miss"})
+    return hits / total if total else 0.0
 
-def inicializar_db():
-    if db:
-        print("✅ Conexión a Firestore activa.")
-    else:
-        print("❌ Error: Firestore no está conectado.")
+
+metrics.registrar_gauge("user_cache_entradas", lambda: len(_cache_usuarios))
+metrics.registrar_gauge("user_cache_hit_rate", tasa_aciertos_cache, agregacion="promedio")
 
 
 def obtener_usuario(numero_telefono):
-    if not db: return None
+    """
+    Retorna el usuario desde la caché del proceso o, si no está, desde el backend.
+    Dentro de un turno retorna la SesionUsuario del turno (ver sesion.py), que
+    ya ve los cambios aún no confirmados; solo la primera lectura sale de fuera.
+    """
+    numero = str(numero_telefono)
+    unidad = unidad_actual()
+    if unidad is not None and numero in unidad.sesiones:
+        return unidad.sesiones[numero]
+    datos = _SIN_CACHE if _turno_sin_cache(unidad) else _cache_leer(numero, copiar=unidad is None)
+    if datos is _SIN_CACHE:
+        datos = leer_usuario(numero)
+    return abrir_sesion(numero, datos)
+
+
+async def obtener_usuario_async(numero_telefono):
+    """Como obtener_usuario, sin bloquear el event loop cuando hay que ir al backend."""
+    numero = str(numero_telefono)
+    unidad = unidad_actual()
+    if unidad is not None and numero in unidad.sesiones:
+        return unidad.sesiones[numero]
+    datos = _SIN_CACHE if _turno_sin_cache(unidad) else _cache_leer(numero, copiar=unidad is None)
+    if datos is _SIN_CACHE:
+        datos = await leer_usuario_async(numero)
+    return abrir_sesion(numero, datos)
+
+
+def _turno_sin_cache(unidad):
+    """
+    Un turno no abre su sesión desde la caché si el backend lo comparten
+    varios procesos: la entrada puede ser de antes de un turno que otro
+    proceso de gunicorn ya escribió (hasta USER_CACHE_TTL_SEGUNDOS atrás).
+    """
+    return unidad is not None and obtener_almacen().compartido
+
+
+def abrir_sesion(numero_telefono, datos):
+    """
+    Dentro de un turno, la SesionUsuario del usuario sobre `datos` (un
+    documento ya leído, ej. en la lectura batch de la entrega). Fuera de un
+    turno retorna `datos` tal cual.
+    """
+    unidad = unidad_actual()
+    if datos is None or unidad is None:
+        return datos
+    return unidad.sesion(numero_telefono, datos)
+
+
+def leer_usuario(numero_telefono):
+    """Lee el usuario directo del backend (sin caché) y refresca la caché."""
+    try:
+        datos, version = obtener_almacen().leer_usuario(str(numero_telefono))
+    except Exception as e:
+        print(f"Error obteniendo usuario: {e}")
+        return None
+    return _leido(str(numero_telefono), datos, version)
+
+
+async def leer_usuario_async(numero_telefono):
     try:
-        doc_ref = db.collection(COLLECTION_USERS).document(str(numero_telefono))
-        doc = doc_ref.get()
-        if doc.exists:
-            datos = doc.to_dict()
-            datos['numero_telefono'] = str(numero_telefono)
-            return datos
-        else:
-            return None
+        datos, version = await obtener_almacen().leer_usuario_async(str(numero_telefono))
     except Exception as e:
         print(f"Error obteniendo usuario: {e}")
         return None
+    return _leido(str(numero_telefono), datos, version)
+
+
+def _leido(numero, datos, version):
+    # Lo diferido en el diario aún no está en el backend, pero el turno debe verlo
+    datos = diario.superponer(numero, normalizar_usuario(datos))
+    _cache_guardar(numero, datos, version)
+    return datos
+
+
+def obtener_usuarios(numeros_telefono):
+    """
+    Lee varios usuarios en UNA sola llamada batch (get_all en Firestore).
+    Retorna {numero: datos | None}; None significa que el usuario no existe.
+    Si la lectura falla retorna {} para que el llamador lea uno a uno.
+    Siempre va al backend: es donde la caché se revalida en cada entrega.
+    """
+    if not numeros_telefono: return {}
+    try:
+        leidos = obtener_almacen().leer_usuarios([str(n) for n in numeros_telefono])
+    except Exception as e:
+        print(f"Error obteniendo usuarios en batch: {e}")
+        return {}
+    return {numero: _leido(numero, datos, version) for numero, (datos, version) in leidos.items()}
+
+
+async def obtener_usuarios_async(numeros_telefono):
+    """Como obtener_usuarios, sin bloquear el event loop."""
+    if not numeros_telefono: return {}
+    try:
+        leidos = await obtener_almacen().leer_usuarios_async([str(n) for n in numeros_telefono])
+    except Exception as e:
+        print(f"Error obteniendo usuarios en batch: {e}")
+        return {}
+    return {numero: _leido(numero, datos, version) for numero, (datos, version) in leidos.items()}
+
+
+def reclamar_mensaje(message_id, ttl_segundos):
+    """
+    Reclama atómicamente un messages[].id: solo el primer proceso que lo
+    intente gana. Retorna False si ya estaba reclamado.
+    Ante errores del backend retorna True (preferimos procesar a perder el mensaje).
+    """
+    try:
+        return obtener_almacen().reclamar_mensaje(str(message_id), ttl_segundos)
+    except Exception as e:
+        print(f"⚠️ Error reclamando mensaje {message_id}: {e}")
+        return True
+
+
+def adquirir_turno(numero_telefono, propietario, ttl_segundos):
+    """
+    Toma (o renueva) el lease del usuario dentro de una transacción.
+    Retorna False si otro proceso lo tiene y aún no expiró.
+    Ante errores del backend retorna True para no bloquear al estudiante.
+    """
+    try:
+        return obtener_almacen().adquirir_turno(str(numero_telefono), propietario, ttl_segundos)
+    except Exception as e:
+        print(f"⚠️ Error adquiriendo turno de {numero_telefono}: {e}")
+        return True
+
+
+def liberar_turno(numero_telefono, propietario):
+    """Libera el lease del usuario solo si todavía pertenece a `propietario`."""
+    try:
+        obtener_almacen().liberar_turno(str(numero_telefono), propietario)
+    except Exception as e:
+        print(f"⚠️ Error liberando turno de {numero_telefono}: {e}")
 
 
 def crear_usuario(numero_telefono, nombre):
-    if not db: return
     if obtener_usuario(numero_telefono): return
 
+    nuevo_usuario = _nuevo_usuario(numero_telefono, nombre)
+    try:
+        # Usuario y copia del dashboard en una sola escritura atómica
+        version = obtener_almacen().crear_usuario(str(numero_telefono), nuevo_usuario,
+                                                  _datos_publicos(numero_telefono, nuevo_usuario))
+        _usuario_creado(numero_telefono, nuevo_usuario, version)
+    except Exception as e:
+        print(f"❌ Error al crear usuario: {e}")
+
+
+async def crear_usuario_async(numero_telefono, nombre):
+    if await obtener_usuario_async(numero_telefono): return
+
+    nuevo_usuario = _nuevo_usuario(numero_telefono, nombre)
+    try:
+        version = await obtener_almacen().crear_usuario_async(str(numero_telefono), nuevo_usuario,
+                                                              _datos_publicos(numero_telefono, nuevo_usuario))
+        _usuario_creado(numero_telefono, nuevo_usuario, version)
+    except Exception as e:
+        print(f"❌ Error al crear usuario: {e}")
+
+
+def _nuevo_usuario(numero_telefono, nombre):
     progreso_inicial = {}
     java_lessons = CURSOS.get("java", {}).get("lecciones", [])
     for leccion in java_lessons:
@@ -88,64 +371,269 @@ def crear_usuario(numero_telefono, nombre):
         "reto_actual_solucion": None,
         "reto_actual_pistas": None,
         "pistas_usadas": 0,
-        "historial_chat": "[]",
-        "progreso_temas": json.dumps(progreso_inicial),
+        "historial_chat": [],
+        "progreso_temas": progreso_inicial,
         "onboarding_completado": 0,
         "preferencia_aprendizaje": None,
         "nivel_inicial": None,
-        "logros_desbloqueados": "[]",
+        "logros_desbloqueados": [],
         "retos_completados": 0,
         "retos_sin_pistas": 0,
         "class_token": None,  # Campo nuevo para vinculación
         # NUEVOS CAMPOS GLOBALES PARA ANALÍTICA
         "total_pistas_usadas": 0,  # Histórico acumulado
-        "total_fallos": 0  # Histórico de errores
+        "total_fallos": 0,  # Histórico de errores
+        "schema_version": ESQUEMA_USUARIO
     }
+    return nuevo_usuario
 
-    try:
-        db.collection(COLLECTION_USERS).document(str(numero_telefono)).set(nuevo_usuario)
-        print(f"✅ Usuario {numero_telefono} creado en Firestore exitosamente")
-        # Sincronizar creación con el dashboard
-        sincronizar_con_dashboard(str(numero_telefono), nuevo_usuario)
-    except Exception as e:
-        print(f"❌ Error al crear usuario en Firestore: {e}")
+
+def _usuario_creado(numero_telefono, nuevo_usuario, version):
+    _cache_guardar(str(numero_telefono), nuevo_usuario, version)
+    print(f"✅ Usuario {numero_telefono} creado exitosamente")
+    unidad = unidad_actual()
+    if unidad is not None:
+        unidad.registrar_base(numero_telefono, nuevo_usuario)
 
 
 def actualizar_usuario(numero_telefono, datos):
-    if not db: return
+    """
+    Dentro de un turno acumula los cambios en la unidad de trabajo
+    (se escriben al final, ver unit_of_work.py); fuera de él escribe directo.
+    """
+    unidad = unidad_actual()
+    if unidad is not None:
+        unidad.registrar(numero_telefono, datos)
+        return
+    guardar_cambios_usuario(numero_telefono, datos)
+
+
+async def actualizar_usuario_async(numero_telefono, datos):
+    """Como actualizar_usuario; fuera de un turno escribe sin bloquear el event loop."""
+    unidad = unidad_actual()
+    if unidad is not None:
+        unidad.registrar(numero_telefono, datos)
+        return
+    await guardar_cambios_usuario_async(numero_telefono, datos)
+
+
+# --- PUNTAJE ---
+# Los contadores se escriben como Incremento y el nivel como Maximo: el backend
+# los aplica sobre el valor guardado (Increment/Maximum en Firestore), así dos
+# turnos concurrentes del mismo usuario no se pisan los puntos y no hace falta
+# releer el documento para sumar. Dentro de un turno pasan por la unidad de
+# trabajo como cualquier cambio: obtener_usuario ya los ve sumados.
+
+def sumar_puntos(numero_telefono, puntos, **contadores):
+    """Suma `puntos` y, opcionalmente, otros contadores (ej: retos_completados=1)."""
+    cambios = {campo: Incremento(valor) for campo, valor in contadores.items() if valor}
+    if puntos:
+        cambios["puntos"] = Incremento(puntos)
+    if cambios:
+        actualizar_usuario(numero_telefono, cambios)
+
+
+def registrar_acierto(numero_telefono, puntos, sin_pistas):
+    sumar_puntos(numero_telefono, puntos, retos_completados=1, retos_sin_pistas=1 if sin_pistas else 0)
+
+
+def registrar_fallo(numero_telefono):
+    sumar_puntos(numero_telefono, 0, intentos_fallidos=1, total_fallos=1)
+
+
+def registrar_pista(numero_telefono):
+    sumar_puntos(numero_telefono, 0, pistas_usadas=1, total_pistas_usadas=1)
+
+
+def subir_nivel(numero_telefono, nivel):
+    """Sube el nivel general a `nivel`; si otro turno ya lo subió más, se conserva el mayor."""
+    actualizar_usuario(numero_telefono, {"nivel": Maximo(nivel)})
+
+
+def sumar_progreso_tema(numero_telefono, tema, puntos, nivel):
+    """Suma puntos al tema y deja su nivel en al menos `nivel` (solo toca progreso_temas.<tema>)."""
+    actualizar_usuario(numero_telefono, {
+        ("progreso_temas", tema, "puntos"): Incremento(puntos),
+        ("progreso_temas", tema, "nivel"): Maximo(nivel)
+    })
+
+
+def desbloquear_logros(numero_telefono, logros_ids):
+    """Agrega los logros a logros_desbloqueados sin reescribir la lista."""
+    if logros_ids:
+        actualizar_usuario(numero_telefono, {"logros_desbloqueados": UnionArreglo(logros_ids)})
+
+
+# Campos cuyo cambio debe reflejarse en el Dashboard
+CAMPOS_DASHBOARD = ["puntos", "nivel", "racha_dias", "progreso_temas", "retos_completados", "historial_chat",
+                    "class_token", "total_pistas_usadas", "total_fallos"]
+
+
+def guardar_cambios_usuario(numero_telefono, datos, usuario_base=None):
+    """
+    Escribe `datos` en el documento del usuario y en la caché (write-through).
+    Retorna True si se guardó. Si cambia algún campo del Dashboard, a users_sync
+    solo van los campos públicos cuyo valor cambió respecto de `usuario_base`
+    (o de la caché), sin volver a leer el documento. Sin ventana de sync van en
+    la misma escritura atómica; si no, se difieren (ver dashboard_sync.py).
+    """
+    numero = str(numero_telefono)
+    clave = diario.anotar(numero, datos)
+    if clave is not None and diario.atrasado(numero):
+        return _diferir(numero, datos, usuario_base, clave)
     try:
-        doc_ref = db.collection(COLLECTION_USERS).document(str(numero_telefono))
-        doc_ref.update(datos)
-
-        # Sincronización automática con Dashboard si hay cambios relevantes
-        campos_dashboard = ["puntos", "nivel", "racha_dias", "progreso_temas", "retos_completados", "historial_chat",
-                            "class_token", "total_pistas_usadas", "total_fallos"]
-        if any(campo in datos for campo in campos_dashboard):
-            # Obtenemos el usuario completo actualizado para sincronizar
-            usuario_actualizado = obtener_usuario(numero_telefono)
-            if usuario_actualizado:
-                sincronizar_con_dashboard(numero_telefono, usuario_actualizado)
+        if usuario_base is None and any(isinstance(campo, tuple) for campo in datos):
+            usuario_base = _cache_documento(numero) or leer_usuario(numero)
+        escritos, base, cambios_publicos, en_linea = _preparar_guardado(
+            numero, diario.marcar(datos, clave, usuario_base), usuario_base)
+        version = obtener_almacen().actualizar_usuario(numero, escritos, cambios_publicos if en_linea else None)
+        _usuario_guardado(numero, escritos, base, version, cambios_publicos, en_linea)
+        diario.confirmar(clave)
+        return True
+    except Exception as e:
+        return _error_al_guardar(numero, datos, usuario_base, clave, e)
 
+
+async def guardar_cambios_usuario_async(numero_telefono, datos, usuario_base=None):
+    """Como guardar_cambios_usuario, sin bloquear el event loop."""
+    numero = str(numero_telefono)
+    clave = diario.anotar(numero, datos)
+    if clave is not None and diario.atrasado(numero):
+        return _diferir(numero, datos, usuario_base, clave)
+    try:
+        if usuario_base is None and any(isinstance(campo, tuple) for campo in datos):
+            usuario_base = _cache_documento(numero) or await leer_usuario_async(numero)
+        escritos, base, cambios_publicos, en_linea = _preparar_guardado(
+            numero, diario.marcar(datos, clave, usuario_base), usuario_base)
+        version = await obtener_almacen().actualizar_usuario_async(numero, escritos,
+                                                                   cambios_publicos if en_linea else None)
+        _usuario_guardado(numero, escritos, base, version, cambios_publicos, en_linea)
+        diario.confirmar(clave)
+        return True
     except Exception as e:
-        print(f"❌ Error al actualizar usuario: {e}")
+        return _error_al_guardar(numero, datos, usuario_base, clave, e)
 
 
-def sincronizar_con_dashboard(numero_telefono, datos_usuario):
+def _error_al_guardar(numero, datos, usuario_base, clave, error):
+    if clave is not None:
+        print(f"💾 Error al actualizar usuario ({error}): el cambio queda en el diario para reintentarlo")
+        return _diferir(numero, datos, usuario_base, clave)
+    # No sabemos qué quedó escrito: la próxima lectura va al backend
+    invalidar_cache_usuario(numero)
+    print(f"❌ Error al actualizar usuario: {error}")
+    return False
+
+
+def _diferir(numero, datos, usuario_base, clave):
+    """Deja el cambio para el hilo del diario; la caché ya lo refleja para los próximos turnos."""
+    diario.diferir(clave)
+    _cache_aplicar(numero, diario.marcar(datos, clave), usuario_base, None)
+    return True
+
+
+def reaplicar_cambios_usuario(numero_telefono, datos, clave):
     """
-    Copia los datos esenciales a la colección pública 'artifacts'
-    para que el Dashboard Web pueda leerlos.
+    Reintenta un cambio diferido del diario. Retorna False si el backend
+    sigue sin responder; True si quedó escrito, ya estaba aplicado o el
+    usuario ya no existe.
     """
-    if not db: return
+    numero = str(numero_telefono)
+    try:
+        usuario_base, _ = obtener_almacen().leer_usuario(numero)
+        if usuario_base is None:
+            print(f"⚠️ Diario: el usuario {numero} ya no existe, se descarta su cambio")
+            metrics.incrementar("diario_entradas_total", etiquetas={"resultado": "descartada"})
+            return True
+        if diario.aplicada(usuario_base, clave):
+            return True
+        escritos, base, cambios_publicos, en_linea = _preparar_guardado(
+            numero, diario.marcar(datos, clave, usuario_base), normalizar_usuario(usuario_base))
+        version = obtener_almacen().actualizar_usuario(numero, escritos, cambios_publicos if en_linea else None)
+        _usuario_guardado(numero, escritos, base, version, cambios_publicos, en_linea)
+        return True
+    except Exception as e:
+        print(f"⚠️ Diario: reintento para {numero} fallido: {e}")
+        return False
+
+
+def _preparar_guardado(numero, datos, usuario_base):
+    """Retorna (datos, usuario_base, cambios_publicos, en_linea) listos para escribir."""
+    if usuario_base is not None and usuario_base.get("schema_version", 1) < ESQUEMA_USUARIO:
+        # Documento v1: sus campos estructurados aún son strings en el
+        # backend, así que van enteros (ya decodificados) junto con el resto
+        datos = {**{campo: valor for campo, valor in datos.items() if raiz(campo) not in CAMPOS_ESTRUCTURADOS},
+                 **cambios_de_migracion(resolver(usuario_base, datos))}
+        metrics.incrementar("usuarios_migrados_total", etiquetas={"origen": "escritura"})
+
+    cambios_publicos = {}
+    if any(raiz(campo) in CAMPOS_DASHBOARD for campo in datos):
+        if usuario_base is None:
+            usuario_base = _cache_documento(numero)
+        cambios_publicos = _diferencias_publicas(numero, usuario_base, datos)
+        if not cambios_publicos:
+            metrics.incrementar("dashboard_sync_omitidas_total")
+
+    en_linea = bool(cambios_publicos) and not dashboard_sync.diferido()
+    return datos, usuario_base, cambios_publicos, en_linea
+
+
+def _usuario_guardado(numero, datos, usuario_base, version, cambios_publicos, en_linea):
+    if en_linea:
+        _contar_sync(cambios_publicos)
+    if any(raiz(campo) in estadisticas_clase.CAMPOS_CLASE for campo in datos):
+        _actualizar_clases(numero, usuario_base, datos)
+    _cache_aplicar(numero, datos, usuario_base, version)
+    if cambios_publicos and not en_linea:
+        dashboard_sync.programar(numero, cambios_publicos)
 
-    # Preparamos solo los datos que el dashboard necesita ver
-    datos_publicos = {
+
+def _diferencias_publicas(numero_telefono, usuario_base, datos):
+    """
+    Campos públicos cuyo valor cambia al aplicar `datos` sobre `usuario_base`.
+    Sin base no se puede comparar: se toman los públicos presentes en `datos`.
+    Los Incremento/Maximo viajan tal cual, para que la copia también se
+    actualice en el servidor y no con un total calculado sobre una base vieja.
+    """
+    despues = _datos_publicos(numero_telefono, resolver(usuario_base, datos))
+    if usuario_base is None:
+        raices = {raiz(campo) for campo in datos}
+        cambios = {campo: valor for campo, valor in despues.items() if campo in raices}
+    else:
+        antes = _datos_publicos(numero_telefono, usuario_base)
+        cambios = {campo: valor for campo, valor in despues.items() if antes.get(campo) != valor}
+    for campo in cambios:
+        if es_transformacion(datos.get(campo)):
+            cambios[campo] = datos[campo]
+    return cambios
+
+
+def _actualizar_clases(numero, usuario_base, datos):
+    """Lleva a los agregados de la clase la diferencia que este cambio hace en el alumno."""
+    if usuario_base is None:
+        usuario_base = _cache_documento(numero)
+    if usuario_base is None:
+        # Sin el estado previo no hay diferencia que calcular (reconstruir_clases lo corrige)
+        metrics.incrementar("estadisticas_clase_sin_base_total")
+        return
+    usuario_base = {**usuario_base, "numero_telefono": numero}
+    estadisticas_clase.programar(estadisticas_clase.diferencias(usuario_base, resolver(usuario_base, datos)))
+
+
+def _contar_sync(cambios_publicos):
+    metrics.incrementar("dashboard_sync_escrituras_total")
+    metrics.incrementar("dashboard_sync_campos_total", len(cambios_publicos))
+
+
+def _datos_publicos(numero_telefono, datos_usuario):
+    """Solo los datos que el dashboard necesita ver."""
+    return {
         "nombre": datos_usuario.get("nombre"),
         "numero_telefono": str(numero_telefono),
         "class_token": datos_usuario.get("class_token"),
         "nivel": datos_usuario.get("nivel"),
         "puntos": datos_usuario.get("puntos"),
         "racha_dias": datos_usuario.get("racha_dias"),
-        "progreso_temas": datos_usuario.get("progreso_temas"),
+        "progreso_temas": _como_json(datos_usuario.get("progreso_temas")),
         "retos_completados": datos_usuario.get("retos_completados"),
         "retos_sin_pistas": datos_usuario.get("retos_sin_pistas"),
         "pistas_usadas": datos_usuario.get("pistas_usadas"),
@@ -154,24 +642,59 @@ def sincronizar_con_dashboard(numero_telefono, datos_usuario):
         "total_pistas_usadas": datos_usuario.get("total_pistas_usadas", 0),
         "total_fallos": datos_usuario.get("total_fallos", 0),
         # Limitamos el historial para no saturar
-        "historial_chat": datos_usuario.get("historial_chat", "[]")
+        "historial_chat": _como_json(datos_usuario.get("historial_chat", []))
     }
 
+
+def proyeccion_dashboard(numero_telefono, datos_usuario):
+    """La copia completa de users_sync que corresponde a un documento de usuario."""
+    return _datos_publicos(numero_telefono, normalizar_usuario(datos_usuario))
+
+
+def _como_json(valor):
+    # El frontend del dashboard sigue leyendo estos campos como strings JSON
+    return json.dumps(valor) if isinstance(valor, (list, dict)) else valor
+
+
+def sincronizar_con_dashboard(numero_telefono, datos_usuario):
+    """
+    Copia los datos esenciales a la colección pública 'artifacts'
+    para que el Dashboard Web pueda leerlos.
+    """
     try:
-        # Ruta: artifacts/{APP_ID}/public/data/users_sync/{numero_telefono}
-        # Esta ruta es legible por el frontend
-        (db.collection('artifacts').document(APP_ID_DASHBOARD)
-         .collection('public').document('data')
-         .collection('users_sync').document(str(numero_telefono))
-         .set(datos_publicos))
+        obtener_almacen().reemplazar_dashboard(str(numero_telefono), _datos_publicos(numero_telefono, datos_usuario))
     except Exception as e:
         print(f"⚠️ Error sincronizando con dashboard: {e}")
 
 
+def escribir_dashboard(cambios_por_usuario):
+    """
+    Escribe en users_sync los campos cambiados de varios usuarios
+    ({numero: {campo: valor}}); en Firestore, hasta 500 por WriteBatch con
+    set + merge (solo toca esos campos y no falla si la copia aún no existe).
+    Retorna True si todo se guardó.
+    """
+    try:
+        obtener_almacen().escribir_dashboard(cambios_por_usuario)
+        for cambios in cambios_por_usuario.values():
+            _contar_sync(cambios)
+        return True
+    except Exception as e:
+        print(f"⚠️ Error escribiendo cambios del dashboard: {e}")
+        return False
+
+
+def obtener_estadisticas_clase(token_clase):
+    """Agregados de la clase (alumnos, puntos, temas, fallos, pistas, actividad) en una lectura."""
+    try:
+        return obtener_almacen().leer_clase(token_clase)
+    except Exception as e:
+        print(f"⚠️ Error leyendo estadísticas de la clase {token_clase}: {e}")
+        return None
+
+
 def vincular_alumno_a_clase(numero_telefono, token_clase):
     """Vincula un alumno a una clase específica mediante token."""
-    if not db: return False
-
     print(f"🔗 Vinculando {numero_telefono} a clase {token_clase}")
     try:
         # 1. Actualizar registro principal
@@ -182,14 +705,28 @@ def vincular_alumno_a_clase(numero_telefono, token_clase):
         return False
 
 
+def escribir_registros(registros):
+    """
+    Crea (o reescribe) registros de analítica con ID conocido en una sola
+    escritura (un WriteBatch en Firestore). `registros` es una lista de
+    (coleccion, doc_id, datos) de hasta 500. Retorna True si se guardaron.
+    Lo usa bulk_writer.py.
+    """
+    try:
+        obtener_almacen().escribir_registros(registros)
+        return True
+    except Exception as e:
+        print(f"⚠️ Error escribiendo lote de {len(registros)} registro(s): {e}")
+        return False
+
+
 # ✅ NUEVA FUNCIÓN PARA REGISTRAR ALERTAS
 def registrar_alerta_seguridad(numero_telefono, datos_alerta):
     """
     Registra una alerta de integridad (velocidad, copy-paste) en Firestore
     para que sea notificada en el Dashboard Docente.
+    Se encola y se escribe en lote en segundo plano (ver bulk_writer.py).
     """
-    if not db: return False
-
     try:
         # Estructura del documento de alerta
         alerta = {
@@ -215,9 +752,7 @@ def registrar_alerta_seguridad(numero_telefono, datos_alerta):
 
         # Guardamos en la colección pública 'alerts' dentro de artifacts
         # Ruta: artifacts/{APP_ID}/public/data/alerts/{auto_id}
-        (db.collection('artifacts').document(APP_ID_DASHBOARD)
-         .collection('public').document('data')
-         .collection('alerts').add(alerta))
+        bulk_writer.encolar('alerts', alerta)
 
         print(f"🚨 Alerta de seguridad registrada para {numero_telefono}")
         return True
@@ -233,14 +768,16 @@ def registrar_log_reto(numero_telefono, datos_log):
     """
     Registra CUALQUIER intento de reto (sea correcto, incorrecto o sospechoso)
     para el historial académico completo en el dashboard.
+    Se encola y se escribe en lote en segundo plano (ver bulk_writer.py).
     """
-    if not db: return False
-
     try:
+        token_clase = (obtener_usuario(numero_telefono) or {}).get("class_token")
+
         # Estructura del log académico
         log_entry = {
             "estudiante_id": str(numero_telefono),
             "nombre_estudiante": datos_log.get("nombre", "Estudiante"),
+            "class_token": token_clase,  # Para filtrar exportaciones por clase
 
             # Contexto Educativo
             "tema": datos_log.get("tema", "General"),
@@ -261,9 +798,12 @@ def registrar_log_reto(numero_telefono, datos_log):
         }
 
         # Guardamos en 'challenge_logs' (colección pública para el dashboard)
-        (db.collection('artifacts').document(APP_ID_DASHBOARD)
-         .collection('public').document('data')
-         .collection('challenge_logs').add(log_entry))
+        bulk_writer.encolar('challenge_logs', log_entry)
+
+        # Y sus totales en los agregados de la clase del alumno
+        if token_clase:
+            estadisticas_clase.programar(
+                {token_clase: estadisticas_clase.cambios_de_reto(numero_telefono, log_entry)})
 
         print(f"📝 Log académico registrado para {numero_telefono}")
         return True
@@ -0,0 +1,85 @@
+# dedup.py
+# Deduplicación idempotente de mensajes re-entregados por Meta.
+# Cuando un turno tarda más que el timeout del webhook, Meta vuelve a enviar
+# el mismo messages[].id; aquí lo detectamos para no evaluar ni puntuar dos veces.
+
+import threading
+import time
+from collections import OrderedDict
+
+import src.database as db
+from src import metrics
+from src.config.config import DEDUP_TTL_SEGUNDOS, DEDUP_MAX_IDS, DEDUP_STORE
+
+# Los IDs se reclaman en el Almacen configurado (Firestore o SQLite);
+# "firestore" es el nombre que tenía antes esta opción
+_COMPARTIDO = DEDUP_STORE in ("compartido", "firestore")
+
+_lock = threading.Lock()
+# message_id -> instante (monotonic) en que expira
+_vistos = OrderedDict()
+
+
+def _purgar(ahora):
+    """Elimina los IDs expirados y recorta al tamaño máximo (los más viejos primero)."""
+    while _vistos:
+        message_id, expira = next(iter(_vistos.items()))
+        if expira > ahora and len(_vistos) <= DEDUP_MAX_IDS:
+            break
+        _vistos.popitem(last=False)
+
+
+def registrar_en_memoria(message_id):
+    """
+    Marca el ID como visto en este proceso.
+    Retorna True si es nuevo y False si ya se había visto (duplicado).
+    """
+    metrics.incrementar("dedup_consultas_total")
+    ahora = time.monotonic()
+    with _lock:
+        _purgar(ahora)
+        expira = _vistos.get(message_id)
+        if expira is not None and expira > ahora:
+            duplicado = True
+        else:
+            _vistos[message_id] = ahora + DEDUP_TTL_SEGUNDOS
+            duplicado = False
+
+    if duplicado:
+        metrics.incrementar("dedup_duplicados_total")
+        metrics.incrementar("dedup_hits_memoria_total")
+    return not duplicado
+
+
+def olvidar(message_ids):
+    """Desmarca IDs (ej: la entrega no se pudo encolar y Meta la reintentará)."""
+    with _lock:
+        for message_id in message_ids:
+            _vistos.pop(message_id, None)
+
+
+def reclamar_compartido(message_id):
+    """
+    Reclama el ID en el store compartido entre procesos (si está activo).
+    Retorna True si este proceso debe procesar el mensaje.
+    """
+    if not _COMPARTIDO:
+        return True
+
+    nuevo = db.reclamar_mensaje(message_id, DEDUP_TTL_SEGUNDOS)
+    if not nuevo:
+        metrics.incrementar("dedup_duplicados_total")
+        metrics.incrementar("dedup_hits_compartido_total")
+    return nuevo
+
+
+def tasa_de_aciertos():
+    """Fracción de mensajes descartados por duplicados sobre el total consultado."""
+    consultas = metrics.leer_contador("dedup_consultas_total")
+    if not consultas:
+        return 0.0
+    return metrics.leer_contador("dedup_duplicados_total") / consultas
+
+
+metrics.registrar_gauge("dedup_ids_en_memoria", lambda: len(_vistos))
+metrics.registrar_gauge("dedup_hit_rate", tasa_de_aciertos, agregacion="promedio")
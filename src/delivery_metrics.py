@@ -0,0 +1,136 @@
+# delivery_metrics.py
+# Latencia extremo a extremo de las respuestas del bot, usando los callbacks
+# de estado que envía Meta (sent, delivered, read) para cada mensaje saliente.
+#
+# Etapas medidas (segundos desde que el webhook recibió el mensaje del usuario):
+#   respuesta_enviada   -> la Graph API aceptó nuestra respuesta
+#   respuesta_sent      -> Meta confirma 'sent'
+#   respuesta_entregada -> Meta confirma 'delivered' en el teléfono
+#   respuesta_leida     -> el estudiante la leyó ('read')
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from src import metrics
+from src.config.config import DELIVERY_METRICS_FLUSH_SEGUNDOS
+from src.turn_context import turno_actual
+
+_ESTADOS = {
+    "sent": "respuesta_sent",
+    "delivered": "respuesta_entregada",
+    "read": "respuesta_leida",
+}
+
+# Correlación local wamid -> (recibido_en, enviado_en), por si un callback
+# llega sin biz_opaque_callback_data. Acotada para no crecer sin límite.
+_MAX_ENVIOS = 20000
+_envios = OrderedDict()
+_lock = threading.Lock()
+_flusher = None
+
+
+def datos_callback(enviado_en):
+    """
+    Serializa los tiempos del turno en curso para `biz_opaque_callback_data`.
+    Meta lo devuelve en cada callback de estado, así la latencia se puede
+    calcular en cualquier proceso de gunicorn, no solo en el que envió.
+    """
+    turno = turno_actual()
+    if not turno or not turno.get("recibido_en"):
+        return None
+    return json.dumps({"r": round(turno["recibido_en"], 3), "e": round(enviado_en, 3)},
+                      separators=(",", ":"))
+
+
+def registrar_envio(wamid, enviado_en):
+    """Registra una respuesta aceptada por la Graph API."""
+    metrics.incrementar("whatsapp_envios_total")
+
+    turno = turno_actual()
+    if not turno or not turno.get("recibido_en"):
+        return
+
+    metrics.observar("respuesta_enviada_segundos", time.time() - turno["recibido_en"])
+    if wamid:
+        with _lock:
+            _envios[wamid] = (turno["recibido_en"], enviado_en)
+            while len(_envios) > _MAX_ENVIOS:
+                _envios.popitem(last=False)
+
+
+def registrar_estados(estados):
+    """Procesa los `statuses` de una entrega del webhook."""
+    for estado in estados:
+        tipo = estado.get("status")
+        metrics.incrementar("whatsapp_estados_total", etiquetas={"estado": tipo})
+
+        etapa = _ESTADOS.get(tipo)
+        if not etapa:
+            continue
+
+        tiempos = _tiempos_del_envio(estado)
+        try:
+            ocurrido_en = float(estado.get("timestamp"))
+        except (TypeError, ValueError):
+            ocurrido_en = time.time()
+        if not tiempos:
+            metrics.incrementar("whatsapp_estados_sin_correlacion_total")
+            continue
+
+        recibido_en, enviado_en = tiempos
+        # Meta reporta en segundos enteros: evitamos latencias negativas
+        metrics.observar(f"{etapa}_segundos", max(0.0, ocurrido_en - recibido_en))
+        if tipo == "delivered":
+            metrics.observar("envio_a_entrega_segundos", max(0.0, ocurrido_en - enviado_en))
+        if tipo == "read":
+            with _lock:
+                _envios.pop(estado.get("id"), None)
+
+
+def _tiempos_del_envio(estado):
+    """Obtiene (recibido_en, enviado_en) del callback o de la correlación local."""
+    callback = estado.get("biz_opaque_callback_data")
+    if callback:
+        try:
+            datos = json.loads(callback)
+            return float(datos["r"]), float(datos["e"])
+        except (ValueError, KeyError, TypeError):
+            pass
+    with _lock:
+        return _envios.get(estado.get("id"))
+
+
+def iniciar_flush_periodico():
+    """Arranca un hilo que cada DELIVERY_METRICS_FLUSH_SEGUNDOS resume las latencias en el log."""
+    global _flusher
+    if _flusher or DELIVERY_METRICS_FLUSH_SEGUNDOS <= 0:
+        return
+    _flusher = threading.Thread(target=_bucle_flush, name="delivery-metrics-flush", daemon=True)
+    _flusher.start()
+
+
+def _bucle_flush():
+    while True:
+        time.sleep(DELIVERY_METRICS_FLUSH_SEGUNDOS)
+        try:
+            flush()
+        except Exception as e:
+            print(f"⚠️ Error resumiendo métricas de entrega: {e}")
+
+
+def flush():
+    """Imprime p50/p95 de cada etapa con observaciones."""
+    partes = []
+    for etapa in ["respuesta_enviada"] + list(_ESTADOS.values()):
+        p50 = metrics.percentil(f"{etapa}_segundos", 0.5)
+        if p50 is None:
+            continue
+        p95 = metrics.percentil(f"{etapa}_segundos", 0.95)
+        partes.append(f"{etapa} p50≤{p50}s p95≤{p95}s")
+    if partes:
+        print("⏱️ Latencia de respuestas: " + " | ".join(partes))
+
+
+metrics.registrar_gauge("whatsapp_envios_en_seguimiento", lambda: len(_envios))
@@ -0,0 +1,446 @@
+# diario.py
+# Diario de escrituras (write-ahead) de los cambios de usuario.
+#
+# database.guardar_cambios_usuario anota cada cambio en un segmento JSONL de
+# este proceso antes de enviarlo al backend y lo confirma cuando el backend
+# responde. Si la escritura falla, el cambio queda diferido: el turno sigue
+# (la caché ya lo refleja) y un hilo lo reintenta cada
+# DIARIO_REINTENTO_SEGUNDOS, en el orden en que se anotó. Mientras un usuario
+# tenga cambios diferidos, los nuevos van detrás de ellos.
+#
+# Cada escritura lleva en el documento la marca `diario_aplicado.<origen>`
+# con el número de la anotación (como Maximo), así un reintento de algo que
+# sí llegó al backend (timeout ambiguo, o el proceso murió antes de
+# confirmar) no suma dos veces los Incremento. La marca es por origen: las
+# escrituras de otros procesos no pisan la de uno que murió con anotaciones
+# sin recuperar. Como cada proceso es un origen nuevo, los números son
+# microsegundos (crecientes) y cada escritura borra las marcas de orígenes
+# que llevan más de DIARIO_MARCA_DIAS sin escribir: el documento guarda solo
+# las de los procesos recientes.
+#
+# Los segmentos de un proceso que murió los reclama otro (renombrándolos,
+# como los derrames de bulk_writer) y reanota lo que no estaba confirmado. Un
+# segmento cerrado sin pendientes se borra; si el diario pasa de
+# DIARIO_MAX_BYTES se compactan los segmentos viejos y, si aún no hay lugar,
+# los cambios nuevos se escriben sin anotar.
+
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from src import metrics
+from src.config.config import (
+    DIARIO_DIR, DIARIO_SEGMENTO_BYTES, DIARIO_MAX_BYTES, DIARIO_REINTENTO_SEGUNDOS, DIARIO_FSYNC,
+    DIARIO_MARCA_DIAS
+)
+from src.storage.base import Borrado, Incremento, Maximo, UnionArreglo, resolver
+
+# Campo del documento de usuario con la última anotación aplicada por origen
+CAMPO_MARCA = "diario_aplicado"
+
+# Identifica las anotaciones de este proceso (un pid se reutiliza entre reinicios)
+_ORIGEN = uuid.uuid4().hex[:12]
+# Número de la última anotación, en microsegundos (ver _siguiente)
+_ultimo_seq = 0
+_lock = threading.Lock()
+_hilo = None
+
+# (origen, seq) -> [numero, datos, segmento, en_vuelo]. en_vuelo: la está
+# escribiendo su turno; si no, está diferida y la reintenta el hilo del diario.
+_entradas = OrderedDict()
+# numero -> anotaciones sin confirmar
+_por_usuario = Counter()
+# numero -> (renovar, liberar) del lease que su turno dejó tomado (ver retener)
+_retenidos = {}
+# ruta -> [bytes, anotaciones sin confirmar], en orden de creación
+_segmentos = OrderedDict()
+_activo = None
+_n_segmento = itertools.count(1)
+
+
+def activo():
+    return bool(DIARIO_DIR)
+
+
+# --- CODIFICACIÓN ---
+
+def _codificar(datos):
+    """[campo, op, valor] por cambio; las rutas anidadas van como listas."""
+    filas = []
+    for campo, valor in datos.items():
+        campo = list(campo) if isinstance(campo, tuple) else campo
+        if isinstance(valor, Incremento):
+            filas.append([campo, "inc", valor.valor])
+        elif isinstance(valor, Maximo):
+            filas.append([campo, "max", valor.valor])
+        elif isinstance(valor, UnionArreglo):
+            filas.append([campo, "union", valor.valores])
+        else:
+            filas.append([campo, "=", valor])
+    return filas
+
+
+def _decodificar(filas):
+    operaciones = {"inc": Incremento, "max": Maximo, "union": UnionArreglo}
+    datos = {}
+    for campo, op, valor in filas:
+        campo = tuple(campo) if isinstance(campo, list) else campo
+        datos[campo] = operaciones[op](valor) if op in operaciones else valor
+    return datos
+
+
+def _linea(clave, numero, datos):
+    return json.dumps({"o": clave[0], "s": clave[1], "n": numero, "c": _codificar(datos)},
+                      ensure_ascii=False, default=str) + "\n"
+
+
+# --- SEGMENTOS (siempre con _lock tomado) ---
+
+def _ruta_segmento():
+    return os.path.join(DIARIO_DIR, f"diario-{os.getpid()}-{next(_n_segmento):06d}.jsonl")
+
+
+def _escribir(lineas, sincronizar=DIARIO_FSYNC):
+    """Agrega líneas al segmento activo (rota si se llenó). Retorna su ruta."""
+    global _activo
+    if _activo is None or _segmentos[_activo.name][0] >= DIARIO_SEGMENTO_BYTES:
+        if _activo is not None:
+            anterior, _activo = _activo, None
+            anterior.close()
+            _borrar_si_vacio(anterior.name)
+        os.makedirs(DIARIO_DIR, exist_ok=True)
+        _activo = open(_ruta_segmento(), "a", encoding="utf-8")
+        _segmentos[_activo.name] = [0, 0]
+    texto = "".join(lineas)
+    _activo.write(texto)
+    _activo.flush()
+    if sincronizar:
+        os.fsync(_activo.fileno())
+    _segmentos[_activo.name][0] += len(texto.encode("utf-8"))
+    return _activo.name
+
+
+def _borrar_si_vacio(ruta):
+    if ruta in _segmentos and _segmentos[ruta][1] == 0 and (_activo is None or _activo.name != ruta):
+        del _segmentos[ruta]
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+
+def _total_bytes():
+    return sum(tamano for tamano, _ in _segmentos.values())
+
+
+def _bytes_con_lock():
+    with _lock:
+        return _total_bytes()
+
+
+def _compactar():
+    """Reanota en el segmento activo lo pendiente de los segmentos cerrados y los borra."""
+    cerrados = [ruta for ruta in _segmentos if _activo is None or ruta != _activo.name]
+    if not cerrados:
+        return
+    movidas = [(clave, entrada) for clave, entrada in _entradas.items() if entrada[2] in cerrados]
+    if movidas:
+        destino = _escribir([_linea(clave, entrada[0], entrada[1]) for clave, entrada in movidas], sincronizar=True)
+        for _, entrada in movidas:
+            entrada[2] = destino
+        _segmentos[destino][1] += len(movidas)
+    for ruta in cerrados:
+        _segmentos[ruta][1] = 0
+        _borrar_si_vacio(ruta)
+    metrics.incrementar("diario_compactaciones_total")
+
+
+def _siguiente():
+    """Número de la próxima anotación: la hora en microsegundos, siempre creciente."""
+    global _ultimo_seq
+    _ultimo_seq = max(_ultimo_seq + 1, time.time_ns() // 1000)
+    return _ultimo_seq
+
+
+# --- API DEL TURNO ---
+
+def anotar(numero_telefono, datos):
+    """
+    Anota el cambio antes de escribirlo. Retorna su clave, o None si el
+    diario está desactivado o lleno (el cambio se escribe sin anotar).
+    """
+    if not activo():
+        return None
+    numero = str(numero_telefono)
+    try:
+        with _lock:
+            clave = (_ORIGEN, _siguiente())
+            linea = _linea(clave, numero, datos)
+            if _total_bytes() + len(linea) > DIARIO_MAX_BYTES:
+                _compactar()
+                if _total_bytes() + len(linea) > DIARIO_MAX_BYTES:
+                    metrics.incrementar("diario_entradas_total", etiquetas={"resultado": "sin_lugar"})
+                    print(f"⚠️ Diario lleno ({DIARIO_MAX_BYTES} bytes): el cambio de {numero} va sin anotar")
+                    return None
+            ruta = _escribir([linea])
+            _segmentos[ruta][1] += 1
+            _entradas[clave] = [numero, datos, ruta, True]
+            _por_usuario[numero] += 1
+    except (OSError, TypeError, ValueError) as e:
+        metrics.incrementar("diario_entradas_total", etiquetas={"resultado": "sin_lugar"})
+        print(f"❌ No se pudo anotar el cambio de {numero} en el diario: {e}")
+        return None
+    metrics.incrementar("diario_entradas_total", etiquetas={"resultado": "anotada"})
+    iniciar()
+    return clave
+
+
+def atrasado(numero_telefono):
+    """True si el usuario tiene otras anotaciones sin confirmar (la nueva debe ir detrás)."""
+    return _por_usuario.get(str(numero_telefono), 0) > 1
+
+
+def marcar(datos, clave, documento=None):
+    """
+    `datos` con la marca de la anotación, para reconocerla si se reintenta.
+    Con `documento` (el usuario antes de la escritura) también borra las
+    marcas de los orígenes que no escriben hace más de DIARIO_MARCA_DIAS.
+    """
+    if clave is None:
+        return datos
+    marcados = {**datos, (CAMPO_MARCA, clave[0]): Maximo(clave[1])}
+    marcas = (documento or {}).get(CAMPO_MARCA) or {}
+    if marcas and DIARIO_MARCA_DIAS > 0:
+        limite = time.time_ns() // 1000 - int(DIARIO_MARCA_DIAS * 86400 * 1_000_000)
+        with _lock:
+            # Lo que este proceso aún tiene por reintentar conserva su marca
+            pendientes = {origen for origen, _ in _entradas}
+        for origen, seq in marcas.items():
+            # "origen" y "seq" son la marca de antes de guardarlas por origen
+            if origen in ("origen", "seq", clave[0]) or origen in pendientes:
+                continue
+            if isinstance(seq, (int, float)) and seq < limite:
+                marcados[(CAMPO_MARCA, origen)] = Borrado()
+    return marcados
+
+
+def aplicada(documento, clave):
+    """True si el documento del backend ya incluye la anotación `clave`."""
+    marca = (documento or {}).get(CAMPO_MARCA) or {}
+    aplicadas = marca.get(clave[0]) or 0
+    if marca.get("origen") == clave[0]:
+        # Marca {origen, seq} de antes de guardarlas por origen
+        aplicadas = max(aplicadas, marca.get("seq") or 0)
+    return aplicadas >= clave[1]
+
+
+def confirmar(clave):
+    """El backend confirmó la escritura: la anotación ya no se reintenta."""
+    if clave is None:
+        return
+    retenido = None
+    with _lock:
+        entrada = _entradas.pop(clave, None)
+        if entrada is None:
+            return
+        _por_usuario[entrada[0]] -= 1
+        if not _por_usuario[entrada[0]]:
+            del _por_usuario[entrada[0]]
+            retenido = _retenidos.pop(entrada[0], None)
+        _segmentos[entrada[2]][1] -= 1
+        try:
+            _escribir([json.dumps({"a": list(clave)}) + "\n"], sincronizar=False)
+        except OSError as e:
+            # Sin la marca de confirmación un reintento tras un reinicio la reconoce igual
+            print(f"⚠️ No se pudo anotar la confirmación en el diario: {e}")
+        _borrar_si_vacio(entrada[2])
+    if retenido is not None:
+        try:
+            retenido[1]()
+        except Exception as e:
+            print(f"⚠️ Diario: no se pudo liberar el lease de {entrada[0]}: {e}")
+
+
+def diferir(clave):
+    """La escritura falló: la anotación queda para el hilo del diario."""
+    with _lock:
+        entrada = _entradas.get(clave)
+        if entrada is not None:
+            entrada[3] = False
+    metrics.incrementar("diario_entradas_total", etiquetas={"resultado": "diferida"})
+
+
+def retener(numero_telefono, renovar, liberar):
+    """
+    Si el usuario tiene cambios sin confirmar, el diario se queda con su lease:
+    llama a `renovar` antes de reintentarlos (False = lo tiene otro proceso,
+    se espera) y a `liberar` cuando se confirma el último. Retorna False si
+    no hay nada pendiente (el llamador lo libera ya).
+    """
+    numero = str(numero_telefono)
+    with _lock:
+        if not _por_usuario.get(numero):
+            return False
+        _retenidos[numero] = (renovar, liberar)
+    return True
+
+
+def superponer(numero_telefono, documento):
+    """Aplica al documento leído del backend los cambios diferidos que aún no tiene."""
+    numero = str(numero_telefono)
+    if documento is None or not _por_usuario.get(numero):
+        return documento
+    with _lock:
+        diferidos = [(clave, entrada[1]) for clave, entrada in _entradas.items()
+                     if entrada[0] == numero and not entrada[3]]
+    for clave, datos in diferidos:
+        if not aplicada(documento, clave):
+            documento = resolver(documento, marcar(datos, clave))
+    return documento
+
+
+# --- REINTENTOS ---
+
+def iniciar():
+    """Arranca el hilo que reintenta lo diferido y recupera diarios huérfanos. Es idempotente."""
+    global _hilo
+    if not activo():
+        return
+    with _lock:
+        if _hilo:
+            return
+        _hilo = threading.Thread(target=_bucle, name="diario", daemon=True)
+        _hilo.start()
+
+
+def _bucle():
+    while True:
+        try:
+            recuperar()
+            reintentar()
+        except Exception as e:
+            print(f"⚠️ Error en el diario de escrituras: {e}")
+        time.sleep(DIARIO_REINTENTO_SEGUNDOS)
+
+
+def reintentar():
+    """
+    Reescribe en orden las anotaciones diferidas. Se detiene en la primera
+    que falle (el backend sigue caído). Retorna True si no quedó nada diferido.
+    Antes renueva el lease que retiene cada usuario; si lo tomó otro proceso,
+    lo de ese usuario espera al próximo ciclo.
+    """
+    import src.database as db
+
+    while True:
+        with _lock:
+            diferidas = [(clave, entrada[0], entrada[1]) for clave, entrada in _entradas.items() if not entrada[3]]
+        if not diferidas:
+            return True
+        esperan, renovados, escritas = set(), set(), 0
+        for clave, numero, datos in diferidas:
+            if numero in esperan:
+                continue
+            retenido = _retenidos.get(numero)
+            if retenido is not None and numero not in renovados:
+                if not retenido[0]():
+                    esperan.add(numero)
+                    continue
+                renovados.add(numero)
+            if not db.reaplicar_cambios_usuario(numero, datos, clave):
+                return False
+            confirmar(clave)
+            escritas += 1
+            metrics.incrementar("diario_entradas_total", etiquetas={"resultado": "reaplicada"})
+        if escritas:
+            print(f"💾 Diario: {escritas} cambio(s) diferido(s) escritos en el backend")
+        if esperan:
+            return False
+
+
+def _dueno(ruta):
+    """Pid del proceso dueño del segmento (el que lo reclamó, si tiene sufijo)."""
+    nombre = os.path.basename(ruta)
+    try:
+        if not nombre.endswith(".jsonl"):
+            return int(nombre.rsplit(".", 1)[1])
+        return int(nombre.split("-")[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def recuperar():
+    """Reanota lo no confirmado de los diarios de procesos que ya terminaron."""
+    if not activo():
+        return
+    with _lock:
+        candidatos = [ruta for ruta in sorted(glob.glob(os.path.join(DIARIO_DIR, "diario-*.jsonl*")))
+                      if ruta not in _segmentos and _dueno(ruta) is not None]
+    ajenos = []
+    for ruta in candidatos:
+        dueno = _dueno(ruta)
+        if dueno != os.getpid() and metrics.proceso_vivo(dueno):
+            continue
+        # Renombrarlo lo reclama: otro proceso que lo vea ya no lo toma
+        reclamado = f"{ruta.split('.jsonl', 1)[0]}.jsonl.{os.getpid()}"
+        try:
+            if reclamado != ruta:
+                os.replace(ruta, reclamado)
+            ajenos.append(reclamado)
+        except OSError:
+            continue
+    if not ajenos:
+        return
+
+    anotadas, confirmadas = OrderedDict(), set()
+    for ruta in ajenos:
+        with open(ruta, encoding="utf-8") as archivo:
+            for linea in archivo:
+                try:
+                    registro = json.loads(linea)
+                except ValueError:
+                    continue  # línea cortada por la caída del proceso
+                if "a" in registro:
+                    confirmadas.add(tuple(registro["a"]))
+                else:
+                    anotadas[(registro["o"], registro["s"])] = (registro["n"], _decodificar(registro["c"]))
+
+    with _lock:
+        pendientes = [(clave, numero, datos) for clave, (numero, datos) in anotadas.items()
+                      if clave not in confirmadas and clave not in _entradas]
+        if pendientes:
+            destino = _escribir([_linea(clave, numero, datos) for clave, numero, datos in pendientes],
+                                sincronizar=True)
+            for clave, numero, datos in pendientes:
+                _entradas[clave] = [numero, datos, destino, False]
+                _por_usuario[numero] += 1
+            _segmentos[destino][1] += len(pendientes)
+    for ruta in ajenos:
+        os.remove(ruta)
+    if pendientes:
+        metrics.incrementar("diario_entradas_total", len(pendientes), {"resultado": "recuperada"})
+        print(f"💾 Diario: {len(pendientes)} cambio(s) recuperados de procesos anteriores")
+
+
+def cerrar():
+    """Cierra el segmento activo; si no queda nada pendiente, borra el diario del proceso."""
+    global _activo
+    with _lock:
+        if _activo is not None:
+            _activo.close()
+            _activo = None
+        if not _entradas:
+            for ruta in list(_segmentos):
+                _segmentos[ruta][1] = 0
+                _borrar_si_vacio(ruta)
+        else:
+            print(f"💾 Diario: {len(_entradas)} cambio(s) sin confirmar quedan en disco para el próximo proceso")
+
+
+metrics.registrar_gauge("diario_pendientes", lambda: len(_entradas))
+metrics.registrar_gauge("diario_bytes", _bytes_con_lock)
@@ -0,0 +1,187 @@
+# estadisticas_clase.py
+# Agregados por clase (artifacts/.../public/data/class_stats/{class_token})
+# para que el Dashboard Web cargue una clase con una sola lectura, sin
+# recorrer users_sync ni challenge_logs.
+#
+# Cada alumno aporta a su clase una suma de valores (ver aportes()). Cuando se
+# escribe un usuario, database.py compara su aporte antes y después del
+# cambio y entrega aquí solo la diferencia, como Incremento; si cambió de
+# clase, se resta de la vieja y se suma a la nueva. Los logs de retos suman
+# resultados y la última actividad del alumno.
+#
+# El documento de una clase lo escriben todos sus alumnos, así que los
+# cambios se combinan por clase durante ESTADISTICAS_CLASE_VENTANA_SEGUNDOS y
+# se escriben juntos (Firestore admite ~1 escritura por segundo por
+# documento). Con ventana 0 se escriben en el momento.
+#
+# Los incrementos se calculan sobre la base que vio el turno: si algo se
+# desvía (escrituras concurrentes, usuarios anteriores a los agregados),
+# src/scripts/reconstruir_clases.py los recalcula desde los usuarios.
+
+import threading
+import time
+
+from src import metrics
+from src.config.config import ESTADISTICAS_CLASE_VENTANA_SEGUNDOS
+from src.storage.base import Incremento, combinar
+
+# Campos del usuario que cambian su aporte a la clase
+CAMPOS_CLASE = {"class_token", "puntos", "progreso_temas", "retos_completados", "total_fallos",
+                "total_pistas_usadas"}
+# Límite inferior de cada rango de la distribución de puntos
+RANGOS_PUNTOS = (0, 50, 200, 500, 1000)
+
+_lock = threading.Lock()
+# class_token -> {campo o ruta: valor} aún no escritos
+_pendientes = {}
+# class_token -> instante (monotonic) en que vence su ventana
+_vencen = {}
+_despertar = threading.Event()
+_hilo = None
+
+
+def rango_puntos(puntos):
+    """Etiqueta del rango de la distribución: "0-49", ..., "1000+"."""
+    inferior = max(r for r in RANGOS_PUNTOS if r <= max(puntos, 0))
+    i = RANGOS_PUNTOS.index(inferior)
+    return f"{inferior}+" if i == len(RANGOS_PUNTOS) - 1 else f"{inferior}-{RANGOS_PUNTOS[i + 1] - 1}"
+
+
+def _numero(valor):
+    return valor if isinstance(valor, (int, float)) and not isinstance(valor, bool) else 0
+
+
+def aportes(usuario):
+    """Lo que el usuario suma a los agregados de su clase, por ruta."""
+    puntos = _numero(usuario.get("puntos"))
+    suma = {
+        ("alumnos",): 1,
+        ("puntos_total",): puntos,
+        ("distribucion_puntos", rango_puntos(puntos)): 1,
+        ("retos_completados",): _numero(usuario.get("retos_completados")),
+        ("total_fallos",): _numero(usuario.get("total_fallos")),
+        ("total_pistas_usadas",): _numero(usuario.get("total_pistas_usadas")),
+    }
+    for tema, progreso in (usuario.get("progreso_temas") or {}).items():
+        if isinstance(progreso, dict):
+            suma[("temas", tema, "alumnos")] = 1
+            suma[("temas", tema, "suma_nivel")] = _numero(progreso.get("nivel"))
+            suma[("temas", tema, "suma_puntos")] = _numero(progreso.get("puntos"))
+    return suma
+
+
+def diferencias(antes, despues):
+    """
+    {class_token: cambios} que llevan los agregados del estado `antes` al
+    `despues` de un mismo usuario. Solo rutas cuyo aporte cambió.
+    """
+    clase_antes = (antes or {}).get("class_token")
+    clase_despues = (despues or {}).get("class_token")
+    aporte_antes = aportes(antes) if clase_antes else {}
+    aporte_despues = aportes(despues) if clase_despues else {}
+    cambios = {}
+    if clase_antes == clase_despues:
+        for ruta in aporte_antes.keys() | aporte_despues.keys():
+            delta = aporte_despues.get(ruta, 0) - aporte_antes.get(ruta, 0)
+            if delta:
+                cambios.setdefault(clase_despues, {})[ruta] = Incremento(delta)
+        return cambios
+
+    numero = str((despues or antes).get("numero_telefono", ""))
+    if clase_antes:
+        cambios[clase_antes] = {ruta: Incremento(-valor) for ruta, valor in aporte_antes.items() if valor}
+        # None: el alumno ya no está en la clase
+        cambios[clase_antes][("ultima_actividad", numero)] = None
+    if clase_despues:
+        cambios[clase_despues] = {ruta: Incremento(valor) for ruta, valor in aporte_despues.items() if valor}
+    return cambios
+
+
+def cambios_de_reto(numero_telefono, log):
+    """Lo que un log de reto suma a la clase del alumno."""
+    cambios = {
+        ("resultados", log.get("resultado") or "SIN_RESULTADO"): Incremento(1),
+        ("ultima_actividad", str(numero_telefono)): log.get("timestamp"),
+    }
+    if log.get("es_sospechoso"):
+        cambios[("retos_sospechosos",)] = Incremento(1)
+    return cambios
+
+
+def programar(cambios_por_clase):
+    """Acumula cambios por clase; se escriben cuando vence la ventana de cada una."""
+    cambios_por_clase = {token: cambios for token, cambios in cambios_por_clase.items() if token and cambios}
+    if not cambios_por_clase:
+        return
+    if ESTADISTICAS_CLASE_VENTANA_SEGUNDOS <= 0:
+        _escribir(cambios_por_clase)
+        return
+    with _lock:
+        for token, cambios in cambios_por_clase.items():
+            if token in _pendientes:
+                combinar(_pendientes[token], cambios)
+                metrics.incrementar("estadisticas_clase_coalescidas_total")
+            else:
+                _pendientes[token] = dict(cambios)
+                _vencen[token] = time.monotonic() + ESTADISTICAS_CLASE_VENTANA_SEGUNDOS
+    _iniciar()
+    _despertar.set()
+
+
+def _iniciar():
+    global _hilo
+    with _lock:
+        if _hilo:
+            return
+        _hilo = threading.Thread(target=_bucle, name="estadisticas-clase", daemon=True)
+        _hilo.start()
+
+
+def _bucle():
+    while True:
+        with _lock:
+            proximo = next(iter(_vencen.values()), None)
+        if proximo is None:
+            _despertar.wait()
+            _despertar.clear()
+            continue
+        time.sleep(max(0, proximo - time.monotonic()))
+        try:
+            vaciar(solo_vencidos=True)
+        except Exception as e:
+            print(f"⚠️ Error escribiendo estadísticas de clase: {e}")
+
+
+def vaciar(solo_vencidos=False):
+    """
+    Escribe los cambios acumulados (todos, o solo los de ventanas vencidas).
+    Si la escritura falla se vuelven a encolar, combinados con los nuevos.
+    """
+    ahora = time.monotonic()
+    with _lock:
+        tokens = [t for t, vence in _vencen.items() if not solo_vencidos or vence <= ahora]
+        lote = {t: _pendientes.pop(t) for t in tokens}
+        for token in tokens:
+            del _vencen[token]
+    if not lote or _escribir(lote):
+        return
+    with _lock:
+        for token, cambios in lote.items():
+            _pendientes[token] = combinar(cambios, _pendientes.get(token, {}))
+            _vencen.setdefault(token, time.monotonic() + ESTADISTICAS_CLASE_VENTANA_SEGUNDOS)
+    _despertar.set()
+
+
+def _escribir(cambios_por_clase):
+    from src.storage import obtener_almacen
+
+    try:
+        obtener_almacen().escribir_clases(cambios_por_clase)
+        metrics.incrementar("estadisticas_clase_escrituras_total", len(cambios_por_clase))
+        return True
+    except Exception as e:
+        print(f"⚠️ Error escribiendo estadísticas de clase: {e}")
+        return False
+
+
+metrics.registrar_gauge("estadisticas_clase_pendientes", lambda: len(_pendientes))
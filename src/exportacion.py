@@ -0,0 +1,232 @@
+# exportacion.py
+# Exportación de challenge_logs para investigación y docentes, en JSONL o
+# Parquet, filtrando por clase, tema y rango de fechas.
+#
+# Los logs se leen por páginas ordenadas por (timestamp, doc_id) con cursores
+# (start_after en Firestore): en memoria nunca hay más de una página, sin
+# importar cuántos logs tenga el semestre.
+#
+# Exportar a un destino deja junto a él un estado con el cursor del último
+# log escrito. Si la exportación se interrumpe, la siguiente corrida con los
+# mismos filtros sigue desde ahí; una vez terminada, volver a correrla agrega
+# solo los logs nuevos.
+#
+# El cursor es "<timestamp>|<doc_id>" del último log recibido; el endpoint
+# GET /export/challenge_logs lo acepta para continuar una descarga cortada.
+#
+# El timestamp de un log se pone al crearlo, pero bulk_writer lo escribe
+# hasta BULK_WRITER_FLUSH_SEGUNDOS después: cada corrida se corta en logs
+# más viejos que ese plazo (más un margen), para que el cursor no pase por
+# delante de uno que todavía no llegó al backend.
+
+import json
+import os
+from datetime import datetime, timedelta
+
+from src.config.config import BULK_WRITER_FLUSH_SEGUNDOS
+from src.storage import obtener_almacen
+
+COLECCION = "challenge_logs"
+FORMATOS = ("jsonl", "parquet")
+# Columnas del Parquet y su tipo; los campos que no estén aquí solo van al JSONL
+COLUMNAS = {
+    "id": "texto",
+    "estudiante_id": "texto",
+    "nombre_estudiante": "texto",
+    "class_token": "texto",
+    "tema": "texto",
+    "dificultad": "texto",
+    "resultado": "texto",
+    "enunciado": "texto",
+    "respuesta": "texto",
+    "feedback_ia": "texto",
+    "tiempo_tomado": "numero",
+    "tiempo_estimado": "numero",
+    "es_sospechoso": "bool",
+    "timestamp": "texto",
+}
+# Filtro -> campo del log que debe ser igual
+_FILTROS_IGUALES = {"clase": "class_token", "tema": "tema"}
+# Margen sobre BULK_WRITER_FLUSH_SEGUNDOS para los logs en camino al backend
+_MARGEN_SEGUNDOS = 60
+
+
+def filtros(clase=None, tema=None, desde=None, hasta=None):
+    """Filtros de una exportación; `desde`/`hasta` son fechas ISO (hasta excluida)."""
+    valores = {"clase": clase, "tema": tema, "desde": desde, "hasta": hasta}
+    return {clave: valor for clave, valor in valores.items() if valor}
+
+
+def cursor_de(registro):
+    """Cursor que continúa después de este registro."""
+    return f"{registro['timestamp']}|{registro['id']}"
+
+
+def leer_cursor(cursor):
+    """(timestamp, doc_id) de un cursor; ValueError si no tiene ese formato."""
+    timestamp, _, doc_id = str(cursor).rpartition("|")
+    if not timestamp or not doc_id:
+        raise ValueError(f"Cursor inválido: {cursor!r}")
+    return timestamp, doc_id
+
+
+def corte():
+    """Timestamp ISO antes del cual los logs ya están escritos (ver arriba)."""
+    return (datetime.now() - timedelta(seconds=BULK_WRITER_FLUSH_SEGUNDOS + _MARGEN_SEGUNDOS)).isoformat()
+
+
+def paginas(filtros_exportacion, cursor=None, lote=500):
+    """
+    Genera páginas de logs ({"id": doc_id, **datos}) a partir del cursor,
+    hasta el corte de esta corrida (o antes, si el filtro `hasta` es menor).
+    """
+    almacen = obtener_almacen()
+    iguales = {campo: filtros_exportacion[clave] for clave, campo in _FILTROS_IGUALES.items()
+               if filtros_exportacion.get(clave)}
+    hasta = min(filter(None, (filtros_exportacion.get("hasta"), corte())))
+    despues_de = leer_cursor(cursor) if cursor else None
+    while True:
+        pagina = almacen.listar_registros(COLECCION, iguales, filtros_exportacion.get("desde"),
+                                          hasta, despues_de, lote)
+        if not pagina:
+            return
+        yield [{"id": doc_id, **datos} for doc_id, datos in pagina]
+        if len(pagina) < lote:
+            return
+        despues_de = (pagina[-1][1]["timestamp"], pagina[-1][0])
+
+
+def lineas_jsonl(filtros_exportacion, cursor=None, lote=500):
+    """Genera los logs como líneas JSONL (para respuestas en streaming)."""
+    for pagina in paginas(filtros_exportacion, cursor, lote):
+        yield "".join(_a_jsonl(registro) for registro in pagina)
+
+
+def _a_jsonl(registro):
+    return json.dumps(registro, ensure_ascii=False, default=str) + "\n"
+
+
+# --- EXPORTACIÓN A ARCHIVO (reanudable) ---
+
+def ruta_estado(destino, formato):
+    """Archivo con el cursor de la exportación: junto al JSONL o dentro del directorio Parquet."""
+    return os.path.join(destino, "_estado.json") if formato == "parquet" else f"{destino}.estado.json"
+
+
+def _leer_estado(destino, formato, filtros_exportacion):
+    ruta = ruta_estado(destino, formato)
+    if not os.path.exists(ruta):
+        return None
+    with open(ruta, encoding="utf-8") as archivo:
+        estado = json.load(archivo)
+    if estado.get("formato") != formato or estado.get("filtros") != filtros_exportacion:
+        raise ValueError(f"{ruta} es de otra exportación ({estado.get('formato')}, filtros "
+                         f"{estado.get('filtros')}); usar otro destino o empezar desde cero")
+    return estado
+
+
+def _guardar_estado(destino, estado):
+    ruta = ruta_estado(destino, estado["formato"])
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "w", encoding="utf-8") as archivo:
+        json.dump(estado, archivo, ensure_ascii=False)
+    os.replace(temporal, ruta)
+
+
+def exportar(destino, formato="jsonl", filtros_exportacion=None, reanudar=True, lote=500,
+             filas_por_parte=100000):
+    """
+    Exporta los logs a `destino` (un archivo JSONL o un directorio de partes
+    Parquet). Con `reanudar` continúa desde el cursor guardado; si no, empieza
+    de cero. Retorna el estado final (cursor y total de registros).
+    """
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato desconocido: {formato} (opciones: {', '.join(FORMATOS)})")
+    filtros_exportacion = filtros_exportacion or {}
+    estado = _leer_estado(destino, formato, filtros_exportacion) if reanudar else None
+    if estado:
+        print(f"↪️ Reanudando desde {estado['cursor']} ({estado['registros']} logs ya exportados)")
+    else:
+        estado = {"formato": formato, "filtros": filtros_exportacion, "cursor": None, "registros": 0}
+
+    if formato == "parquet":
+        _exportar_parquet(destino, estado, lote, filas_por_parte)
+    else:
+        _exportar_jsonl(destino, estado, lote)
+    return estado
+
+
+def _exportar_jsonl(destino, estado, lote):
+    escritos = estado.setdefault("bytes", 0)
+    if escritos and (not os.path.exists(destino) or os.path.getsize(destino) < escritos):
+        raise ValueError(f"{destino} es más corto que lo que indica su estado; empezar desde cero")
+
+    with open(destino, "r+b" if escritos else "wb") as archivo:
+        # Descarta lo escrito después del último cursor guardado
+        archivo.truncate(escritos)
+        archivo.seek(escritos)
+        for pagina in paginas(estado["filtros"], estado["cursor"], lote):
+            archivo.write("".join(_a_jsonl(registro) for registro in pagina).encode("utf-8"))
+            archivo.flush()
+            os.fsync(archivo.fileno())
+            estado.update(cursor=cursor_de(pagina[-1]), registros=estado["registros"] + len(pagina),
+                          bytes=archivo.tell())
+            _guardar_estado(destino, estado)
+            print(f"📦 {estado['registros']} logs exportados")
+
+
+def _valor_columna(valor, tipo):
+    if valor is None:
+        return None
+    if tipo == "bool":
+        return bool(valor)
+    if tipo == "numero":
+        try:
+            return float(valor)
+        except (TypeError, ValueError):
+            return None
+    return valor if isinstance(valor, str) else json.dumps(valor, ensure_ascii=False, default=str)
+
+
+def _exportar_parquet(destino, estado, lote, filas_por_parte):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Exportar a Parquet necesita pyarrow: pip install pyarrow")
+
+    tipos = {"texto": pa.string(), "numero": pa.float64(), "bool": pa.bool_()}
+    esquema = pa.schema([(columna, tipos[tipo]) for columna, tipo in COLUMNAS.items()])
+    os.makedirs(destino, exist_ok=True)
+    estado.setdefault("partes", 0)
+    escritor, temporal, filas, cursor = None, None, 0, None
+
+    def _cerrar_parte():
+        # Una parte solo cuenta (y mueve el cursor) cuando quedó completa
+        escritor.close()
+        os.replace(temporal, os.path.join(destino, f"parte-{estado['partes']:05d}.parquet"))
+        estado.update(cursor=cursor, registros=estado["registros"] + filas, partes=estado["partes"] + 1)
+        _guardar_estado(destino, estado)
+        print(f"📦 {estado['registros']} logs exportados ({estado['partes']} partes)")
+
+    try:
+        for pagina in paginas(estado["filtros"], estado["cursor"], lote):
+            if escritor is None:
+                temporal = os.path.join(destino, f"parte-{estado['partes']:05d}.parquet.tmp")
+                escritor = pq.ParquetWriter(temporal, esquema)
+            # Un row group por página: la memoria queda acotada a una página
+            columnas = {columna: [_valor_columna(registro.get(columna), tipo) for registro in pagina]
+                        for columna, tipo in COLUMNAS.items()}
+            escritor.write_table(pa.Table.from_pydict(columnas, schema=esquema))
+            filas += len(pagina)
+            cursor = cursor_de(pagina[-1])
+            if filas >= filas_por_parte:
+                _cerrar_parte()
+                escritor, filas = None, 0
+        if escritor is not None:
+            _cerrar_parte()
+            escritor = None
+    finally:
+        if escritor is not None:
+            escritor.close()
+            os.remove(temporal)
@@ -1,16 +1,21 @@
 # main.py
 
+import hmac
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from fastapi import FastAPI, Request, Response
-from datetime import date, datetime
+from fastapi.responses import StreamingResponse
+from datetime import datetime
 
+import src.ai_services as ai
 import src.database as db
-import src.message_handler as handler
-from src.whatsapp_utils import enviar_botones_basicos
-# --- ✅ IMPORTACIÓN AGREGADA ---
-from src.message_components import iniciar_onboarding
+import src.turn_workers as turn_workers
+import src.whatsapp_utils as wa
+from src import (bulk_writer, dashboard_sync, dedup, delivery_metrics, diario, estadisticas_clase, exportacion,
+                 metrics, retencion, tracing)
+from src.config.config import EXPORTACION_TOKEN, WEBHOOK_GRABAR_EN, WARMUP_TIMEOUT_SEGUNDOS
 
 app = FastAPI(
     title="LogicBot API",
@@ -35,66 +40,160 @@ async def startup_event():
     print(f"🌍 Entorno: {'Producción (Render)' if os.getenv('RENDER') else 'Desarrollo Local'}")
     print(f"🔌 Puerto: {os.getenv('PORT', '8000')}")
 
-    # Inicializar base de datos
-    db.inicializar_db()
+    # Clientes de Firestore, Gemini y Graph API listos antes del primer webhook
+    _calentar_clientes()
+
+    # Workers que procesan los turnos fuera del webhook
+    turn_workers.iniciar_workers()
+    # Reintenta cambios que quedaron en el diario (de este arranque o de procesos anteriores)
+    diario.iniciar()
+    delivery_metrics.iniciar_flush_periodico()
+    metrics.iniciar_volcado_periodico()
+    # Resume y borra logs y alertas más viejos que la retención configurada
+    retencion.iniciar()
 
     print("✅ Servidor listo para recibir peticiones")
     print("=" * 60)
 
 
+def _calentar_clientes():
+    """
+    Crea los clientes y abre sus conexiones en paralelo. Si algún servicio
+    tarda más que WARMUP_TIMEOUT_SEGUNDOS el servidor arranca igual y ese
+    cliente termina de inicializarse en el primer uso.
+    """
+    if WARMUP_TIMEOUT_SEGUNDOS <= 0:
+        return
+    inicio = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="warmup")
+    tareas = [executor.submit(f) for f in (db.inicializar_db, ai.calentar, wa.calentar)]
+    _, pendientes = wait(tareas, timeout=WARMUP_TIMEOUT_SEGUNDOS)
+    executor.shutdown(wait=False)
+    duracion = time.perf_counter() - inicio
+    metrics.fijar_gauge("warmup_duracion_segundos", round(duracion, 3), agregacion="max")
+    if pendientes:
+        print(f"⚠️ Warmup incompleto tras {WARMUP_TIMEOUT_SEGUNDOS}s; se continúa en segundo plano")
+    else:
+        print(f"🔥 Warmup completado en {duracion * 1000:.0f} ms")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Drena la cola de turnos pendientes antes de que el proceso termine."""
+    await turn_workers.esperar_repartos()
+    turn_workers.detener_workers()
+    # Cambios del dashboard que aún esperaban su ventana
+    dashboard_sync.vaciar()
+    estadisticas_clase.vaciar()
+    # Logs y alertas aún en memoria (si Firestore falla quedan derramados a disco)
+    bulk_writer.vaciar()
+    # Cambios diferidos: un último intento; lo que falle queda en disco para el próximo proceso
+    diario.reintentar()
+    diario.cerrar()
+    # Último volcado para que /metrics conserve los contadores de este proceso
+    metrics.volcar_a_disco()
+    tracing.vaciar()
+
+
+def _agrupar_mensajes_por_remitente(body):
+    """
+    Recorre TODAS las entries, changes y messages de una entrega de Meta
+    (que puede traer varios mensajes coalescidos) y los agrupa por remitente
+    conservando el orden de llegada.
+    Retorna {numero: [(message_data, nombre_usuario), ...]}.
+    """
+    grupos = {}
+    for entry in body.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            mensajes = value.get('messages') or []
+            if not mensajes:
+                continue
+
+            nombres = {}
+            for contacto in value.get('contacts') or []:
+                nombre = contacto.get('profile', {}).get('name')
+                if contacto.get('wa_id') and nombre:
+                    nombres[str(contacto['wa_id'])] = nombre
+            # Compatibilidad: si solo viene un contacto sin wa_id, aplica a todos
+            contactos = value.get('contacts') or [{}]
+            nombre_por_defecto = contactos[0].get('profile', {}).get('name', "Estudiante")
+
+            for message_data in mensajes:
+                if 'from' not in message_data:
+                    continue
+                numero = str(message_data['from'])
+                nombre_usuario = nombres.get(numero, nombre_por_defecto)
+                grupos.setdefault(numero, []).append((message_data, nombre_usuario))
+    return grupos
+
+
+def _grabar_entrega(body):
+    """Guarda la entrega cruda para reproducirla en el benchmark (opcional)."""
+    try:
+        with open(WEBHOOK_GRABAR_EN, "a", encoding="utf-8") as archivo:
+            archivo.write(json.dumps(body, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"⚠️ No se pudo grabar la entrega: {e}")
+
+
+def _extraer_estados(body):
+    """Recolecta los callbacks de estado (sent/delivered/read/failed) de la entrega."""
+    estados = []
+    for entry in body.get('entry') or []:
+        for change in entry.get('changes') or []:
+            estados.extend((change.get('value') or {}).get('statuses') or [])
+    return estados
+
+
+def _filtrar_duplicados(grupos):
+    """Descarta los mensajes cuyo messages[].id ya fue visto por este proceso."""
+    filtrados = {}
+    for numero, mensajes in grupos.items():
+        nuevos = [(m, nombre) for m, nombre in mensajes
+                  if not m.get('id') or dedup.registrar_en_memoria(m['id'])]
+        if nuevos:
+            filtrados[numero] = nuevos
+        if len(nuevos) < len(mensajes):
+            print(f"♻️ {len(mensajes) - len(nuevos)} mensaje(s) re-entregado(s) de {numero} ignorado(s)")
+    return filtrados
+
+
 @app.post("/webhook")
 async def recibir_mensaje(request: Request):
-    body = await request.json()
+    """
+    Ack inmediato: valida la entrega, encola sus mensajes y responde 200.
+    El procesamiento (Firestore, Gemini, envíos) ocurre en turn_workers.
+    """
+    inicio = time.perf_counter()
+    respuesta = await _atender_entrega(request)
+    metrics.observar("webhook_duracion_segundos", time.perf_counter() - inicio,
+                     {"codigo": respuesta.status_code}, metrics.BUCKETS_RAPIDOS)
+    return respuesta
+
+
+async def _atender_entrega(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return Response(status_code=400)
+
+    if WEBHOOK_GRABAR_EN:
+        _grabar_entrega(body)
+
     try:
-        entry = body.get('entry', [{}])[0]
-        changes = entry.get('changes', [{}])[0]
-        value = changes.get('value', {})
-
-        if not value: return Response(status_code=200)
-
-        if 'statuses' in value: return Response(status_code=200)
-        if 'messages' not in value: return Response(status_code=200)
-
-        if value['messages']:
-            message_data = value['messages'][0]
-            numero_remitente = str(message_data['from'])
-
-            profile = value.get('contacts', [{}])[0].get('profile', {})
-            nombre_usuario = profile.get('name', "Estudiante")
-
-            print(f"📩 Mensaje recibido de: {nombre_usuario} ({numero_remitente})")
-
-            usuario = db.obtener_usuario(numero_remitente)
-
-            # RF-01: Registro de nuevo usuario
-            if not usuario:
-                print(f"👤 Usuario nuevo detectado: {numero_remitente}. Registrando...")
-                db.crear_usuario(numero_remitente, nombre_usuario)
-                # --- ✅ LLAMADA AHORA CORRECTA ---
-                iniciar_onboarding(numero_remitente, nombre_usuario)
-                return Response(status_code=200)
-
-            # Actualización de racha
-            if usuario.get("ultima_conexion") != str(date.today()):
-                try:
-                    ayer = date.fromisoformat(usuario.get("ultima_conexion", "1970-01-01"))
-                    dias_diferencia = (date.today() - ayer).days
-                    racha_actual = usuario.get("racha_dias", 0)
-                    nueva_racha = racha_actual + 1 if dias_diferencia == 1 else 1
-                    db.actualizar_usuario(numero_remitente,
-                                          {"ultima_conexion": str(date.today()), "racha_dias": nueva_racha})
-                except ValueError:
-                    db.actualizar_usuario(numero_remitente, {"ultima_conexion": str(date.today())})
-
-            # Delegación de mensajes
-            if message_data.get('type') == 'interactive':
-                interactive_type = message_data['interactive']['type']
-                id_seleccion = message_data['interactive'][interactive_type]['id']
-                handler.handle_interactive_message(id_seleccion, numero_remitente, usuario)
-
-            elif message_data.get('type') == 'text':
-                mensaje_texto = message_data['text']['body']
-                handler.handle_text_message(mensaje_texto, numero_remitente, usuario)
+        estados = _extraer_estados(body)
+        if estados:
+            delivery_metrics.registrar_estados(estados)
+
+        grupos = _filtrar_duplicados(_agrupar_mensajes_por_remitente(body))
+        if not grupos:
+            return Response(status_code=200)
+
+        # Cola llena: 503 para que Meta reintente en lugar de perder mensajes
+        if not turn_workers.encolar_entrega(grupos):
+            dedup.olvidar([m.get('id') for mensajes in grupos.values() for m, _ in mensajes])
+            return Response(status_code=503)
 
     except Exception as e:
         print(f"❌ Error en webhook: {e}")
@@ -109,7 +208,39 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {"status": "healthy", "timestamp": datetime.now().isoformat(), "metricas": metrics.snapshot()}
+
+
+@app.get("/metrics")
+def exportar_metricas():
+    """
+    Métricas de todos los workers de gunicorn en formato de texto de Prometheus.
+    Síncrono a propósito: lee los volcados de los demás procesos del disco, y
+    FastAPI lo corre en su threadpool en vez de bloquear el event loop.
+    """
+    return Response(content=metrics.exportar_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/export/challenge_logs")
+def exportar_logs(request: Request, clase: str = None, tema: str = None, desde: str = None,
+                  hasta: str = None, cursor: str = None):
+    """
+    Logs de retos en JSONL, página por página. Para continuar una descarga
+    cortada, pasar como cursor "<timestamp>|<id>" del último log recibido.
+    """
+    if not EXPORTACION_TOKEN:
+        return Response(status_code=404)
+    autorizacion = request.headers.get("authorization", "")
+    if not hmac.compare_digest(autorizacion.encode(), f"Bearer {EXPORTACION_TOKEN}".encode()):
+        return Response(status_code=401)
+    try:
+        if cursor:
+            exportacion.leer_cursor(cursor)
+    except ValueError as e:
+        return Response(content=str(e), status_code=400)
+    # Generador síncrono: Starlette lo recorre en su threadpool, sin bloquear el loop
+    return StreamingResponse(exportacion.lineas_jsonl(exportacion.filtros(clase, tema, desde, hasta), cursor),
+                             media_type="application/x-ndjson")
 
 
 @app.get("/webhook")
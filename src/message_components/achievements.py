@@ -1,7 +1,6 @@
 # message_components/achievements.py
 # Sistema de logros y reconocimientos
 
-import json
 import src.database as db
 from src.whatsapp_utils import responder_mensaje
 from src.utils.formatters import formatear_logro_desbloqueado
@@ -12,14 +11,15 @@ def verificar_y_otorgar_logros(numero_remitente, usuario):
     Verifica si el usuario ha desbloqueado nuevos logros.
     Retorna lista de logros nuevos desbloqueados.
     """
-    logros_actuales = json.loads(usuario.get("logros_desbloqueados", "[]"))
+    logros_actuales = usuario.logros_desbloqueados
     nuevos_logros = []
+    nuevos_ids = []
 
     # Obtener stats del usuario
-    retos_completados = usuario.get("retos_completados", 0)
-    racha_dias = usuario.get("racha_dias", 0)
-    retos_sin_pistas = usuario.get("retos_sin_pistas", 0)
-    progreso_temas = json.loads(usuario.get("progreso_temas", "{}"))
+    retos_completados = usuario.retos_completados
+    racha_dias = usuario.racha_dias
+    retos_sin_pistas = usuario.retos_sin_pistas
+    progreso_temas = usuario.progreso_temas
 
     # Verificar cada logro
     for logro_id, logro_data in LOGROS_DISPONIBLES.items():
@@ -55,14 +55,12 @@ def verificar_y_otorgar_logros(numero_remitente, usuario):
 
         # Si cumple, otorgar logro
         if cumple_requisito:
-            logros_actuales.append(logro_id)
             nuevos_logros.append(logro_data)
+            nuevos_ids.append(logro_id)
 
     # Actualizar logros si hay nuevos
     if nuevos_logros:
-        db.actualizar_usuario(numero_remitente, {
-            "logros_desbloqueados": json.dumps(logros_actuales)
-        })
+        db.desbloquear_logros(numero_remitente, nuevos_ids)
 
         # Notificar cada logro
         for logro in nuevos_logros:
@@ -75,10 +73,7 @@ def verificar_y_otorgar_logros(numero_remitente, usuario):
 
             # Bonus de puntos
             if "puntos_bonus" in logro:
-                puntos_actuales = usuario.get("puntos", 0)
-                db.actualizar_usuario(numero_remitente, {
-                    "puntos": puntos_actuales + logro["puntos_bonus"]
-                })
+                db.sumar_puntos(numero_remitente, logro["puntos_bonus"])
 
     return nuevos_logros
 
@@ -87,7 +82,7 @@ def mostrar_logros_usuario(numero_remitente, usuario):
     """
     Muestra todos los logros del usuario (desbloqueados y bloqueados).
     """
-    logros_desbloqueados = json.loads(usuario.get("logros_desbloqueados", "[]"))
+    logros_desbloqueados = usuario.logros_desbloqueados
 
     mensaje = f"🏆 *TUS LOGROS*\n\n"
     mensaje += f"*DESBLOQUEADOS:* ✅\n\n"
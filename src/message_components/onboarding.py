@@ -2,7 +2,6 @@
 # Sistema de onboarding personalizado
 
 import time
-import json
 from src.config.config import LOGROS_DISPONIBLES
 from src.utils.formatters import formatear_logro_desbloqueado
 from src.utils.emojis import *
@@ -97,18 +96,12 @@ def finalizar_onboarding_y_empezar(numero_remitente, usuario):
     Marca el onboarding como completado y otorga el primer logro.
     """
     # Marcar como completado
-    db.actualizar_usuario(numero_remitente, {
-        "onboarding_completado": 1,
-        "estado_conversacion": "menu_principal"
-    })
+    usuario.actualizar(onboarding_completado=1, estado_conversacion="menu_principal")
 
     # Desbloquear logro "Primer Paso"
-    logros_actuales = json.loads(usuario.get("logros_desbloqueados", "[]"))
+    logros_actuales = usuario.logros_desbloqueados
     if "primer_paso" not in logros_actuales:
-        logros_actuales.append("primer_paso")
-        db.actualizar_usuario(numero_remitente, {
-            "logros_desbloqueados": json.dumps(logros_actuales)
-        })
+        db.desbloquear_logros(numero_remitente, ["primer_paso"])
 
         # Mensaje de logro
         logro = LOGROS_DISPONIBLES["primer_paso"]
@@ -120,15 +113,12 @@ def finalizar_onboarding_y_empezar(numero_remitente, usuario):
         responder_mensaje(numero_remitente, mensaje_logro, [])
 
         # Bonus de puntos
-        puntos_actuales = usuario.get("puntos", 0)
-        db.actualizar_usuario(numero_remitente, {
-            "puntos": puntos_actuales + logro["puntos_bonus"]
-        })
+        db.sumar_puntos(numero_remitente, logro["puntos_bonus"])
 
         time.sleep(1)
 
     # Mostrar menú principal
-    preferencia = usuario.get("preferencia_aprendizaje", "ambos")
+    preferencia = usuario.preferencia_aprendizaje or "ambos"
 
     if preferencia == "curso":
         mensaje = f"{COHETE} ¡Genial! Empecemos con tu primer tema de Java"
@@ -1,9 +1,8 @@
 # message_handler.py
 
-import json
 import random
 import time
-from datetime import datetime
+from datetime import date, datetime
 import src.database as db
 import src.ai_services as ai
 from src.config.config import (
@@ -21,14 +20,111 @@ from src.utils.formatters import (
 )
 from src.utils.emojis import *
 from src.message_components import (
-    handle_onboarding_paso_1, handle_onboarding_paso_2,
+    iniciar_onboarding, handle_onboarding_paso_1, handle_onboarding_paso_2,
     completar_onboarding, finalizar_onboarding_y_empezar,
     verificar_y_otorgar_logros, mostrar_logros_usuario
 )
+from src import metrics
+from src.turn_context import turno_actual
+
+
+# Indica que el documento del usuario no vino precargado en la entrega
+NO_PRECARGADO = object()
+
+# Carriles de ejecución de un turno (ver turn_workers.py)
+CARRIL_RAPIDO = "rapido"
+CARRIL_LLM = "llm"
+
+# Comandos y botones que se resuelven sin llamar a Gemini.
+# Deben reflejar las ramas de handle_text_message y handle_interactive_message:
+# si una de estas rutas empieza a usar la IA, hay que quitarla de aquí.
+_COMANDOS_RAPIDOS = {
+    "menu", "menú", "me rindo", "mi perfil", "perfil", "logros", "mis logros",
+    "fichas", "mochila", "recursos", "ayuda", "pista", "help"
+}
+_SELECCIONES_RAPIDAS = {
+    "onboarding_empezar", "nivel_principiante", "nivel_intermedio", "nivel_avanzado",
+    "pref_curso", "pref_retos", "pref_ambos", "finalizar_onboarding",
+    "mostrar_menu", "mostrar_temas_java", "pedir_reto_aleatorio",
+    "ver_mi_perfil", "ver_logros", "ver_coleccion"
+}
+
+
+def procesar_mensaje_entrante(message_data, nombre_usuario, usuario=NO_PRECARGADO):
+    """
+    Pipeline completo de un turno: registro, racha y delegación al handler.
+    Se ejecuta en los workers de segundo plano (ver turn_workers.py).
+    `usuario` puede venir de la lectura batch de la entrega (None = no existe).
+    Los handlers reciben la SesionUsuario del turno (ver sesion.py).
+    """
+    numero_remitente = str(message_data['from'])
+    print(f"📩 Mensaje recibido de: {nombre_usuario} ({numero_remitente})")
+
+    if usuario is NO_PRECARGADO:
+        usuario = db.obtener_usuario(numero_remitente)
+    else:
+        usuario = db.abrir_sesion(numero_remitente, usuario)
+
+    # Estado con el que empezó el turno, para las métricas por estado
+    turno = turno_actual()
+    if turno is not None:
+        turno["estado_conversacion"] = usuario.estado_conversacion if usuario else "nuevo"
+
+    # RF-01: Registro de nuevo usuario
+    if not usuario:
+        print(f"👤 Usuario nuevo detectado: {numero_remitente}. Registrando...")
+        db.crear_usuario(numero_remitente, nombre_usuario)
+        iniciar_onboarding(numero_remitente, nombre_usuario)
+        return
+
+    # Actualización de racha
+    if usuario.ultima_conexion != str(date.today()):
+        try:
+            ayer = date.fromisoformat(usuario.ultima_conexion or "1970-01-01")
+            dias_diferencia = (date.today() - ayer).days
+            usuario.racha_dias = usuario.racha_dias + 1 if dias_diferencia == 1 else 1
+        except ValueError:
+            pass
+        usuario.ultima_conexion = str(date.today())
+
+    # Delegación de mensajes
+    if message_data.get('type') == 'interactive':
+        interactive_type = message_data['interactive']['type']
+        id_seleccion = message_data['interactive'][interactive_type]['id']
+        handle_interactive_message(id_seleccion, numero_remitente, usuario)
+
+    elif message_data.get('type') == 'text':
+        mensaje_texto = message_data['text']['body']
+        handle_text_message(mensaje_texto, numero_remitente, usuario)
+
 
+def clasificar_turno(message_data, usuario=NO_PRECARGADO):
+    """
+    Decide en qué carril corre el turno sin leer Firestore.
+    Ante la duda (texto libre, estado desconocido) se asume que usa la IA.
+    """
+    # Usuario nuevo: solo registro y onboarding
+    if usuario is None:
+        return CARRIL_RAPIDO
 
+    if message_data.get('type') == 'interactive':
+        interactive = message_data.get('interactive') or {}
+        id_seleccion = (interactive.get(interactive.get('type')) or {}).get('id', "")
+        return CARRIL_RAPIDO if id_seleccion in _SELECCIONES_RAPIDAS else CARRIL_LLM
+
+    if message_data.get('type') == 'text':
+        mensaje_lower = message_data.get('text', {}).get('body', "").lower().strip()
+        if mensaje_lower in _COMANDOS_RAPIDOS or mensaje_lower.startswith("unirse"):
+            return CARRIL_RAPIDO
+        return CARRIL_LLM
+
+    # Tipos que el handler ignora (imágenes, audio...): no hay nada que esperar
+    return CARRIL_RAPIDO
+
+
+@metrics.instrumentar("handler")
 def handle_interactive_message(id_seleccion, numero_remitente, usuario):
-    historial_chat = json.loads(usuario.get("historial_chat", "[]"))
+    historial_chat = list(usuario.historial_chat)
 
     # === ONBOARDING ===
     if id_seleccion == 'onboarding_empezar':
@@ -55,8 +151,7 @@ def handle_interactive_message(id_seleccion, numero_remitente, usuario):
         iniciar_curso(numero_remitente, usuario, "java", leccion_especifica=numero_leccion)
 
     elif id_seleccion == "pedir_reto_aleatorio":
-        db.actualizar_usuario(numero_remitente,
-                              {"estado_conversacion": "eligiendo_dificultad", "tipo_reto_actual": "java"})
+        usuario.actualizar(estado_conversacion="eligiendo_dificultad", tipo_reto_actual="java")
         mensaje = f"{PREGUNTA} ¿Qué nivel de dificultad prefieres?\n\n"
         mensaje += f"1{NIVEL_UP} Fácil {FACIL}\n"
         mensaje += f"2{NIVEL_UP} Intermedio {INTERMEDIO}\n"
@@ -84,10 +179,11 @@ def handle_interactive_message(id_seleccion, numero_remitente, usuario):
             responder_mensaje(numero_remitente, "No encontré esa ficha.", historial_chat)
 
 
+@metrics.instrumentar("handler")
 def handle_text_message(mensaje_texto, numero_remitente, usuario):
-    historial_chat = json.loads(usuario.get("historial_chat", "[]"))
+    historial_chat = list(usuario.historial_chat)
     historial_chat.append({"usuario": mensaje_texto})
-    estado = usuario.get("estado_conversacion", "menu_principal")
+    estado = usuario.estado_conversacion
     mensaje_lower = mensaje_texto.lower().strip()
 
     # --- COMANDO DE VINCULACIÓN A CLASE ---
@@ -126,25 +222,17 @@ def handle_text_message(mensaje_texto, numero_remitente, usuario):
         mostrar_biblioteca_fichas(numero_remitente, usuario, historial_chat)
         return
     if mensaje_lower in ["ayuda", "pista", "help"]:
-        if usuario.get("reto_actual_enunciado"):
+        if usuario.reto_actual_enunciado:
             # 1. Recuperar las pistas específicas de este reto y el contador actual
-            pistas_guardadas = json.loads(usuario.get("reto_actual_pistas", "[]"))
-            pistas_usadas = usuario.get("pistas_usadas", 0)
+            pistas_guardadas = usuario.reto_actual_pistas
+            pistas_usadas = usuario.pistas_usadas
 
             # 2. Verificar si quedan pistas disponibles
             if pistas_usadas < len(pistas_guardadas):
                 pista_a_mostrar = pistas_guardadas[pistas_usadas]
 
-                # --- ACTUALIZACIÓN: CONTADOR GLOBAL Y ACTUAL ---
-                # Obtener el usuario actualizado para tener el valor más reciente
-                usuario_actual = db.obtener_usuario(numero_remitente)
-                total_pistas = usuario_actual.get("total_pistas_usadas", 0) + 1
-
-                db.actualizar_usuario(numero_remitente, {
-                    "pistas_usadas": pistas_usadas + 1,
-                    "total_pistas_usadas": total_pistas  # Contador histórico global
-                })
-                # --------------------------
+                # Contador del reto y contador histórico global, sumados en el servidor
+                db.registrar_pista(numero_remitente)
 
                 mensaje_ayuda = f"{IDEA} *Pista #{pistas_usadas + 1}:*\n\n{pista_a_mostrar}"
 
@@ -181,8 +269,9 @@ def handle_text_message(mensaje_texto, numero_remitente, usuario):
         responder_mensaje(numero_remitente, respuesta_chat, historial_chat)
 
 
+@metrics.instrumentar("handler")
 def mostrar_biblioteca_fichas(numero_remitente, usuario, historial_chat):
-    progreso_temas = json.loads(usuario.get("progreso_temas", "{}"))
+    progreso_temas = usuario.progreso_temas
     fichas_disponibles = []
 
     temas_curso = CURSOS["java"]["lecciones"]
@@ -202,6 +291,7 @@ def mostrar_biblioteca_fichas(numero_remitente, usuario, historial_chat):
         enviar_lista_recursos(numero_remitente, fichas_disponibles)
 
 
+@metrics.instrumentar("handler")
 def iniciar_curso(numero_remitente, usuario, curso_key, leccion_especifica=None):
     if curso_key not in CURSOS:
         responder_mensaje(numero_remitente, "Lo siento, ese curso no está disponible.", [])
@@ -214,15 +304,15 @@ def iniciar_curso(numero_remitente, usuario, curso_key, leccion_especifica=None)
         responder_mensaje(numero_remitente, "Lo siento, esa lección no es válida.", [])
         return
 
-    db.actualizar_usuario(numero_remitente, {
-        "estado_conversacion": "en_curso",
-        "curso_actual": curso_key,
-        "leccion_actual": leccion_actual,
-        "intentos_fallidos": 0
-    })
+    usuario.actualizar(
+        estado_conversacion="en_curso",
+        curso_actual=curso_key,
+        leccion_actual=leccion_actual,
+        intentos_fallidos=0
+    )
 
     tema_seleccionado = curso['lecciones'][leccion_actual]
-    historial_chat = json.loads(usuario.get("historial_chat", "[]"))
+    historial_chat = list(usuario.historial_chat)
 
     mensaje_inicio = f"{COHETE} ¡Excelente elección! Vamos a dominar el tema: *{tema_seleccionado}*."
     responder_mensaje(numero_remitente, mensaje_inicio, historial_chat)
@@ -241,6 +331,7 @@ def iniciar_curso(numero_remitente, usuario, curso_key, leccion_especifica=None)
     generar_y_enviar_reto(numero_remitente, usuario, curso_key, "Fácil", tema_seleccionado)
 
 
+@metrics.instrumentar("handler")
 def handle_seleccion_dificultad(mensaje_texto, numero_remitente, usuario, historial_chat):
     dificultad = None
     mensaje_lower = mensaje_texto.lower()
@@ -252,7 +343,7 @@ def handle_seleccion_dificultad(mensaje_texto, numero_remitente, usuario, histor
         dificultad = "Difícil"
 
     if dificultad:
-        tipo_reto = usuario["tipo_reto_actual"]
+        tipo_reto = usuario.tipo_reto_actual
         tematica_aleatoria = random.choice(CURSOS["java"]["lecciones"])
         responder_mensaje(numero_remitente,
                           f"¡Entendido! 👨‍💻 Buscando un reto de *{tipo_reto}* sobre *{tematica_aleatoria}* con dificultad *{dificultad}*...",
@@ -265,21 +356,22 @@ def handle_seleccion_dificultad(mensaje_texto, numero_remitente, usuario, histor
 
 # --- EN message_handler.py ---
 
+@metrics.instrumentar("handler")
 def handle_solucion_reto(mensaje_texto, numero_remitente, usuario, historial_chat, es_debug=False):
-    enunciado = usuario.get("reto_actual_enunciado")
+    enunciado = usuario.reto_actual_enunciado
 
     # 1. EVALUAR CON IA
-    tipo_reto = "depuración de código" if es_debug else (usuario.get("curso_actual") or usuario.get("tipo_reto_actual"))
+    tipo_reto = "depuración de código" if es_debug else (usuario.curso_actual or usuario.tipo_reto_actual)
     feedback = ai.evaluar_solucion_con_ia(enunciado, mensaje_texto, tipo_reto)
 
     # 2. CÁLCULO DE TIEMPO
     tiempo_tomado = 0
-    tiempo_estimado = usuario.get("tiempo_estimado_ia", 60)
+    tiempo_estimado = usuario.tiempo_estimado_ia
     es_sospechoso = False
 
-    if usuario.get("timestamp_inicio_reto"):
+    if usuario.timestamp_inicio_reto:
         try:
-            inicio = datetime.fromisoformat(usuario["timestamp_inicio_reto"])
+            inicio = datetime.fromisoformat(usuario.timestamp_inicio_reto)
             fin = datetime.now()
             tiempo_tomado = (fin - inicio).total_seconds()
             if tiempo_tomado < (tiempo_estimado / 2):
@@ -300,19 +392,19 @@ def handle_solucion_reto(mensaje_texto, numero_remitente, usuario, historial_cha
     if not es_pregunta_teorica and not es_mensaje_corto:
 
         # Recuperar tema actual para el filtro
-        tema_log = usuario.get("tematica_actual")
-        if not tema_log and usuario.get("curso_actual"):
+        tema_log = usuario.tematica_actual
+        if not tema_log and usuario.curso_actual:
             # Intentar sacar el tema del curso si no está explícito
             try:
-                idx = usuario.get("leccion_actual", 0)
-                tema_log = CURSOS[usuario["curso_actual"]]["lecciones"][idx]
+                idx = usuario.leccion_actual
+                tema_log = CURSOS[usuario.curso_actual]["lecciones"][idx]
             except:
                 tema_log = "Java General"
 
         datos_log = {
-            "nombre": usuario.get("nombre"),
+            "nombre": usuario.nombre,
             "tema": tema_log or "Reto Rápido",
-            "dificultad": usuario.get("dificultad_reto_actual", "General"),
+            "dificultad": usuario.dificultad_reto_actual or "General",
             "resultado": resultado_log,
             "enunciado": enunciado,
             "respuesta": mensaje_texto,
@@ -330,21 +422,18 @@ def handle_solucion_reto(mensaje_texto, numero_remitente, usuario, historial_cha
     # 5. FLUJO DE RESPUESTA (Igual que antes)
     if es_pregunta_teorica:
         tema_actual = "programación en Java"
-        if usuario.get("curso_actual"):
-            tema_actual = CURSOS[usuario["curso_actual"]]["lecciones"][usuario["leccion_actual"]]
+        if usuario.curso_actual:
+            tema_actual = CURSOS[usuario.curso_actual]["lecciones"][usuario.leccion_actual]
         respuesta = ai.chat_conversacional_con_ia(mensaje_texto, historial_chat, tema_actual)
         responder_mensaje(numero_remitente, respuesta, historial_chat)
 
     elif es_correcto:
-        dificultad = usuario.get("dificultad_reto_actual", "Fácil")
+        dificultad = usuario.dificultad_reto_actual or "Fácil"
         activar_defensa = es_sospechoso or (dificultad != "Fácil" and not es_debug and random.random() < 0.3)
 
         if activar_defensa:
             pregunta_defensa = ai.generar_pregunta_defensa(enunciado, mensaje_texto)
-            db.actualizar_usuario(numero_remitente, {
-                "estado_conversacion": "esperando_defensa",
-                "pregunta_defensa_actual": pregunta_defensa
-            })
+            usuario.actualizar(estado_conversacion="esperando_defensa", pregunta_defensa_actual=pregunta_defensa)
             msg = f"✅ ¡Código correcto!\n\n{'Para validar tu aprendizaje' if es_sospechoso else 'Solo una pregunta rápida'}:"
             responder_mensaje(numero_remitente, msg, historial_chat)
             time.sleep(1)
@@ -357,8 +446,9 @@ def handle_solucion_reto(mensaje_texto, numero_remitente, usuario, historial_cha
         procesar_fallo(numero_remitente, usuario, historial_chat)
 
 
+@metrics.instrumentar("handler")
 def procesar_acierto(numero_remitente, usuario, historial_chat, factor_puntos=1.0):
-    dificultad = usuario.get("dificultad_reto_actual", "Fácil")
+    dificultad = usuario.dificultad_reto_actual or "Fácil"
 
     # Obtenemos los puntos base según dificultad
     puntos_base = PUNTOS_POR_DIFICULTAD.get(dificultad, 10)
@@ -366,32 +456,20 @@ def procesar_acierto(numero_remitente, usuario, historial_chat, factor_puntos=1.
     # APLICAMOS EL FACTOR (Aquí está el arreglo) 🛠️
     puntos_ganados = int(puntos_base * factor_puntos)
 
-    racha = usuario.get("racha_dias", 1)
+    racha = usuario.racha_dias
     puntos_con_bonus = puntos_ganados + racha
 
-    puntos_actuales_generales = usuario.get("puntos", 0) + puntos_con_bonus
-    retos_completados = usuario.get("retos_completados", 0) + 1
-    pistas_usadas = usuario.get("pistas_usadas", 0)
-    retos_sin_pistas = usuario.get("retos_sin_pistas", 0)
-    if pistas_usadas == 0:
-        retos_sin_pistas += 1
-
-    db.actualizar_usuario(numero_remitente, {
-        "puntos": puntos_actuales_generales,
-        "retos_completados": retos_completados,
-        "retos_sin_pistas": retos_sin_pistas
-    })
+    # Los contadores se suman en el servidor; el total local solo decide el nivel
+    puntos_actuales_generales = usuario.puntos + puntos_con_bonus
+    db.registrar_acierto(numero_remitente, puntos_con_bonus, sin_pistas=usuario.pistas_usadas == 0)
 
     mensaje_puntos = formatear_puntos_ganados(puntos_ganados, racha)
     responder_mensaje(numero_remitente, mensaje_puntos, historial_chat)
 
-    tema_actual = usuario.get("tematica_actual")
+    tema_actual = usuario.tematica_actual
     if tema_actual:
-        progreso_temas = json.loads(usuario.get("progreso_temas", "{}"))
-        if tema_actual not in progreso_temas:
-            progreso_temas[tema_actual] = {"puntos": 0, "nivel": 1}
-
-        tema_data = progreso_temas[tema_actual]
+        progreso_temas = usuario.progreso_temas
+        tema_data = {"puntos": 0, "nivel": 1, **progreso_temas.get(tema_actual, {})}
         tema_data["puntos"] += puntos_con_bonus
         puntos_necesarios = PUNTOS_HABILIDAD_PARA_NIVEL_UP * tema_data["nivel"]
 
@@ -412,25 +490,26 @@ def procesar_acierto(numero_remitente, usuario, historial_chat, factor_puntos=1.
             cheat_sheet = ai.generar_cheat_sheet(tema_actual)
             responder_mensaje(numero_remitente, cheat_sheet, historial_chat)
 
-        db.actualizar_usuario(numero_remitente, {"progreso_temas": json.dumps(progreso_temas)})
+        # Solo se escribe la entrada de este tema (puntos sumados en el servidor)
+        db.sumar_progreso_tema(numero_remitente, tema_actual, puntos_con_bonus, tema_data["nivel"])
 
-    nivel_actual = usuario.get("nivel", 1)
+    nivel_actual = usuario.nivel
     if puntos_actuales_generales >= PUNTOS_PARA_NIVEL_UP * nivel_actual:
         nuevo_nivel_general = nivel_actual + 1
         nombre_nivel = NOMBRES_NIVELES.get(nuevo_nivel_general, f"Nivel {nuevo_nivel_general}")
-        db.actualizar_usuario(numero_remitente, {"nivel": nuevo_nivel_general})
+        db.subir_nivel(numero_remitente, nuevo_nivel_general)
         mensaje_nivel_up = formatear_nivel_up(nuevo_nivel_general, nombre_nivel)
         responder_mensaje(numero_remitente, mensaje_nivel_up, historial_chat)
 
-    usuario_actualizado = db.obtener_usuario(numero_remitente)
-    verificar_y_otorgar_logros(numero_remitente, usuario_actualizado)
+    # La sesión ya ve los puntos y contadores sumados en este turno
+    verificar_y_otorgar_logros(numero_remitente, usuario)
 
-    db.actualizar_usuario(numero_remitente, {
-        "estado_conversacion": "menu_principal",
-        "reto_actual_enunciado": None,
-        "reto_actual_solucion": None,
-        "pistas_usadas": 0
-    })
+    usuario.actualizar(
+        estado_conversacion="menu_principal",
+        reto_actual_enunciado=None,
+        reto_actual_solucion=None,
+        pistas_usadas=0
+    )
 
     mensaje_final = f"\n{PREGUNTA} ¿Qué quieres hacer ahora?"
     botones = [
@@ -440,80 +519,79 @@ def procesar_acierto(numero_remitente, usuario, historial_chat, factor_puntos=1.
     enviar_botones_basicos(numero_remitente, "👇 Opciones disponibles:", botones)
 
 
+@metrics.instrumentar("handler")
 def avanzar_leccion(numero_remitente, usuario, historial_chat):
-    curso_key = usuario["curso_actual"]
+    curso_key = usuario.curso_actual
     curso = CURSOS[curso_key]
-    nueva_leccion = usuario["leccion_actual"] + 1
+    nueva_leccion = usuario.leccion_actual + 1
 
     if nueva_leccion < len(curso["lecciones"]):
-        db.actualizar_usuario(numero_remitente, {"leccion_actual": nueva_leccion, "intentos_fallidos": 0})
+        usuario.actualizar(leccion_actual=nueva_leccion, intentos_fallidos=0)
         siguiente_tema = curso["lecciones"][nueva_leccion]
         mensaje = f"¡Muy bien! Lección completada. ✅\n\nTu siguiente lección es: **{siguiente_tema}**.\n\nGenerando un nuevo reto..."
         responder_mensaje(numero_remitente, mensaje, historial_chat)
         generar_y_enviar_reto(numero_remitente, usuario, curso_key, "Fácil", siguiente_tema)
     else:
-        mensaje_final = f"¡Increíble, {usuario['nombre']}! 🏆 ¡Has completado el curso *{curso['nombre']}*! Has demostrado una gran habilidad. ¡Sigue practicando con retos aleatorios!"
+        mensaje_final = f"¡Increíble, {usuario.nombre}! 🏆 ¡Has completado el curso *{curso['nombre']}*! Has demostrado una gran habilidad. ¡Sigue practicando con retos aleatorios!"
         responder_mensaje(numero_remitente, mensaje_final, historial_chat)
-        db.actualizar_usuario(numero_remitente, {"estado_conversacion": "menu_principal", "curso_actual": None})
+        usuario.actualizar(estado_conversacion="menu_principal", curso_actual=None)
         enviar_menu_interactivo(numero_remitente)
 
 
+@metrics.instrumentar("handler")
 def procesar_fallo(numero_remitente, usuario, historial_chat):
-    intentos = usuario.get("intentos_fallidos", 0) + 1
-    total_fallos_global = usuario.get("total_fallos", 0) + 1  # Contador histórico global
+    intentos = usuario.intentos_fallidos + 1
+    db.registrar_fallo(numero_remitente)  # intentos del reto + histórico global
 
-    db.actualizar_usuario(numero_remitente, {
-        "intentos_fallidos": intentos,
-        "total_fallos": total_fallos_global  # Guardamos histórico
-    })
-
-    if usuario.get("estado_conversacion") == "en_curso" and intentos >= UMBRAL_DE_FALLOS:
-        db.actualizar_usuario(numero_remitente, {"estado_conversacion": "esperando_ayuda_teorica"})
-        tema = CURSOS[usuario["curso_actual"]]["lecciones"][usuario["leccion_actual"]]
+    if usuario.estado_conversacion == "en_curso" and intentos >= UMBRAL_DE_FALLOS:
+        usuario.estado_conversacion = "esperando_ayuda_teorica"
+        tema = CURSOS[usuario.curso_actual]["lecciones"][usuario.leccion_actual]
         mensaje = f"He notado que este reto te está costando un poco. El tema de esta lección es '{tema}'. ¿Te gustaría una explicación teórica antes de volver a intentarlo? (Responde 'sí' o 'no')"
         responder_mensaje(numero_remitente, mensaje, historial_chat)
 
 
+@metrics.instrumentar("handler")
 def handle_ayuda_teorica(mensaje_texto, numero_remitente, usuario, historial_chat):
     mensaje_lower = mensaje_texto.lower()
     if "sí" in mensaje_lower or "si" in mensaje_lower:
-        curso = CURSOS[usuario["curso_actual"]]
-        tema = curso["lecciones"][usuario["leccion_actual"]]
+        curso = CURSOS[usuario.curso_actual]
+        tema = curso["lecciones"][usuario.leccion_actual]
         explicacion = ai.explicar_tema_con_ia(tema)
         responder_mensaje(numero_remitente, explicacion, historial_chat)
         responder_mensaje(numero_remitente,
                           "Ahora que hemos repasado, ¡vamos a intentarlo con un nuevo reto sobre el mismo tema!",
                           historial_chat)
-        db.actualizar_usuario(numero_remitente, {"intentos_fallidos": 0, "estado_conversacion": "en_curso"})
-        generar_y_enviar_reto(numero_remitente, usuario, usuario["curso_actual"], "Fácil", tema)
+        usuario.actualizar(intentos_fallidos=0, estado_conversacion="en_curso")
+        generar_y_enviar_reto(numero_remitente, usuario, usuario.curso_actual, "Fácil", tema)
     else:
-        db.actualizar_usuario(numero_remitente, {"estado_conversacion": "en_curso"})
+        usuario.estado_conversacion = "en_curso"
         responder_mensaje(numero_remitente,
                           "¡De acuerdo! Puedes seguir intentando el reto actual cuando quieras. ¡Tú puedes!",
                           historial_chat)
 
 
+@metrics.instrumentar("handler")
 def rendirse(numero_remitente, usuario, historial_chat):
-    if not usuario.get("reto_actual_solucion"):
+    if not usuario.reto_actual_solucion:
         responder_mensaje(numero_remitente,
                           "Tranquilo, no tienes ningún reto activo para rendirte. ¡Pide uno cuando quieras! 👍",
                           historial_chat)
     else:
-        solucion = usuario.get("reto_actual_solucion")
+        solucion = usuario.reto_actual_solucion
         mensaje_final = f"¡No te preocupes! Rendirse es parte de aprender. Lo importante es entender cómo funciona. 💪\n\nAquí tienes la solución ideal:\n\n```\n{solucion}\n```\n\n¡Analízala y verás que la próxima vez lo conseguirás! Sigue practicando. ✨"
-        db.actualizar_usuario(numero_remitente, {"estado_conversacion": "menu_principal", "reto_actual_enunciado": None,
-                                                 "reto_actual_solucion": None, "curso_actual": None,
-                                                 "intentos_fallidos": 0})
+        usuario.actualizar(estado_conversacion="menu_principal", reto_actual_enunciado=None,
+                           reto_actual_solucion=None, curso_actual=None, intentos_fallidos=0)
         responder_mensaje(numero_remitente, mensaje_final, historial_chat)
         enviar_menu_interactivo(numero_remitente)
 
 
+@metrics.instrumentar("handler")
 def mostrar_perfil(numero_remitente, usuario, historial_chat):
-    nombre = usuario['nombre']
-    nivel = usuario.get('nivel', 1)
-    puntos = usuario.get('puntos', 0)
-    racha = usuario.get('racha_dias', 0)
-    retos_completados = usuario.get('retos_completados', 0)
+    nombre = usuario.nombre
+    nivel = usuario.nivel
+    puntos = usuario.puntos
+    racha = usuario.racha_dias
+    retos_completados = usuario.retos_completados
 
     nombre_nivel = NOMBRES_NIVELES.get(nivel, f"Nivel {nivel}")
     puntos_necesarios = PUNTOS_PARA_NIVEL_UP * nivel
@@ -531,7 +609,7 @@ def mostrar_perfil(numero_remitente, usuario, historial_chat):
 
     responder_mensaje(numero_remitente, perfil_general, historial_chat)
 
-    progreso_temas = json.loads(usuario.get("progreso_temas", "{}"))
+    progreso_temas = usuario.progreso_temas
 
     if progreso_temas and any(data['puntos'] > 0 for data in progreso_temas.values()):
         mensaje_habilidades = f"\n{CONCEPTO} *PROGRESO POR TEMA:*\n\n"
@@ -554,45 +632,46 @@ def mostrar_perfil(numero_remitente, usuario, historial_chat):
     enviar_botones_basicos(numero_remitente, "👇 Opciones disponibles:", botones)
 
 
+@metrics.instrumentar("handler")
 def generar_y_enviar_reto(numero_remitente, usuario, tipo_reto, dificultad, tematica=None):
     # 30% de probabilidad de que sea un Reto de Depuración (si no es el primer reto)
-    es_debug = random.random() < 0.3 and usuario.get("retos_completados", 0) > 2
+    es_debug = random.random() < 0.3 and usuario.retos_completados > 2
 
-    historial_chat = json.loads(usuario.get("historial_chat", "[]"))
+    historial_chat = list(usuario.historial_chat)
 
     if es_debug:
-        reto = ai.generar_reto_depuracion(usuario['nivel'], tematica or "Java General")
+        reto = ai.generar_reto_depuracion(usuario.nivel, tematica or "Java General")
         nuevo_estado = "resolviendo_debug"
         tipo_msg = f"🕵️ *RETO DE DEPURACIÓN*"
     else:
-        reto = ai.generar_reto_con_ia(usuario['nivel'], tipo_reto, dificultad, tematica)
-        nuevo_estado = "resolviendo_reto" if not usuario.get("curso_actual") else "en_curso"
+        reto = ai.generar_reto_con_ia(usuario.nivel, tipo_reto, dificultad, tematica)
+        nuevo_estado = "resolviendo_reto" if not usuario.curso_actual else "en_curso"
         tipo_msg = f"{RETO} *NUEVO RETO ({dificultad})*"
 
     if "error" in reto:
         responder_mensaje(numero_remitente, "Ups, la IA se tomó un descanso. Intenta de nuevo.", historial_chat)
-        db.actualizar_usuario(numero_remitente, {"estado_conversacion": "menu_principal"})
+        usuario.estado_conversacion = "menu_principal"
     else:
         # 🕒 OBTENEMOS TIMESTAMP ACTUAL PARA EL DETECTOR DE VELOCIDAD
         ahora = datetime.now().isoformat()
 
         # Guardamos el reto
-        db.actualizar_usuario(numero_remitente, {
-            "estado_conversacion": nuevo_estado,
-            "reto_actual_enunciado": reto["enunciado"],
-            "reto_actual_solucion": reto["solucion_ideal"],
-            "reto_actual_pistas": json.dumps(reto["pistas"]),
-            "pistas_usadas": 0,
+        usuario.actualizar(
+            estado_conversacion=nuevo_estado,
+            reto_actual_enunciado=reto["enunciado"],
+            reto_actual_solucion=reto["solucion_ideal"],
+            reto_actual_pistas=reto["pistas"],
+            pistas_usadas=0,
 
             # --- NUEVOS CAMPOS DE TIEMPO ---
-            "timestamp_inicio_reto": ahora,
-            "tiempo_estimado_ia": reto.get("tiempo_estimado", 120),  # Default 2 min si falla
+            timestamp_inicio_reto=ahora,
+            tiempo_estimado_ia=reto.get("tiempo_estimado", 120),  # Default 2 min si falla
             # -------------------------------
 
-            "tipo_reto_actual": "debug" if es_debug else tipo_reto,
-            "dificultad_reto_actual": dificultad,
-            "tematica_actual": tematica
-        })
+            tipo_reto_actual="debug" if es_debug else tipo_reto,
+            dificultad_reto_actual=dificultad,
+            tematica_actual=tematica
+        )
 
         msg_completo = f"{tipo_msg}\n\n{reto['enunciado']}"
         responder_mensaje(numero_remitente, msg_completo, historial_chat)
@@ -600,10 +679,11 @@ def generar_y_enviar_reto(numero_remitente, usuario, tipo_reto, dificultad, tema
 
 # --- ✅ NUEVA FUNCIÓN FASE 3: PROCESAR RESPUESTA DE DEFENSA ---
 
+@metrics.instrumentar("handler")
 def handle_respuesta_defensa(mensaje_texto, numero_remitente, usuario, historial_chat):
     """Evalúa si el estudiante realmente comprende su solución (anti-plagio)."""
-    pregunta = usuario.get("pregunta_defensa_actual", "¿Por qué?")
-    enunciado = usuario.get("reto_actual_enunciado", "")
+    pregunta = usuario.pregunta_defensa_actual or "¿Por qué?"
+    enunciado = usuario.reto_actual_enunciado or ""
 
     responder_mensaje(numero_remitente, f"🤔 Analizando tu justificación...", historial_chat)
 
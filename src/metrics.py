@@ -0,0 +1,324 @@
+# metrics.py
+# Registro en memoria de contadores, gauges e histogramas, con exportación
+# en formato de texto de Prometheus (GET /metrics).
+#
+# Gunicorn corre varios procesos y cada uno tiene su propio registro. Para que
+# /metrics muestre el total, cada proceso vuelca periódicamente su estado a
+# METRICS_DIR y el proceso que atiende el scrape suma todos los archivos.
+
+import bisect
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+from src import tracing
+from src.config.config import METRICS_DIR, METRICS_FLUSH_SEGUNDOS
+
+# Límites superiores (segundos) de los buckets de latencia
+BUCKETS_LATENCIA = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, float("inf"))
+# Para operaciones de milisegundos (webhook, lecturas y escrituras de Firestore)
+BUCKETS_RAPIDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf"))
+
+_lock = threading.Lock()
+# Las claves son (nombre, etiquetas) con etiquetas como tupla ordenada de pares
+_contadores = {}
+_gauges = {}
+_gauges_dinamicos = {}
+# nombre -> cómo se combinan los valores de varios procesos ("suma", "promedio" o "max")
+_agregacion_gauges = {}
+# clave -> {"buckets": tuple, "conteos": list, "suma": float, "total": int}
+_histogramas = {}
+_exportador = None
+
+
+def _clave(nombre, etiquetas):
+    return nombre, tuple(sorted((k, str(v)) for k, v in (etiquetas or {}).items()))
+
+
+def incrementar(nombre, valor=1, etiquetas=None):
+    """Suma `valor` al contador `nombre` (lo crea en 0 si no existe)."""
+    clave = _clave(nombre, etiquetas)
+    with _lock:
+        _contadores[clave] = _contadores.get(clave, 0) + valor
+
+
+def leer_contador(nombre, etiquetas=None):
+    """Valor actual de un contador de este proceso (0 si no existe)."""
+    with _lock:
+        return _contadores.get(_clave(nombre, etiquetas), 0)
+
+
+def fijar_gauge(nombre, valor, etiquetas=None, agregacion="suma"):
+    """Fija el valor instantáneo de un gauge."""
+    with _lock:
+        _gauges[_clave(nombre, etiquetas)] = valor
+        _agregacion_gauges[nombre] = agregacion
+
+
+def registrar_gauge(nombre, funcion, agregacion="suma", etiquetas=None):
+    """
+    Registra un gauge cuyo valor se calcula al leerlo
+    (ej: profundidad actual de la cola de turnos).
+    `agregacion` indica cómo combinarlo entre procesos: las proporciones
+    como una tasa de aciertos deben promediarse, no sumarse.
+    """
+    with _lock:
+        _gauges_dinamicos[_clave(nombre, etiquetas)] = funcion
+        _agregacion_gauges[nombre] = agregacion
+
+
+def observar(nombre, valor, etiquetas=None, buckets=BUCKETS_LATENCIA):
+    """Registra una observación (ej: una latencia en segundos) en un histograma."""
+    clave = _clave(nombre, etiquetas)
+    with _lock:
+        histograma = _histogramas.get(clave)
+        if histograma is None:
+            histograma = _histogramas[clave] = {
+                "buckets": buckets, "conteos": [0] * len(buckets), "suma": 0.0, "total": 0
+            }
+        histograma["conteos"][bisect.bisect_left(histograma["buckets"], valor)] += 1
+        histograma["suma"] += valor
+        histograma["total"] += 1
+
+
+def instrumentar(etapa, buckets=BUCKETS_LATENCIA):
+    """
+    Decorador que mide la duración de cada llamada en el histograma
+    `{etapa}_duracion_segundos`, etiquetado con el nombre de la función,
+    y la registra como span `{etapa}.{función}` de la traza del turno.
+    También acepta funciones async.
+    """
+    def decorador(funcion):
+        etiquetas = {"operacion": funcion.__name__}
+        nombre_span = f"{etapa}.{funcion.__name__}"
+
+        if inspect.iscoroutinefunction(funcion):
+            @functools.wraps(funcion)
+            async def envoltura_async(*args, **kwargs):
+                inicio = time.perf_counter()
+                try:
+                    with tracing.span(nombre_span):
+                        return await funcion(*args, **kwargs)
+                finally:
+                    observar(f"{etapa}_duracion_segundos", time.perf_counter() - inicio, etiquetas, buckets)
+
+            return envoltura_async
+
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                with tracing.span(nombre_span):
+                    return funcion(*args, **kwargs)
+            finally:
+                observar(f"{etapa}_duracion_segundos", time.perf_counter() - inicio, etiquetas, buckets)
+
+        return envoltura
+
+    return decorador
+
+
+def percentil(nombre, q, etiquetas=None):
+    """
+    Aproxima el percentil `q` (0-1) de un histograma con el límite superior
+    del bucket que lo contiene. Retorna None si no hay observaciones.
+    """
+    with _lock:
+        histograma = _histogramas.get(_clave(nombre, etiquetas))
+        if not histograma or not histograma["total"]:
+            return None
+        objetivo = q * histograma["total"]
+        acumulado = 0
+        for limite, conteo in zip(histograma["buckets"], histograma["conteos"]):
+            acumulado += conteo
+            if acumulado >= objetivo:
+                return limite
+    return None
+
+
+def _estado_local():
+    """Estado serializable del registro de este proceso (gauges dinámicos ya evaluados)."""
+    with _lock:
+        contadores = dict(_contadores)
+        gauges = dict(_gauges)
+        histogramas = {clave: {**h, "conteos": list(h["conteos"])} for clave, h in _histogramas.items()}
+        dinamicos = dict(_gauges_dinamicos)
+        agregacion = dict(_agregacion_gauges)
+
+    for clave, funcion in dinamicos.items():
+        try:
+            gauges[clave] = funcion()
+        except Exception as e:
+            print(f"⚠️ Error leyendo gauge {clave[0]}: {e}")
+
+    return {
+        "pid": os.getpid(),
+        "contadores": [[n, list(e), v] for (n, e), v in contadores.items()],
+        "gauges": [[n, list(e), v, agregacion.get(n, "suma")] for (n, e), v in gauges.items()],
+        "histogramas": [[n, list(e), {**h, "buckets": [_formatear(b) for b in h["buckets"]]}]
+                        for (n, e), h in histogramas.items()],
+    }
+
+
+def snapshot():
+    """Devuelve una vista plana de todas las métricas del proceso (usada en /health)."""
+    estado = _estado_local()
+    datos = {}
+    for nombre, etiquetas, v, *_ in estado["contadores"] + estado["gauges"]:
+        datos[nombre + _formatear_etiquetas(etiquetas)] = v
+    for nombre, etiquetas, h in estado["histogramas"]:
+        sufijo = _formatear_etiquetas(etiquetas)
+        datos[f"{nombre}_count{sufijo}"] = h["total"]
+        datos[f"{nombre}_sum{sufijo}"] = round(h["suma"], 3)
+    return datos
+
+
+# --- AGREGACIÓN ENTRE PROCESOS ---
+
+def volcar_a_disco():
+    """Escribe el estado de este proceso en METRICS_DIR (reemplazo atómico)."""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    ruta = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "w", encoding="utf-8") as archivo:
+        json.dump(_estado_local(), archivo)
+    os.replace(temporal, ruta)
+
+
+def iniciar_volcado_periodico():
+    """Vuelca el registro a disco cada METRICS_FLUSH_SEGUNDOS en un hilo de fondo."""
+    global _exportador
+    if _exportador or not METRICS_DIR:
+        return
+
+    def _bucle():
+        while True:
+            time.sleep(METRICS_FLUSH_SEGUNDOS)
+            try:
+                volcar_a_disco()
+            except Exception as e:
+                print(f"⚠️ Error volcando métricas: {e}")
+
+    _exportador = threading.Thread(target=_bucle, name="metrics-flush", daemon=True)
+    _exportador.start()
+
+
+def proceso_vivo(pid):
+    """True si el proceso `pid` de esta máquina sigue en ejecución."""
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _estados_de_todos_los_procesos():
+    """
+    Lee los volcados de todos los procesos. Los contadores e histogramas de
+    procesos muertos se conservan (son acumulados); sus gauges se descartan.
+    """
+    if not METRICS_DIR:
+        return [_estado_local()]
+
+    volcar_a_disco()
+    estados = []
+    for nombre_archivo in os.listdir(METRICS_DIR):
+        if not nombre_archivo.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, nombre_archivo), encoding="utf-8") as archivo:
+                estado = json.load(archivo)
+        except (OSError, ValueError):
+            continue
+        if not proceso_vivo(estado.get("pid", 0)):
+            estado["gauges"] = []
+        estados.append(estado)
+    return estados
+
+
+def _agregar(estados):
+    contadores, gauges, histogramas = {}, {}, {}
+    # clave -> (agregacion, [valores de cada proceso])
+    valores_gauges = {}
+    for estado in estados:
+        for nombre, etiquetas, v in estado["contadores"]:
+            clave = (nombre, tuple(map(tuple, etiquetas)))
+            contadores[clave] = contadores.get(clave, 0) + v
+        for nombre, etiquetas, v, agregacion in estado["gauges"]:
+            clave = (nombre, tuple(map(tuple, etiquetas)))
+            valores_gauges.setdefault(clave, (agregacion, []))[1].append(v or 0)
+        for nombre, etiquetas, h in estado["histogramas"]:
+            clave = (nombre, tuple(map(tuple, etiquetas)))
+            total = histogramas.setdefault(clave, {
+                "buckets": h["buckets"], "conteos": [0] * len(h["buckets"]), "suma": 0.0, "total": 0
+            })
+            total["conteos"] = [a + b for a, b in zip(total["conteos"], h["conteos"])]
+            total["suma"] += h["suma"]
+            total["total"] += h["total"]
+
+    for clave, (agregacion, valores) in valores_gauges.items():
+        if agregacion == "promedio":
+            gauges[clave] = sum(valores) / len(valores)
+        elif agregacion == "max":
+            gauges[clave] = max(valores)
+        else:
+            gauges[clave] = sum(valores)
+    return contadores, gauges, histogramas
+
+
+# --- FORMATO PROMETHEUS ---
+
+def _formatear(numero):
+    if numero == float("inf"):
+        return "+Inf"
+    return repr(float(numero)) if isinstance(numero, float) else str(numero)
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatear_etiquetas(etiquetas, extra=None):
+    pares = list(etiquetas) + ([extra] if extra else [])
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in pares) + "}"
+
+
+def exportar_prometheus():
+    """Texto de exposición de Prometheus con las métricas de todos los procesos."""
+    contadores, gauges, histogramas = _agregar(_estados_de_todos_los_procesos())
+    lineas = []
+
+    def _por_nombre(series):
+        agrupadas = {}
+        for (nombre, etiquetas), v in sorted(series.items()):
+            agrupadas.setdefault(nombre, []).append((etiquetas, v))
+        return agrupadas.items()
+
+    for nombre, series in _por_nombre(contadores):
+        lineas.append(f"# TYPE {nombre} counter")
+        lineas += [f"{nombre}{_formatear_etiquetas(e)} {v}" for e, v in series]
+
+    for nombre, series in _por_nombre(gauges):
+        lineas.append(f"# TYPE {nombre} gauge")
+        lineas += [f"{nombre}{_formatear_etiquetas(e)} {v}" for e, v in series]
+
+    for nombre, series in _por_nombre(histogramas):
+        lineas.append(f"# TYPE {nombre} histogram")
+        for etiquetas, h in series:
+            acumulado = 0
+            for limite, conteo in zip(h["buckets"], h["conteos"]):
+                acumulado += conteo
+                lineas.append(f"{nombre}_bucket{_formatear_etiquetas(etiquetas, ('le', limite))} {acumulado}")
+            lineas.append(f"{nombre}_sum{_formatear_etiquetas(etiquetas)} {h['suma']}")
+            lineas.append(f"{nombre}_count{_formatear_etiquetas(etiquetas)} {h['total']}")
+
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,186 @@
+# retencion.py
+# Retención de challenge_logs y alerts: los documentos más viejos que
+# RETENCION_LOGS_DIAS / RETENCION_ALERTAS_DIAS se resumen por día y se
+# borran, así las colecciones crudas (y lo que cuesta consultarlas) dejan de
+# crecer con la antigüedad del despliegue.
+#
+#   challenge_logs_diarios/{dia}_{estudiante}_{tema}: intentos por resultado
+#       y dificultad, sospechosos y tiempo total de un alumno en un tema
+#   alerts_diarias/{dia}_{estudiante}: alertas por tipo y severidad, y
+#       cuántas seguían sin leer por el docente
+#
+# Cada página de documentos vencidos se resume y se borra en una sola
+# escritura atómica (Almacen.compactar_registros): si algo falla a mitad de
+# camino, ningún documento queda contado dos veces ni borrado sin contar. Los
+# resúmenes se acumulan con incrementos, así que la siguiente corrida solo
+# procesa lo que quedó.
+#
+# Se corta por día completo (antes de la medianoche de hace N días) para que
+# cada resumen reciba su día de una vez. Con RETENCION_ARCHIVO_DIR los
+# documentos se copian a JSONL antes de borrarse.
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from src import metrics
+from src.config.config import (RETENCION_ALERTAS_DIAS, RETENCION_ARCHIVO_DIR, RETENCION_INTERVALO_HORAS,
+                               RETENCION_LOGS_DIAS)
+from src.storage import obtener_almacen
+from src.storage.base import Incremento, combinar
+
+COLECCION_LOGS_DIARIOS = "challenge_logs_diarios"
+COLECCION_ALERTAS_DIARIAS = "alerts_diarias"
+# Documentos por página: sus resúmenes y borrados caben en un WriteBatch (500)
+LOTE = 250
+# Lease (ver Almacen.adquirir_turno) para que compacte un solo proceso a la vez,
+# sea el servidor o scripts/compactar_registros.py. Firestore reserva los IDs
+# de la forma __.*__, así que va sin guiones bajos.
+_CLAVE_LEASE = "retencion"
+_ID_PROCESO = uuid.uuid4().hex
+# La primera compactación espera a que el servidor termine de arrancar
+_ESPERA_INICIAL_SEGUNDOS = 300
+
+_hilo = None
+
+
+def _numero(valor):
+    return valor if isinstance(valor, (int, float)) and not isinstance(valor, bool) else 0
+
+
+def resumen_log(log):
+    """(doc_id del resumen, cambios) con lo que un log de reto suma a su día."""
+    dia = str(log["timestamp"])[:10]
+    estudiante = str(log.get("estudiante_id", ""))
+    tema = log.get("tema") or "General"
+    # Los temas llevan espacios y paréntesis: en el ID va un hash corto
+    clave_tema = hashlib.sha1(tema.encode("utf-8")).hexdigest()[:10]
+    cambios = {
+        "dia": dia,
+        "estudiante_id": estudiante,
+        "nombre_estudiante": log.get("nombre_estudiante"),
+        "tema": tema,
+        "intentos": Incremento(1),
+        ("resultados", log.get("resultado") or "SIN_RESULTADO"): Incremento(1),
+        ("dificultades", log.get("dificultad") or "Sin dificultad"): Incremento(1),
+        "sospechosos": Incremento(1 if log.get("es_sospechoso") else 0),
+        "tiempo_tomado_total": Incremento(_numero(log.get("tiempo_tomado"))),
+    }
+    if log.get("class_token"):
+        cambios["class_token"] = log["class_token"]
+    return f"{dia}_{estudiante}_{clave_tema}", cambios
+
+
+def resumen_alerta(alerta):
+    """(doc_id del resumen, cambios) con lo que una alerta suma a su día."""
+    dia = str(alerta["timestamp_alerta"])[:10]
+    estudiante = str(alerta.get("estudiante_id", ""))
+    cambios = {
+        "dia": dia,
+        "estudiante_id": estudiante,
+        "nombre_estudiante": alerta.get("nombre_estudiante"),
+        "alertas": Incremento(1),
+        ("por_tipo", alerta.get("tipo") or "desconocido"): Incremento(1),
+        ("por_severidad", alerta.get("nivel_severidad") or "desconocida"): Incremento(1),
+        "sin_leer": Incremento(0 if alerta.get("leida") else 1),
+    }
+    return f"{dia}_{estudiante}", cambios
+
+
+# coleccion -> (campo de fecha, colección de resúmenes, función de resumen)
+POLITICAS = {
+    "challenge_logs": ("timestamp", COLECCION_LOGS_DIARIOS, resumen_log),
+    "alerts": ("timestamp_alerta", COLECCION_ALERTAS_DIARIAS, resumen_alerta),
+}
+
+
+def compactar(coleccion, dias, simular=False, lote=LOTE):
+    """
+    Resume y borra los documentos de `coleccion` anteriores a hace `dias`
+    días. Con `simular` solo los cuenta. Retorna cuántos procesó.
+    """
+    campo, destino, resumir = POLITICAS[coleccion]
+    corte = (datetime.now() - timedelta(days=dias)).date().isoformat()
+    almacen = obtener_almacen()
+    procesados, despues_de = 0, None
+    while True:
+        pagina = almacen.listar_registros(coleccion, hasta=corte, despues_de=despues_de, limite=lote, campo=campo)
+        if not pagina:
+            return procesados
+        if not simular:
+            acumulados = {}
+            for _, datos in pagina:
+                resumen_id, cambios = resumir(datos)
+                combinar(acumulados.setdefault((destino, resumen_id), {}), cambios)
+            if RETENCION_ARCHIVO_DIR:
+                _archivar(coleccion, campo, pagina)
+            almacen.compactar_registros(acumulados, [(coleccion, doc_id) for doc_id, _ in pagina])
+            metrics.incrementar("retencion_documentos_total", len(pagina), {"coleccion": coleccion})
+        procesados += len(pagina)
+        if len(pagina) < lote:
+            return procesados
+        despues_de = (pagina[-1][1][campo], pagina[-1][0])
+
+
+def _archivar(coleccion, campo, pagina):
+    # Un archivo por colección y mes; si la escritura que sigue falla, la
+    # página se vuelve a archivar en la próxima corrida (deduplicar por "id")
+    os.makedirs(RETENCION_ARCHIVO_DIR, exist_ok=True)
+    por_mes = {}
+    for doc_id, datos in pagina:
+        mes = str(datos[campo])[:7]
+        por_mes.setdefault(mes, []).append(json.dumps({"id": doc_id, **datos}, ensure_ascii=False, default=str))
+    for mes, lineas in por_mes.items():
+        with open(os.path.join(RETENCION_ARCHIVO_DIR, f"{coleccion}-{mes}.jsonl"), "a", encoding="utf-8") as archivo:
+            archivo.write("\n".join(lineas) + "\n")
+            archivo.flush()
+            os.fsync(archivo.fileno())
+
+
+def compactar_todo(simular=False, dias_logs=RETENCION_LOGS_DIAS, dias_alertas=RETENCION_ALERTAS_DIAS):
+    """Aplica la retención configurada a logs y alertas: {coleccion: procesados}."""
+    procesados = {}
+    for coleccion, dias in (("challenge_logs", dias_logs), ("alerts", dias_alertas)):
+        if dias <= 0:
+            continue
+        inicio = time.perf_counter()
+        procesados[coleccion] = compactar(coleccion, dias, simular)
+        accion = "a compactar" if simular else "compactados"
+        print(f"🗜️ {procesados[coleccion]} documentos de {coleccion} {accion} "
+              f"(más de {dias} días, {time.perf_counter() - inicio:.1f}s)")
+    return procesados
+
+
+def adquirir_lease(ttl_segundos):
+    """Toma el lease de la compactación para este proceso; False si lo tiene otro."""
+    return obtener_almacen().adquirir_turno(_CLAVE_LEASE, _ID_PROCESO, ttl_segundos)
+
+
+def liberar_lease():
+    obtener_almacen().liberar_turno(_CLAVE_LEASE, _ID_PROCESO)
+
+
+def iniciar():
+    """Compactación periódica en segundo plano, si hay retención configurada."""
+    global _hilo
+    if RETENCION_INTERVALO_HORAS <= 0 or (RETENCION_LOGS_DIAS <= 0 and RETENCION_ALERTAS_DIAS <= 0) or _hilo:
+        return
+    _hilo = threading.Thread(target=_bucle, name="retencion", daemon=True)
+    _hilo.start()
+
+
+def _bucle():
+    intervalo = RETENCION_INTERVALO_HORAS * 3600
+    time.sleep(_ESPERA_INICIAL_SEGUNDOS)
+    while True:
+        try:
+            # El lease vence antes del próximo ciclo: si este proceso muere, otro lo toma
+            if adquirir_lease(intervalo * 0.9):
+                compactar_todo()
+        except Exception as e:
+            print(f"⚠️ Error en la compactación de logs y alertas: {e}")
+        time.sleep(intervalo)
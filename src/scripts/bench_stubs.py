@@ -0,0 +1,475 @@
+"""
+Dobles locales de Firestore, Gemini y la Graph API de WhatsApp para el
+benchmark del webhook (ver benchmark_webhook.py).
+
+Cada doble simula una latencia configurable (time.sleep, o asyncio.sleep en
+el cliente async) y cuenta sus llamadas, para poder reportar cuántas
+operaciones de backend cuesta un turno.
+"""
+
+import asyncio
+import copy
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+
+
+class ContadorLlamadas:
+    """Cuenta llamadas por operación de forma thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.conteos = Counter()
+
+    def registrar(self, operacion):
+        with self._lock:
+            self.conteos[operacion] += 1
+
+    def reiniciar(self):
+        with self._lock:
+            self.conteos.clear()
+
+    def total(self, prefijo=""):
+        with self._lock:
+            return sum(v for k, v in self.conteos.items() if k.startswith(prefijo))
+
+
+llamadas = ContadorLlamadas()
+
+
+# --- FIRESTORE ---
+
+class _Snapshot:
+    def __init__(self, doc_id, datos, update_time=None):
+        self.id = doc_id
+        self._datos = datos
+        self.exists = datos is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return json.loads(json.dumps(self._datos)) if self._datos is not None else None
+
+
+def _hojas(datos, prefijo=()):
+    """(ruta, valor) de cada hoja de los mapas anidados, como los mezcla set(merge=True)."""
+    for campo, valor in datos.items():
+        if isinstance(valor, dict) and valor:
+            yield from _hojas(valor, prefijo + (campo,))
+        else:
+            yield prefijo + (campo,), valor
+
+
+def _transformar(base, datos, rutas=False, merge=False):
+    """
+    Aplica `datos` sobre `base` resolviendo Increment/Maximum/ArrayUnion y
+    DELETE_FIELD como el servidor. Con `rutas` (update) las claves son field paths; con `merge`
+    los mapas anidados se mezclan hoja por hoja.
+    """
+    from google.cloud.firestore_v1 import DELETE_FIELD
+    from google.cloud.firestore_v1.field_path import FieldPath
+    from google.cloud.firestore_v1.transforms import ArrayUnion, Increment, Maximum
+
+    resultado = copy.deepcopy(base)
+    if rutas:
+        cambios = [(FieldPath.from_string(campo).parts, valor) for campo, valor in datos.items()]
+    elif merge:
+        cambios = list(_hojas(datos))
+    else:
+        cambios = [((campo,), valor) for campo, valor in datos.items()]
+    for partes, valor in cambios:
+        nodo = resultado
+        for parte in partes[:-1]:
+            if not isinstance(nodo.get(parte), dict):
+                nodo[parte] = {}
+            nodo = nodo[parte]
+        if valor is DELETE_FIELD:
+            nodo.pop(partes[-1], None)
+            continue
+        actual = nodo.get(partes[-1])
+        if isinstance(valor, Increment):
+            valor = (actual or 0) + valor.value
+        elif isinstance(valor, Maximum):
+            valor = max(actual or 0, valor.value)
+        elif isinstance(valor, ArrayUnion):
+            valor = list(actual or []) + [v for v in valor.values if v not in (actual or [])]
+        nodo[partes[-1]] = valor
+    return resultado
+
+
+class _DocumentoFalso:
+    def __init__(self, db, ruta):
+        self._db = db
+        self._ruta = ruta
+        self.id = ruta.rsplit("/", 1)[-1]
+
+    def collection(self, nombre):
+        return _ColeccionFalsa(self._db, f"{self._ruta}/{nombre}")
+
+    def get(self, **kwargs):
+        self._db._operacion("firestore.get")
+        with self._db._lock:
+            return self._db._snapshot(self)
+
+    def set(self, datos, merge=False):
+        self._db._operacion("firestore.set")
+        with self._db._lock:
+            return self._aplicar_set(datos, merge)
+
+    def update(self, datos):
+        self._db._operacion("firestore.update")
+        with self._db._lock:
+            return self._aplicar_update(datos)
+
+    # Sin lock ni conteo: los usan set/update y los commits de WriteBatch
+    def _aplicar_set(self, datos, merge):
+        base = self._db.documentos.get(self._ruta, {}) if merge else {}
+        self._db.documentos[self._ruta] = _transformar(base, datos, merge=merge)
+        return self._db._nueva_version(self._ruta)
+
+    def _aplicar_update(self, datos):
+        if self._ruta not in self._db.documentos:
+            raise Exception(f"404 No document to update: {self._ruta}")
+        self._db.documentos[self._ruta] = _transformar(self._db.documentos[self._ruta], datos, rutas=True)
+        return self._db._nueva_version(self._ruta)
+
+    def create(self, datos):
+        from google.api_core.exceptions import AlreadyExists
+
+        self._db._operacion("firestore.create")
+        with self._db._lock:
+            if self._ruta in self._db.documentos:
+                raise AlreadyExists(f"Document already exists: {self._ruta}")
+            self._db.documentos[self._ruta] = dict(datos)
+            return self._db._nueva_version(self._ruta)
+
+    def delete(self):
+        self._db._operacion("firestore.delete")
+        with self._db._lock:
+            self._db.documentos.pop(self._ruta, None)
+            self._db.versiones.pop(self._ruta, None)
+
+
+class _ColeccionFalsa:
+    _ids = itertools.count()
+
+    def __init__(self, db, ruta):
+        self._db = db
+        self._ruta = ruta
+
+    def document(self, doc_id):
+        return _DocumentoFalso(self._db, f"{self._ruta}/{doc_id}")
+
+    def add(self, datos):
+        self._db._operacion("firestore.add")
+        ruta = f"{self._ruta}/auto-{next(self._ids)}"
+        with self._db._lock:
+            self._db.documentos[ruta] = dict(datos)
+        return None, _DocumentoFalso(self._db, ruta)
+
+
+class _BatchFalso:
+    """WriteBatch: acumula escrituras y las aplica juntas en un solo commit."""
+
+    def __init__(self, db):
+        self._db = db
+        self._escrituras = []
+
+    def set(self, ref, datos, merge=False):
+        self._escrituras.append(lambda: ref._aplicar_set(datos, merge))
+
+    def update(self, ref, datos, option=None):
+        self._escrituras.append(lambda: ref._aplicar_update(datos))
+
+    def commit(self):
+        self._db._operacion("firestore.batch_commit")
+        return self._aplicar()
+
+    def _aplicar(self):
+        with self._db._lock:
+            # Atómico: si una escritura falla no se aplica ninguna
+            respaldo = {ruta: dict(doc) for ruta, doc in self._db.documentos.items()}
+            try:
+                return [escritura() for escritura in self._escrituras]
+            except Exception:
+                self._db.documentos = respaldo
+                raise
+
+
+class _TransaccionFalsa:
+    """
+    Transaction con lo que usa @firestore.transactional: las escrituras se
+    acumulan y se aplican en _commit. Las transacciones del cliente se
+    ejecutan de a una, así que nunca hay conflicto ni reintento.
+    """
+
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, db):
+        self._db = db
+        self._id = None
+        self._escrituras = []
+
+    def _clean_up(self):
+        self._escrituras = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db._lock_transacciones.acquire()
+        self._id = b"transaccion-falsa"
+
+    def _commit(self):
+        self._db._operacion("firestore.transaction_commit")
+        try:
+            with self._db._lock:
+                for escritura in self._escrituras:
+                    escritura()
+        finally:
+            self._terminar()
+        return []
+
+    def _rollback(self):
+        if self._id is not None:
+            self._terminar()
+
+    def _terminar(self):
+        self._clean_up()
+        self._db._lock_transacciones.release()
+
+    def set(self, ref, datos, merge=False):
+        self._escrituras.append(lambda: ref._aplicar_set(datos, merge))
+
+    def delete(self, ref):
+        def _borrar():
+            self._db.documentos.pop(ref._ruta, None)
+            self._db.versiones.pop(ref._ruta, None)
+        self._escrituras.append(_borrar)
+
+
+class _ResultadoEscritura:
+    """WriteResult: solo el update_time que usa la caché de usuarios."""
+
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class FirestoreFalso:
+    """Cliente Firestore en memoria con la API que usa src/database.py."""
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.documentos = {}
+        # ruta -> update_time (un contador creciente hace de reloj)
+        self.versiones = {}
+        self._reloj = itertools.count(1)
+        self._lock = threading.Lock()
+        self._lock_transacciones = threading.Lock()
+
+    def _nueva_version(self, ruta):
+        self.versiones[ruta] = next(self._reloj)
+        return _ResultadoEscritura(self.versiones[ruta])
+
+    def _snapshot(self, ref):
+        return _Snapshot(ref.id, self.documentos.get(ref._ruta), self.versiones.get(ref._ruta))
+
+    def _operacion(self, nombre):
+        llamadas.registrar(nombre)
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def collection(self, nombre):
+        return _ColeccionFalsa(self, nombre)
+
+    def batch(self):
+        return _BatchFalso(self)
+
+    def transaction(self):
+        return _TransaccionFalsa(self)
+
+    def get_all(self, refs):
+        self._operacion("firestore.get_all")
+        with self._lock:
+            return [self._snapshot(ref) for ref in refs]
+
+
+class _DocumentoAsyncFalso:
+    def __init__(self, cliente, ref):
+        self._cliente = cliente
+        self._ref = ref
+
+    async def get(self, **kwargs):
+        await self._cliente._operacion("firestore.get")
+        with self._cliente._db._lock:
+            return self._cliente._db._snapshot(self._ref)
+
+    async def set(self, datos, merge=False):
+        await self._cliente._operacion("firestore.set")
+        with self._cliente._db._lock:
+            return self._ref._aplicar_set(datos, merge)
+
+    async def update(self, datos):
+        await self._cliente._operacion("firestore.update")
+        with self._cliente._db._lock:
+            return self._ref._aplicar_update(datos)
+
+
+class _ColeccionAsyncFalsa:
+    def __init__(self, cliente, coleccion):
+        self._cliente = cliente
+        self._coleccion = coleccion
+
+    def document(self, doc_id):
+        return _DocumentoAsyncFalso(self._cliente, self._coleccion.document(doc_id))
+
+
+class _BatchAsyncFalso(_BatchFalso):
+    def __init__(self, cliente):
+        super().__init__(cliente._db)
+        self._cliente = cliente
+
+    def set(self, ref, datos, merge=False):
+        super().set(ref._ref, datos, merge)
+
+    def update(self, ref, datos, option=None):
+        super().update(ref._ref, datos, option)
+
+    async def commit(self):
+        await self._cliente._operacion("firestore.batch_commit")
+        return self._aplicar()
+
+
+class FirestoreAsyncFalso:
+    """AsyncClient sobre los mismos documentos que un FirestoreFalso."""
+
+    def __init__(self, db):
+        self._db = db
+
+    async def _operacion(self, nombre):
+        llamadas.registrar(nombre)
+        if self._db.latencia:
+            await asyncio.sleep(self._db.latencia)
+
+    def collection(self, nombre):
+        return _ColeccionAsyncFalsa(self, self._db.collection(nombre))
+
+    def batch(self):
+        return _BatchAsyncFalso(self)
+
+    async def get_all(self, refs):
+        await self._operacion("firestore.get_all")
+        with self._db._lock:
+            snapshots = [self._db._snapshot(ref._ref) for ref in refs]
+        for snapshot in snapshots:
+            yield snapshot
+
+
+# --- GEMINI ---
+
+class _RespuestaGemini:
+    def __init__(self, texto):
+        self.text = texto
+
+
+class _ModelosFalsos:
+    def __init__(self, latencia, tasa_acierto):
+        self.latencia = latencia
+        self.tasa_acierto = tasa_acierto
+        self._n = itertools.count()
+
+    def get(self, model):
+        llamadas.registrar("gemini.get")
+        return {"name": model}
+
+    def generate_content(self, model, contents):
+        llamadas.registrar("gemini.generate_content")
+        if self.latencia:
+            time.sleep(self.latencia)
+
+        if '"enunciado"' in contents:
+            return _RespuestaGemini(json.dumps({
+                "enunciado": "Escribe un programa que sume dos enteros 💡",
+                "solucion_ideal": "int c = a + b;",
+                "pistas": ["Declara dos variables", "Usa el operador +", "Imprime el resultado"],
+                "tiempo_estimado": 5
+            }))
+        if "evaluador de código" in contents:
+            # Reparte aciertos y fallos de forma determinista
+            if (next(self._n) % 100) < self.tasa_acierto * 100:
+                return _RespuestaGemini("✅ *¡CORRECTO!*: Bien resuelto.")
+            return _RespuestaGemini("❌ *INCORRECTO:*: Revisa el tipo de dato.")
+        if 'Responde SOLO "SI" o "NO"' in contents:
+            return _RespuestaGemini("SI")
+        return _RespuestaGemini("Respuesta simulada del tutor.")
+
+
+class GeminiFalso:
+    """Reemplazo de genai.Client con la forma client.models.generate_content()."""
+
+    def __init__(self, latencia=0.0, tasa_acierto=0.7):
+        self.models = _ModelosFalsos(latencia, tasa_acierto)
+
+
+# --- GRAPH API ---
+
+class _RespuestaGraph:
+    status_code = 200
+    ok = True
+    text = ""
+
+    def __init__(self, wamid):
+        self._wamid = wamid
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"messaging_product": "whatsapp", "messages": [{"id": self._wamid}]}
+
+
+class GraphApiFalsa:
+    """Reemplazo de la sesión HTTP que usa whatsapp_utils para los envíos."""
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self._ids = itertools.count()
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        llamadas.registrar("graph.post")
+        if self.latencia:
+            time.sleep(self.latencia)
+        return _RespuestaGraph(f"wamid.bench{next(self._ids)}")
+
+    def get(self, url, **kwargs):
+        llamadas.registrar("graph.get")
+        return _RespuestaGraph(None)
+
+
+def instalar(latencia_firestore=0.02, latencia_gemini=1.5, latencia_graph=0.15, tasa_acierto=0.7,
+             backend="firestore"):
+    """
+    Reemplaza los clientes reales de los módulos de src por los dobles locales.
+    Debe llamarse después de importar src.main y antes de enviar tráfico.
+    Con backend="firestore" el almacenamiento es AlmacenFirestore sobre un
+    FirestoreFalso (cuenta operaciones de Firestore); con "memoria" es
+    AlmacenMemoria (cuenta lecturas y escrituras). Retorna el Almacen
+    instalado para poder sembrar usuarios.
+    """
+    import src.ai_services as ai
+    import src.whatsapp_utils as wa
+    from src import storage
+
+    if backend == "memoria":
+        from src.storage.memory_store import AlmacenMemoria
+        almacen = storage.instalar(AlmacenMemoria(latencia_firestore))
+    else:
+        from src.storage.firestore_store import AlmacenFirestore
+        falso = FirestoreFalso(latencia_firestore)
+        almacen = storage.instalar(AlmacenFirestore(cliente=falso, cliente_async=FirestoreAsyncFalso(falso)))
+    ai.client = GeminiFalso(latencia_gemini, tasa_acierto)
+
+    wa._sesion = GraphApiFalsa(latencia_graph)
+    wa.WHATSAPP_TOKEN = "bench-token"
+    wa.ID_NUMERO_TELEFONO = "000000000000000"
+    return almacen
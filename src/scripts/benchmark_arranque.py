@@ -0,0 +1,149 @@
+"""
+Benchmark de arranque en frío de LogicBot.
+
+Cada repetición corre en un intérprete nuevo (como un worker de gunicorn
+recién creado por Render) y mide:
+  - import:       tiempo de `import src.main`
+  - startup:      eventos de arranque de FastAPI (incluye el warmup)
+  - 1er webhook:  ack de la primera entrega (solo callbacks de estado, no envía mensajes)
+  - 1ra lectura / 2da lectura de Firestore y creación del cliente de Gemini
+    después del startup: si el warmup funcionó, la primera cuesta lo mismo que la segunda.
+
+Usa las credenciales reales del entorno (.env / firebase_credentials.json).
+Con --modulos imprime además los imports más costosos (python -X importtime).
+
+USO:
+    python -m src.scripts.benchmark_arranque --repeticiones 5
+    python -m src.scripts.benchmark_arranque --sin-warmup   # comparar contra todo perezoso
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def _fase_hija():
+    """Se ejecuta en el proceso hijo: mide y escribe un JSON en stdout."""
+    tiempos = {}
+
+    inicio = time.perf_counter()
+    from src.main import app
+    tiempos["import_ms"] = (time.perf_counter() - inicio) * 1000
+
+    from src.scripts.benchmark_webhook import _lifespan, _post_asgi
+    import src.ai_services as ai
+    import src.database as db
+
+    async def medir():
+        inicio = time.perf_counter()
+        apagar = await _lifespan(app)
+        tiempos["startup_ms"] = (time.perf_counter() - inicio) * 1000
+
+        entrega = {"entry": [{"changes": [{"value": {"statuses": [
+            {"id": "wamid.arranque", "status": "sent", "timestamp": str(int(time.time()))}
+        ]}}]}]}
+        inicio = time.perf_counter()
+        await _post_asgi(app, "/webhook", json.dumps(entrega).encode())
+        tiempos["primer_webhook_ms"] = (time.perf_counter() - inicio) * 1000
+
+        for clave in ("primera_lectura_ms", "segunda_lectura_ms"):
+            inicio = time.perf_counter()
+            db.obtener_usuario("_warmup")
+            tiempos[clave] = (time.perf_counter() - inicio) * 1000
+
+        inicio = time.perf_counter()
+        ai.obtener_cliente()
+        tiempos["cliente_gemini_ms"] = (time.perf_counter() - inicio) * 1000
+
+        await apagar()
+
+    # Los logs del servidor van a stderr para no mezclarse con el resultado
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        asyncio.run(medir())
+    finally:
+        sys.stdout = stdout
+    print(json.dumps(tiempos))
+
+
+def _correr_hijo(entorno):
+    resultado = subprocess.run(
+        [sys.executable, "-m", "src.scripts.benchmark_arranque", "--fase-hija"],
+        capture_output=True, text=True, env=entorno
+    )
+    if resultado.returncode != 0:
+        raise RuntimeError(resultado.stderr[-2000:])
+    return json.loads(resultado.stdout.strip().splitlines()[-1])
+
+
+def _imports_mas_costosos(entorno, cantidad):
+    """Imports con mayor tiempo acumulado según `python -X importtime`."""
+    resultado = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import src.main"],
+        capture_output=True, text=True, env=entorno
+    )
+    filas = []
+    for linea in resultado.stderr.splitlines():
+        if not linea.startswith("import time:") or "cumulative" in linea:
+            continue
+        _, acumulado, modulo = [p.strip() for p in linea[len("import time:"):].split("|")]
+        # Solo paquetes de primer nivel, para ver quién pesa en total
+        if modulo == modulo.lstrip() and "." not in modulo.strip():
+            filas.append((int(acumulado) / 1000, modulo.strip()))
+    return sorted(filas, reverse=True)[:cantidad]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque en frío de LogicBot")
+    parser.add_argument("--repeticiones", type=int, default=3, help="Procesos nuevos a medir")
+    parser.add_argument("--sin-warmup", action="store_true", help="Arranca con WARMUP_TIMEOUT_SEGUNDOS=0")
+    parser.add_argument("--modulos", type=int, default=0, help="Muestra los N imports más costosos")
+    parser.add_argument("--json", action="store_true", help="Imprime el reporte como JSON")
+    parser.add_argument("--fase-hija", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fase_hija:
+        _fase_hija()
+        return
+
+    entorno = dict(os.environ)
+    entorno["PYTHONPATH"] = os.pathsep.join(filter(None, [os.getcwd(), entorno.get("PYTHONPATH")]))
+    if args.sin_warmup:
+        entorno["WARMUP_TIMEOUT_SEGUNDOS"] = "0"
+
+    muestras = [_correr_hijo(entorno) for _ in range(args.repeticiones)]
+    reporte = {
+        clave: {
+            "mediana": round(statistics.median(m[clave] for m in muestras), 1),
+            "max": round(max(m[clave] for m in muestras), 1),
+        }
+        for clave in muestras[0]
+    }
+    if args.modulos:
+        reporte["imports_mas_costosos_ms"] = {m: round(t, 1) for t, m in _imports_mas_costosos(entorno, args.modulos)}
+
+    if args.json:
+        print(json.dumps(reporte, indent=2, ensure_ascii=False))
+        return
+
+    print("=" * 70)
+    print(f"🧊 LogicBot - Arranque en frío ({args.repeticiones} procesos, "
+          f"warmup {'desactivado' if args.sin_warmup else 'activo'})")
+    print("=" * 70)
+    for clave, valores in reporte.items():
+        if clave == "imports_mas_costosos_ms":
+            continue
+        print(f"⏱️  {clave:<22} mediana {valores['mediana']:>8} ms   máx {valores['max']:>8} ms")
+    for modulo, ms in reporte.get("imports_mas_costosos_ms", {}).items():
+        print(f"📦 {modulo:<30} {ms:>8} ms")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+Benchmark extremo a extremo del webhook de LogicBot.
+
+Reproduce entregas de WhatsApp (sintéticas o grabadas) contra la app FastAPI
+de src/main.py a una tasa y concurrencia configurables. Firestore, Gemini y
+la Graph API se reemplazan por dobles locales con latencia configurable
+(ver bench_stubs.py), así que no se toca ningún servicio real.
+
+Reporta throughput, latencia de ingreso (respuesta del webhook), latencia
+p50/p95/p99 del turno completo y llamadas de backend por turno.
+
+USO:
+    python -m src.scripts.benchmark_webhook --usuarios 200 --rps 40 --duracion 30
+    python -m src.scripts.benchmark_webhook --replay entregas.jsonl --concurrencia 50
+
+Para grabar entregas reales: WEBHOOK_GRABAR_EN=entregas.jsonl en el servidor.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from datetime import date
+
+# Mezcla de mensajes de un estudiante típico durante una clase
+MEZCLA_MENSAJES = [
+    ("text", "menu", 3),
+    ("text", "perfil", 1),
+    ("text", "logros", 1),
+    ("text", "pista", 2),
+    ("text", "public int suma(int a, int b) { return a + b; }", 5),
+    ("interactive", "pedir_reto_aleatorio", 1),
+    ("interactive", "ver_mi_perfil", 1),
+]
+
+_ids_mensaje = itertools.count()
+
+
+def percentiles(valores):
+    """p50/p95/p99 por rango más cercano (en milisegundos)."""
+    if not valores:
+        return {"p50": None, "p95": None, "p99": None}
+    ordenados = sorted(valores)
+
+    def _p(q):
+        return round(ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))] * 1000, 1)
+
+    return {"p50": _p(0.50), "p95": _p(0.95), "p99": _p(0.99)}
+
+
+def sintetizar_entrega(numero):
+    """Construye una entrega de Meta con un mensaje aleatorio de la mezcla."""
+    tipo, contenido, _ = random.choices(MEZCLA_MENSAJES, weights=[m[2] for m in MEZCLA_MENSAJES])[0]
+    mensaje = {
+        "from": numero,
+        "id": f"wamid.in{next(_ids_mensaje)}",
+        "timestamp": str(int(time.time())),
+        "type": tipo,
+    }
+    if tipo == "text":
+        mensaje["text"] = {"body": contenido}
+    else:
+        mensaje["interactive"] = {"type": "list_reply", "list_reply": {"id": contenido}}
+
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"changes": [{"value": {
+            "contacts": [{"wa_id": numero, "profile": {"name": f"Bench {numero[-4:]}"}}],
+            "messages": [mensaje]
+        }}]}]
+    }
+
+
+def sembrar_usuarios(almacen, cantidad, esquema_v1=False):
+    """
+    Crea estudiantes con un reto activo para que los envíos de código se evalúen.
+    Con `esquema_v1` los campos estructurados van como strings JSON (documentos
+    sin migrar, que se migran en su primera escritura).
+    """
+    from src.config.config import CURSOS
+    import src.database as db
+
+    numeros = []
+    for i in range(cantidad):
+        numero = f"57300{i:07d}"
+        numeros.append(numero)
+        usuario = {
+            "numero_telefono": numero, "nombre": f"Bench {i}", "nivel": 1, "puntos": 0,
+            "racha_dias": 1, "ultima_conexion": str(date.today()),
+            "estado_conversacion": "resolviendo_reto", "curso_actual": None, "leccion_actual": 0,
+            "intentos_fallidos": 0, "tematica_actual": CURSOS["java"]["lecciones"][0],
+            "tipo_reto_actual": "java", "dificultad_reto_actual": "Fácil",
+            "reto_actual_enunciado": "Suma dos enteros", "reto_actual_solucion": "int c = a + b;",
+            "reto_actual_pistas": ["Pista 1", "Pista 2", "Pista 3"], "pistas_usadas": 0,
+            "historial_chat": [], "progreso_temas": {}, "onboarding_completado": 1,
+            "logros_desbloqueados": [], "retos_completados": 0, "retos_sin_pistas": 0,
+            "class_token": None, "total_pistas_usadas": 0, "total_fallos": 0,
+            "schema_version": db.ESQUEMA_USUARIO,
+        }
+        if esquema_v1:
+            del usuario["schema_version"]
+            for campo in db.CAMPOS_ESTRUCTURADOS:
+                usuario[campo] = json.dumps(usuario[campo])
+        # Con su copia del dashboard, como la que deja crear_usuario
+        almacen.crear_usuario(numero, usuario, db._datos_publicos(numero, usuario))
+    return numeros
+
+
+def renumerar(body):
+    """Copia una entrega grabada con IDs nuevos, para que el dedup no la descarte al repetirla."""
+    copia = json.loads(json.dumps(body))
+    for entry in copia.get("entry", []):
+        for change in entry.get("changes", []):
+            for mensaje in change.get("value", {}).get("messages", []):
+                mensaje["id"] = f"wamid.in{next(_ids_mensaje)}"
+    return copia
+
+
+def ids_de_mensajes(body):
+    return [m["id"] for e in body.get("entry", []) for c in e.get("changes", [])
+            for m in c.get("value", {}).get("messages", []) if "id" in m]
+
+
+class Seguimiento:
+    """Relaciona cada mensaje enviado al webhook con el fin de su turno."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enviados = {}
+        self.terminados = {}
+        self.ingreso = []
+        self.codigos = {}
+
+    def instrumentar_handler(self):
+        import src.message_handler as handler
+        original = handler.procesar_mensaje_entrante
+
+        def _envoltura(message_data, *args, **kwargs):
+            try:
+                return original(message_data, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.terminados[message_data.get("id")] = time.perf_counter()
+
+        handler.procesar_mensaje_entrante = _envoltura
+
+    def latencias_turno(self):
+        with self._lock:
+            return [self.terminados[i] - t for i, t in self.enviados.items() if i in self.terminados]
+
+
+# --- DRIVER ASGI MÍNIMO (sin servidor HTTP ni dependencias extra) ---
+
+async def _post_asgi(app, ruta, cuerpo):
+    recibido = False
+    estado = {}
+
+    async def receive():
+        nonlocal recibido
+        if not recibido:
+            recibido = True
+            return {"type": "http.request", "body": cuerpo, "more_body": False}
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(mensaje):
+        if mensaje["type"] == "http.response.start":
+            estado["status"] = mensaje["status"]
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": ruta, "raw_path": ruta.encode(), "query_string": b"",
+        "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 0), "server": ("bench", 80),
+    }
+    await app(scope, receive, send)
+    return estado.get("status")
+
+
+async def _lifespan(app):
+    """Dispara los eventos startup/shutdown de la app. Retorna una función para apagarla."""
+    cola = asyncio.Queue()
+    listo = asyncio.Event()
+    await cola.put({"type": "lifespan.startup"})
+
+    async def receive():
+        return await cola.get()
+
+    async def send(mensaje):
+        if mensaje["type"] in ("lifespan.startup.complete", "lifespan.startup.failed"):
+            listo.set()
+
+    tarea = asyncio.create_task(app({"type": "lifespan", "asgi": {"version": "3.0"}}, receive, send))
+    await listo.wait()
+
+    async def apagar():
+        await cola.put({"type": "lifespan.shutdown"})
+        await tarea
+
+    return apagar
+
+
+async def ejecutar(args):
+    from src.main import app
+    from src import metrics
+    from src.scripts import bench_stubs
+    import src.database as db
+
+    almacen = bench_stubs.instalar(
+        latencia_firestore=args.latencia_firestore / 1000,
+        latencia_gemini=args.latencia_gemini / 1000,
+        latencia_graph=args.latencia_graph / 1000,
+        backend=args.backend,
+    )
+    if args.sin_pausas:
+        # Las pausas de cortesía entre mensajes (time.sleep) ocultan la latencia real
+        import types
+        import src.message_handler as handler
+        import src.message_components.onboarding as onboarding
+        sin_pausa = types.SimpleNamespace(sleep=lambda s: None, time=time.time)
+        handler.time = sin_pausa
+        onboarding.time = sin_pausa
+
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            entregas = [json.loads(linea) for linea in f if linea.strip()]
+        generador = itertools.cycle(entregas) if args.duracion else iter(entregas)
+
+        def siguiente():
+            body = next(generador, None)
+            return renumerar(body) if body is not None else None
+    else:
+        numeros = sembrar_usuarios(almacen, args.usuarios, args.esquema_v1)
+        siguiente = lambda: sintetizar_entrega(random.choice(numeros))
+
+    seguimiento = Seguimiento()
+    seguimiento.instrumentar_handler()
+    apagar = await _lifespan(app)
+    # Las llamadas del warmup y la siembra no cuentan como costo de los turnos
+    bench_stubs.llamadas.reiniciar()
+    if args.backend == "memoria":
+        almacen.reiniciar_conteos()
+
+    semaforo = asyncio.Semaphore(args.concurrencia)
+    intervalo = 1.0 / args.rps if args.rps else 0
+    fin = time.perf_counter() + args.duracion if args.duracion else None
+    tareas = []
+
+    async def enviar(body):
+        async with semaforo:
+            cuerpo = json.dumps(body).encode()
+            inicio = time.perf_counter()
+            for message_id in ids_de_mensajes(body):
+                seguimiento.enviados.setdefault(message_id, inicio)
+            status = await _post_asgi(app, "/webhook", cuerpo)
+            seguimiento.ingreso.append(time.perf_counter() - inicio)
+            seguimiento.codigos[status] = seguimiento.codigos.get(status, 0) + 1
+
+    inicio_total = time.perf_counter()
+    proximo = inicio_total
+    while fin is None or time.perf_counter() < fin:
+        body = siguiente()
+        if body is None:
+            break
+        tareas.append(asyncio.create_task(enviar(body)))
+        if intervalo:
+            proximo += intervalo
+            await asyncio.sleep(max(0, proximo - time.perf_counter()))
+        else:
+            await asyncio.sleep(0)
+    await asyncio.gather(*tareas)
+
+    # Esperamos a que los workers terminen los turnos encolados
+    limite = time.perf_counter() + args.espera_maxima
+    while len(seguimiento.terminados) < len(seguimiento.enviados) and time.perf_counter() < limite:
+        await asyncio.sleep(0.05)
+    duracion = time.perf_counter() - inicio_total
+    await apagar()
+
+    turnos = len(seguimiento.terminados)
+    reporte = {
+        "entregas_enviadas": len(seguimiento.ingreso),
+        "codigos_http": seguimiento.codigos,
+        "turnos_completados": turnos,
+        "turnos_pendientes": len(seguimiento.enviados) - turnos,
+        "duracion_s": round(duracion, 2),
+        "throughput_turnos_s": round(turnos / duracion, 2) if duracion else 0,
+        "ingreso_ms": percentiles(seguimiento.ingreso),
+        "turno_ms": percentiles(seguimiento.latencias_turno()),
+        "llamadas_por_turno": {
+            "firestore": round(bench_stubs.llamadas.total("firestore.") / max(turnos, 1), 2),
+            "gemini": round(bench_stubs.llamadas.total("gemini.") / max(turnos, 1), 2),
+            "graph": round(bench_stubs.llamadas.total("graph.") / max(turnos, 1), 2),
+        },
+        "llamadas_detalle": dict(bench_stubs.llamadas.conteos),
+        "cache_usuarios_hit_rate": round(db.tasa_aciertos_cache(), 3),
+        "usuarios_migrados": metrics.leer_contador("usuarios_migrados_total", {"origen": "escritura"}),
+    }
+    if args.backend == "memoria":
+        # AlmacenMemoria cuenta documentos leídos/escritos en vez de llamadas a Firestore
+        del reporte["llamadas_por_turno"]["firestore"]
+        for clave in ("lecturas", "escrituras"):
+            reporte["llamadas_por_turno"][clave] = round(almacen.conteos[clave] / max(turnos, 1), 2)
+        reporte["llamadas_detalle"].update(almacen.conteos)
+    return reporte
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark extremo a extremo del webhook de LogicBot")
+    parser.add_argument("--usuarios", type=int, default=100, help="Estudiantes sintéticos")
+    parser.add_argument("--rps", type=float, default=20, help="Entregas por segundo (0 = sin límite)")
+    parser.add_argument("--concurrencia", type=int, default=20, help="Peticiones al webhook en vuelo")
+    parser.add_argument("--duracion", type=float, default=20, help="Segundos de carga (0 = una pasada del replay)")
+    parser.add_argument("--replay", help="Archivo JSONL con entregas grabadas")
+    parser.add_argument("--backend", choices=["firestore", "memoria"], default="firestore",
+                        help="Firestore simulado (cuenta operaciones) o AlmacenMemoria (lecturas/escrituras)")
+    parser.add_argument("--esquema-v1", action="store_true",
+                        help="Siembra usuarios con el esquema viejo (campos como strings JSON)")
+    parser.add_argument("--latencia-firestore", type=float, default=20, help="ms por operación del almacenamiento")
+    parser.add_argument("--latencia-gemini", type=float, default=1500, help="ms por llamada")
+    parser.add_argument("--latencia-graph", type=float, default=150, help="ms por envío")
+    parser.add_argument("--sin-pausas", action="store_true", help="Desactiva los time.sleep de cortesía")
+    parser.add_argument("--espera-maxima", type=float, default=120, help="Segundos para drenar turnos")
+    parser.add_argument("--json", action="store_true", help="Imprime el reporte como JSON")
+    args = parser.parse_args()
+
+    reporte = asyncio.run(ejecutar(args))
+
+    if args.json:
+        print(json.dumps(reporte, indent=2, ensure_ascii=False))
+        return
+
+    print("=" * 70)
+    print("📊 LogicBot - Benchmark del Webhook")
+    print("=" * 70)
+    print(f"📨 Entregas enviadas:   {reporte['entregas_enviadas']}  {reporte['codigos_http']}")
+    print(f"✅ Turnos completados:  {reporte['turnos_completados']} (pendientes: {reporte['turnos_pendientes']})")
+    print(f"🚀 Throughput:          {reporte['throughput_turnos_s']} turnos/s en {reporte['duracion_s']}s")
+    print(f"📥 Ingreso (ms):        {reporte['ingreso_ms']}")
+    print(f"⏱️  Turno completo (ms): {reporte['turno_ms']}")
+    print(f"🔌 Llamadas por turno:  {reporte['llamadas_por_turno']}")
+    print(f"🗃️  Caché de usuarios:   {reporte['cache_usuarios_hit_rate']:.1%} de aciertos")
+    if reporte["usuarios_migrados"]:
+        print(f"🧬 Migrados al escribir: {reporte['usuarios_migrados']} usuario(s) del esquema 1")
+    print("=" * 70)
+    sys.exit(0 if reporte["turnos_pendientes"] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
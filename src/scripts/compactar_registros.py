@@ -0,0 +1,56 @@
+"""
+Resume por día y borra los logs de retos y alertas más viejos que la
+retención configurada (ver src/retencion.py).
+
+El servidor ya lo hace cada RETENCION_INTERVALO_HORAS; este script sirve
+para correrlo desde un cron (con RETENCION_INTERVALO_HORAS=0) o para la
+primera compactación de un despliegue con mucha historia. Toma el mismo
+lease que el servidor, así que no corre mientras otro proceso compacta (ni
+hasta el próximo ciclo del servidor, que lo conserva entre corridas).
+
+USO:
+    python -m src.scripts.compactar_registros                       # usa RETENCION_*_DIAS
+    python -m src.scripts.compactar_registros --logs-dias 180 --alertas-dias 90
+    python -m src.scripts.compactar_registros --simular             # solo cuenta
+"""
+
+import argparse
+import sys
+
+from src import retencion
+from src.config.config import RETENCION_ALERTAS_DIAS, RETENCION_LOGS_DIAS
+
+# Vida del lease si el script muere sin soltarlo
+_LEASE_SEGUNDOS = 6 * 3600
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compacta challenge_logs y alerts viejos en resúmenes diarios")
+    parser.add_argument("--logs-dias", type=int, default=RETENCION_LOGS_DIAS,
+                        help="Retención de challenge_logs en días (0 = no compactar)")
+    parser.add_argument("--alertas-dias", type=int, default=RETENCION_ALERTAS_DIAS,
+                        help="Retención de alerts en días (0 = no compactar)")
+    parser.add_argument("--simular", action="store_true", help="Cuenta los documentos sin tocarlos")
+    args = parser.parse_args()
+
+    if args.logs_dias <= 0 and args.alertas_dias <= 0:
+        print("❌ No hay retención configurada (RETENCION_LOGS_DIAS / RETENCION_ALERTAS_DIAS o --logs-dias / --alertas-dias)")
+        sys.exit(1)
+
+    # --simular solo lee: no hace falta excluir a nadie
+    if not args.simular and not retencion.adquirir_lease(_LEASE_SEGUNDOS):
+        print("❌ Otro proceso tiene el lease de la compactación (turnos_activos/retencion): "
+              "el servidor lo conserva hasta su próximo ciclo. Reintenta más tarde o corre "
+              "el servidor con RETENCION_INTERVALO_HORAS=0.")
+        sys.exit(1)
+    try:
+        procesados = retencion.compactar_todo(args.simular, args.logs_dias, args.alertas_dias)
+    finally:
+        if not args.simular:
+            retencion.liberar_lease()
+    print("=" * 70)
+    print(f"✅ {sum(procesados.values())} documentos {'a compactar' if args.simular else 'compactados'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Exporta los logs de retos (challenge_logs) a JSONL o Parquet por páginas,
+sin cargar la colección completa en memoria.
+
+Junto al destino queda un archivo de estado con el cursor del último log
+exportado: si se corta, correr el mismo comando sigue desde ahí, y correrlo
+más tarde agrega solo los logs nuevos. En Parquet el destino es un
+directorio de partes (parte-00000.parquet, ...) que pandas lee completo con
+pd.read_parquet(destino); necesita pyarrow.
+
+Los filtros --clase y --tema en Firestore requieren un índice compuesto
+(ver README). Los logs anteriores a que se guardara class_token no aparecen
+al filtrar por clase.
+
+USO:
+    python -m src.scripts.exportar_logs logs.jsonl
+    python -m src.scripts.exportar_logs logs.jsonl --clase ABC123 --desde 2025-03-01 --hasta 2025-07-01
+    python -m src.scripts.exportar_logs logs_parquet --formato parquet --tema "Arrays (Arreglos)"
+    python -m src.scripts.exportar_logs logs.jsonl --desde-cero      # ignora el estado guardado
+"""
+
+import argparse
+import sys
+import time
+
+from src import exportacion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta challenge_logs a JSONL o Parquet")
+    parser.add_argument("destino", help="Archivo JSONL o directorio Parquet")
+    parser.add_argument("--formato", choices=exportacion.FORMATOS, default="jsonl")
+    parser.add_argument("--clase", help="Solo logs de este class_token")
+    parser.add_argument("--tema", help="Solo logs de este tema")
+    parser.add_argument("--desde", help="Fecha ISO inicial, incluida (ej: 2025-03-01)")
+    parser.add_argument("--hasta", help="Fecha ISO final, excluida (ej: 2025-07-01)")
+    parser.add_argument("--lote", type=int, default=500, help="Logs por página")
+    parser.add_argument("--filas-por-parte", type=int, default=100000, help="Filas por archivo Parquet")
+    parser.add_argument("--desde-cero", action="store_true", help="Ignora el cursor guardado")
+    args = parser.parse_args()
+
+    filtros = exportacion.filtros(args.clase, args.tema, args.desde, args.hasta)
+    inicio = time.perf_counter()
+    try:
+        estado = exportacion.exportar(args.destino, args.formato, filtros, reanudar=not args.desde_cero,
+                                      lote=args.lote, filas_por_parte=args.filas_por_parte)
+    except (ValueError, RuntimeError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    print("=" * 70)
+    print(f"✅ {estado['registros']} logs en {args.destino} ({time.perf_counter() - inicio:.1f}s)")
+    print(f"   Último cursor: {estado['cursor']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,11 @@
 Script para mantener el servicio de Render despierto.
 Ejecuta pings cada 14 minutos para evitar que el servicio gratuito se suspenda.
 
+Ya no hace falta para ocultar el costo del arranque en frío: el startup abre
+las conexiones con Firestore, Gemini y la Graph API antes de aceptar tráfico
+(ver WARMUP_TIMEOUT_SEGUNDOS y benchmark_arranque.py). Solo es útil en el plan
+gratuito, que suspende el servicio tras 15 minutos sin peticiones.
+
 USO:
     python keep_alive.py https://chatbot-ai-logica-de-programacion.onrender.com
 """
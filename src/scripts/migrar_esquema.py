@@ -0,0 +1,95 @@
+"""
+Migra los documentos de usuario al esquema actual (database.ESQUEMA_USUARIO).
+
+En el esquema 1 historial_chat, progreso_temas, logros_desbloqueados y
+reto_actual_pistas se guardaban como strings JSON; desde el esquema 2 son
+mapas y arreglos nativos. El bot ya migra a cada usuario en su primera
+escritura, así que este script solo hace falta para los inactivos.
+
+Recorre la colección por páginas ordenadas por número y escribe cada página
+en una sola escritura atómica. Cada documento exige seguir en la versión
+leída: si un turno lo modificó mientras tanto, la página se reintenta uno a
+uno y el que cambió se omite (ese turno ya lo migró al escribir).
+
+USO:
+    python -m src.scripts.migrar_esquema                  # usa STORAGE_BACKEND
+    python -m src.scripts.migrar_esquema --simular        # solo cuenta
+    python -m src.scripts.migrar_esquema --desde 573001234567 --lote 200
+"""
+
+import argparse
+import sys
+import time
+
+from src import metrics
+import src.database as db
+from src.storage import obtener_almacen
+
+
+def migrar_pagina(almacen, pendientes, simular=False):
+    """
+    Escribe la migración de `pendientes` ({numero: (cambios, version)}).
+    Retorna (migrados, omitidos).
+    """
+    if simular or not pendientes:
+        return len(pendientes), 0
+    try:
+        almacen.actualizar_usuarios({n: c for n, (c, _) in pendientes.items()},
+                                    versiones={n: v for n, (_, v) in pendientes.items()})
+        return len(pendientes), 0
+    except Exception as e:
+        print(f"⚠️ La página no se pudo escribir junta ({e}); reintentando uno a uno...")
+
+    migrados = omitidos = 0
+    for numero, (cambios, version) in pendientes.items():
+        try:
+            almacen.actualizar_usuarios({numero: cambios}, versiones={numero: version})
+            migrados += 1
+        except Exception as e:
+            print(f"   ↪️ {numero} omitido: {e}")
+            omitidos += 1
+    return migrados, omitidos
+
+
+def migrar(lote=200, desde=None, simular=False):
+    almacen = obtener_almacen()
+    revisados = migrados = omitidos = 0
+    inicio = time.perf_counter()
+
+    while True:
+        pagina = almacen.listar_usuarios(desde=desde, limite=lote)
+        if not pagina:
+            break
+        pendientes = {}
+        for numero, datos, version in pagina:
+            if datos is not None and datos.get("schema_version", 1) < db.ESQUEMA_USUARIO:
+                pendientes[numero] = (db.cambios_de_migracion(db.normalizar_usuario(datos)), version)
+
+        ok, fallidos = migrar_pagina(almacen, pendientes, simular)
+        metrics.incrementar("usuarios_migrados_total", ok, etiquetas={"origen": "script"})
+        revisados += len(pagina)
+        migrados += ok
+        omitidos += fallidos
+        desde = pagina[-1][0]
+        # El último número sirve de cursor para retomar con --desde
+        print(f"📄 {revisados} revisados, {migrados} migrados, {omitidos} omitidos (cursor: {desde})")
+
+    print("=" * 70)
+    accion = "a migrar" if simular else "migrados"
+    print(f"✅ {revisados} usuarios revisados, {migrados} {accion}, {omitidos} omitidos "
+          f"en {time.perf_counter() - inicio:.1f}s")
+    return omitidos == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra usuarios al esquema de campos nativos")
+    parser.add_argument("--lote", type=int, default=200, help="Usuarios por página (máximo 500)")
+    parser.add_argument("--desde", help="Retoma después de este número (el cursor impreso)")
+    parser.add_argument("--simular", action="store_true", help="Cuenta los documentos a migrar sin escribir")
+    args = parser.parse_args()
+
+    sys.exit(0 if migrar(min(args.lote, 500), args.desde, args.simular) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Recalcula desde cero los agregados por clase (class_stats) a partir de los
+documentos de usuario.
+
+El bot mantiene los agregados con incrementos en cada escritura; este script
+los inicializa para las clases que ya tenían alumnos antes de existir, y
+corrige cualquier desvío. Los totales de logs de retos (`resultados`,
+`retos_sospechosos`) y `ultima_actividad` no se pueden derivar de los
+usuarios: se conservan tal como están en el documento actual.
+
+Conviene correrlo con poco tráfico: un turno que escriba mientras se
+recorren los usuarios puede quedar contado dos veces o ninguna.
+
+USO:
+    python -m src.scripts.reconstruir_clases                  # todas las clases
+    python -m src.scripts.reconstruir_clases --clase ABC123   # solo esa clase
+    python -m src.scripts.reconstruir_clases --simular        # solo muestra los totales
+"""
+
+import argparse
+import sys
+import time
+
+import src.database as db
+from src import estadisticas_clase
+from src.storage import obtener_almacen
+from src.storage.base import Incremento, combinar, resolver
+
+# Campos del agregado que no salen de los usuarios
+_CAMPOS_DE_LOGS = ("resultados", "retos_sospechosos", "ultima_actividad")
+
+
+def agregados_por_clase(almacen, clase=None, lote=500):
+    """Recorre los usuarios por páginas y suma sus aportes por class_token."""
+    sumas = {}
+    desde = None
+    while True:
+        pagina = almacen.listar_usuarios(desde=desde, limite=lote)
+        if not pagina:
+            return {token: resolver({}, cambios) for token, cambios in sumas.items()}
+        for _, datos, _ in pagina:
+            token = (datos or {}).get("class_token")
+            if not token or (clase and token != clase):
+                continue
+            aportes = estadisticas_clase.aportes(db.normalizar_usuario(datos))
+            combinar(sumas.setdefault(token, {}), {ruta: Incremento(valor) for ruta, valor in aportes.items()})
+        desde = pagina[-1][0]
+
+
+def reconstruir(clase=None, simular=False):
+    almacen = obtener_almacen()
+    inicio = time.perf_counter()
+    clases = agregados_por_clase(almacen, clase)
+
+    for token, datos in clases.items():
+        actual = almacen.leer_clase(token) or {}
+        datos.update({campo: actual[campo] for campo in _CAMPOS_DE_LOGS if campo in actual})
+        print(f"🏫 {token}: {datos['alumnos']} alumnos, {datos['puntos_total']} puntos")
+        if not simular:
+            almacen.reemplazar_clase(token, datos)
+
+    print("=" * 70)
+    accion = "a reconstruir" if simular else "reconstruidas"
+    print(f"✅ {len(clases)} clases {accion} en {time.perf_counter() - inicio:.1f}s")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcula los agregados por clase desde los usuarios")
+    parser.add_argument("--clase", help="Solo este class_token")
+    parser.add_argument("--simular", action="store_true", help="Muestra los totales sin escribir")
+    args = parser.parse_args()
+
+    sys.exit(0 if reconstruir(args.clase, args.simular) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Reescribe la copia pública de los usuarios (users_sync) a partir de sus
+documentos en usuarios.
+
+El bot solo toca users_sync cuando un alumno escribe, y si esa escritura
+falla el error apenas se imprime. Este script repara la copia de todos de
+una vez: después de cambiar los campos de database._datos_publicos, o si
+el Dashboard muestra datos viejos.
+
+Recorre los usuarios por páginas ordenadas por número; cada página se
+compara y se escribe en un hilo aparte mientras se lee la siguiente. Cada
+copia se compara por checksum con la proyección que le corresponde y solo
+se reescriben las que faltan o difieren (set completo, en WriteBatch de
+hasta 500), así que volver a correrlo cuesta casi solo lecturas.
+
+Conviene correrlo con poco tráfico: si un turno escribe entre la lectura de
+un alumno y la escritura de su copia, la copia puede quedar un paso atrás
+hasta su próximo mensaje (o hasta correrlo otra vez).
+
+USO:
+    python -m src.scripts.resincronizar_dashboard --simular          # solo cuenta
+    python -m src.scripts.resincronizar_dashboard --hilos 8
+    python -m src.scripts.resincronizar_dashboard --max-por-segundo 500
+    python -m src.scripts.resincronizar_dashboard --desde 573001234567  # retoma desde el cursor
+    python -m src.scripts.resincronizar_dashboard --todos            # reescribe aunque estén iguales
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from src import metrics
+import src.database as db
+from src.storage import obtener_almacen
+
+
+def huella(publicos):
+    """Checksum de una copia pública (sin importar el orden de los campos)."""
+    if publicos is None:
+        return None
+    texto = json.dumps(publicos, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(texto.encode("utf-8")).hexdigest()
+
+
+class Ritmo:
+    """Reparte las escrituras para no pasar de `por_segundo` (0 = sin límite)."""
+
+    def __init__(self, por_segundo):
+        self.por_segundo = por_segundo
+        self.inicio = time.monotonic()
+        self.reservadas = 0
+        self._lock = threading.Lock()
+
+    def esperar(self, cantidad):
+        if self.por_segundo <= 0:
+            return
+        with self._lock:
+            turno = self.inicio + self.reservadas / self.por_segundo
+            self.reservadas += cantidad
+        demora = turno - time.monotonic()
+        if demora > 0:
+            time.sleep(demora)
+
+
+def resincronizar_pagina(almacen, pagina, ritmo, simular=False, todos=False):
+    """
+    Compara y reescribe las copias de una página de listar_usuarios.
+    Retorna (escritas, iguales).
+    """
+    proyecciones = {numero: db.proyeccion_dashboard(numero, datos)
+                    for numero, datos, _ in pagina if datos is not None}
+    if not proyecciones:
+        return 0, 0
+    if todos:
+        distintas = proyecciones
+    else:
+        copias = almacen.leer_dashboards(list(proyecciones))
+        distintas = {numero: publicos for numero, publicos in proyecciones.items()
+                     if huella(publicos) != huella(copias.get(numero))}
+    if distintas and not simular:
+        ritmo.esperar(len(distintas))
+        almacen.reemplazar_dashboards(distintas)
+        metrics.incrementar("dashboard_resync_total", len(distintas), {"resultado": "escrito"})
+    metrics.incrementar("dashboard_resync_total", len(proyecciones) - len(distintas), {"resultado": "igual"})
+    return len(distintas), len(proyecciones) - len(distintas)
+
+
+def _desde_texto(inicio):
+    return f"después de {inicio}" if inicio is not None else "inicial"
+
+
+def resincronizar(lote=500, desde=None, hilos=4, por_segundo=0, simular=False, todos=False):
+    almacen = obtener_almacen()
+    ritmo = Ritmo(por_segundo)
+    revisados = escritos = iguales = fallidos = 0
+    inicio = time.perf_counter()
+    # El cursor solo avanza sobre páginas terminadas sin error y en orden,
+    # así --desde <cursor> nunca saltea una página pendiente o fallida
+    cursor, listas, siguiente, indice = desde, {}, 0, 0
+    en_curso = {}
+    # (índice, cursor de inicio) de la primera página fallida
+    primer_fallo = None
+
+    def _recoger(terminados):
+        nonlocal revisados, escritos, iguales, fallidos, cursor, siguiente, primer_fallo
+        for futuro in terminados:
+            numero_pagina, inicio_pagina, ultimo, tamano = en_curso.pop(futuro)
+            revisados += tamano
+            try:
+                ok, igual = futuro.result()
+                escritos += ok
+                iguales += igual
+                listas[numero_pagina] = ultimo
+            except Exception as e:
+                fallidos += tamano
+                metrics.incrementar("dashboard_resync_total", tamano, {"resultado": "fallido"})
+                print(f"⚠️ Página {_desde_texto(inicio_pagina)} sin sincronizar: {e}")
+                if primer_fallo is None or numero_pagina < primer_fallo[0]:
+                    primer_fallo = (numero_pagina, inicio_pagina)
+            while siguiente in listas:
+                cursor = listas.pop(siguiente)
+                siguiente += 1
+        ritmo_actual = revisados / max(time.perf_counter() - inicio, 1e-9)
+        print(f"📄 {revisados} revisados, {escritos} {'a escribir' if simular else 'escritos'}, "
+              f"{iguales} iguales, {fallidos} fallidos ({ritmo_actual:.0f}/s, cursor: {cursor})")
+
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="resync") as ejecutor:
+        while True:
+            pagina = almacen.listar_usuarios(desde=desde, limite=lote)
+            if not pagina:
+                break
+            futuro = ejecutor.submit(resincronizar_pagina, almacen, pagina, ritmo, simular, todos)
+            en_curso[futuro] = (indice, desde, pagina[-1][0], len(pagina))
+            indice += 1
+            desde = pagina[-1][0]
+            # Como mucho dos páginas por hilo en memoria
+            if len(en_curso) >= hilos * 2:
+                _recoger(wait(en_curso, return_when=FIRST_COMPLETED).done)
+            if len(pagina) < lote:
+                break
+        while en_curso:
+            _recoger(wait(en_curso, return_when=FIRST_COMPLETED).done)
+
+    print("=" * 70)
+    accion = "a escribir" if simular else "reescritas"
+    print(f"✅ {revisados} usuarios revisados, {escritos} copias {accion}, {iguales} iguales, "
+          f"{fallidos} fallidos en {time.perf_counter() - inicio:.1f}s")
+    if primer_fallo is not None:
+        inicio_fallo = primer_fallo[1]
+        print(f"   Para reintentar: --desde {inicio_fallo}" if inicio_fallo is not None
+              else "   Para reintentar: correrlo otra vez sin --desde (falló la primera página)")
+    return fallidos == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reescribe users_sync desde los documentos de usuario")
+    parser.add_argument("--lote", type=int, default=500, help="Usuarios por página (máximo 500)")
+    parser.add_argument("--desde", help="Retoma después de este número (el cursor impreso)")
+    parser.add_argument("--hilos", type=int, default=4, help="Páginas que se comparan y escriben en paralelo")
+    parser.add_argument("--max-por-segundo", type=int, default=0,
+                        help="Máximo de copias escritas por segundo (0 = sin límite)")
+    parser.add_argument("--simular", action="store_true", help="Cuenta las copias a reescribir sin escribir")
+    parser.add_argument("--todos", action="store_true", help="Reescribe todas las copias, sin comparar")
+    args = parser.parse_args()
+
+    ok = resincronizar(min(args.lote, 500), args.desde, max(args.hilos, 1), args.max_por_segundo,
+                       args.simular, args.todos)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
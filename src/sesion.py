@@ -0,0 +1,138 @@
+# sesion.py
+# SesionUsuario: el usuario tal como lo ve un turno. La unidad de trabajo
+# (unit_of_work.py) arma una sola por usuario y turno sobre el documento
+# leído, sin copiarlo, y db.obtener_usuario la retorna durante el resto del
+# turno.
+#
+# - Los campos se leen como atributos (usuario.puntos, usuario.historial_chat)
+#   y, si faltan en el documento, valen lo mismo que en un usuario nuevo.
+# - Cada campo se materializa la primera vez que se lee: los mapas y arreglos
+#   se decodifican (strings JSON de los documentos v1) o se copian una sola
+#   vez; lo que el turno no lee no se toca.
+# - Asignar un atributo (o usar actualizar()) lo marca como sucio; la unidad
+#   de trabajo recoge los campos sucios antes de cada cambio que pasa por
+#   db.actualizar_usuario y al confirmar, así se escriben en orden.
+# - Los cambios de db.actualizar_usuario (Incremento, rutas...) también se
+#   aplican aquí, así el turno ve su propio progreso.
+#
+# Los mapas y arreglos no se modifican en el lugar: se asigna uno nuevo.
+
+import json
+
+from src.database import CAMPOS_ESTRUCTURADOS
+from src.storage.base import raiz, resolver
+
+# Campos del documento de usuario y su valor si faltan (ver db._nuevo_usuario).
+# Los de CAMPOS_ESTRUCTURADOS valen un mapa o arreglo vacío.
+CAMPOS = {
+    "numero_telefono": None,
+    "nombre": None,
+    "nivel": 1,
+    "puntos": 0,
+    "racha_dias": 0,
+    "ultima_conexion": None,
+    "estado_conversacion": "menu_principal",
+    "curso_actual": None,
+    "leccion_actual": 0,
+    "intentos_fallidos": 0,
+    "tematica_actual": None,
+    "tipo_reto_actual": None,
+    "dificultad_reto_actual": None,
+    "reto_actual_enunciado": None,
+    "reto_actual_solucion": None,
+    "reto_actual_pistas": None,
+    "pistas_usadas": 0,
+    "historial_chat": None,
+    "progreso_temas": None,
+    "onboarding_completado": 0,
+    "preferencia_aprendizaje": None,
+    "nivel_inicial": None,
+    "logros_desbloqueados": None,
+    "retos_completados": 0,
+    "retos_sin_pistas": 0,
+    "class_token": None,
+    "total_pistas_usadas": 0,
+    "total_fallos": 0,
+    "pregunta_defensa_actual": None,
+    "timestamp_inicio_reto": None,
+    "tiempo_estimado_ia": 60,
+}
+
+_FALTA = object()
+
+
+def _decodificar(campo, valor):
+    tipo = CAMPOS_ESTRUCTURADOS[campo]
+    if isinstance(valor, str):
+        # Documento v1 que no pasó por db.normalizar_usuario
+        try:
+            valor = json.loads(valor)
+        except ValueError:
+            return tipo()
+        return valor if isinstance(valor, tipo) else tipo()
+    if not isinstance(valor, tipo):
+        return tipo()
+    # Copia de dos niveles: alcanza para el historial ([{"usuario": ...}]) y
+    # el progreso ({tema: {"puntos", "nivel"}}) sin un deepcopy completo
+    if tipo is list:
+        return [dict(v) if isinstance(v, dict) else v for v in valor]
+    return {k: dict(v) if isinstance(v, dict) else v for k, v in valor.items()}
+
+
+class SesionUsuario:
+    """Vista del usuario durante un turno, con campos perezosos y marcas de cambios."""
+
+    __slots__ = tuple(CAMPOS) + ("_documento", "_sucios")
+
+    def __init__(self, documento):
+        # El documento se comparte con la caché: nunca se modifica
+        object.__setattr__(self, "_documento", documento)
+        object.__setattr__(self, "_sucios", {})
+
+    def __getattr__(self, campo):
+        # Solo se llama si el slot aún no tiene valor: primera lectura del campo
+        if campo not in CAMPOS:
+            raise AttributeError(campo)
+        valor = self._documento.get(campo, _FALTA)
+        if campo in CAMPOS_ESTRUCTURADOS:
+            valor = _decodificar(campo, valor)
+        elif valor is _FALTA:
+            valor = CAMPOS[campo]
+        object.__setattr__(self, campo, valor)
+        return valor
+
+    def __setattr__(self, campo, valor):
+        if campo not in CAMPOS:
+            raise AttributeError(f"SesionUsuario no tiene el campo '{campo}'")
+        object.__setattr__(self, campo, valor)
+        self._sucios[campo] = None
+
+    def __repr__(self):
+        return f"SesionUsuario({self.numero_telefono!r}, sucios={list(self._sucios)})"
+
+    def get(self, campo, defecto=None):
+        """Lectura al estilo dict, para código que recibe documentos o sesiones."""
+        if campo in CAMPOS:
+            return getattr(self, campo)
+        return self._documento.get(campo, defecto)
+
+    def actualizar(self, **campos):
+        """Asigna varios campos de una vez (todos quedan sucios)."""
+        for campo, valor in campos.items():
+            setattr(self, campo, valor)
+
+    def tomar_cambios(self):
+        """Retorna {campo: valor} de los campos sucios y los deja limpios."""
+        cambios = {campo: getattr(self, campo) for campo in self._sucios}
+        self._sucios.clear()
+        return cambios
+
+    def aplicar(self, cambios):
+        """Refleja cambios ya registrados en otro lado (sin marcarlos como sucios)."""
+        por_campo = {}
+        for campo, valor in cambios.items():
+            por_campo.setdefault(raiz(campo), {})[campo] = valor
+        for campo, suyos in por_campo.items():
+            if campo in CAMPOS:
+                valor = resolver({campo: getattr(self, campo)}, suyos)[campo]
+                object.__setattr__(self, campo, valor)
@@ -0,0 +1,57 @@
+# storage/__init__.py
+# Backends de persistencia intercambiables (ver base.py).
+# STORAGE_BACKEND elige cuál usa el proceso; cada adaptador se importa solo
+# si se usa, así SQLite o memoria no cargan firebase_admin.
+
+import threading
+
+from src.config.config import STORAGE_BACKEND, STORAGE_SQLITE_RUTA
+from .base import Almacen, AlmacenNoDisponible, Borrado, ConflictoDeVersion, Incremento, Maximo, UnionArreglo
+
+_almacen = None
+_lock = threading.Lock()
+
+
+def crear_almacen(nombre=STORAGE_BACKEND):
+    """Construye el backend `nombre` ("firestore", "sqlite" o "memoria")."""
+    if nombre == "firestore":
+        from .firestore_store import AlmacenFirestore
+        return AlmacenFirestore()
+    if nombre == "sqlite":
+        from .sqlite_store import AlmacenSqlite
+        return AlmacenSqlite(STORAGE_SQLITE_RUTA)
+    if nombre == "memoria":
+        from .memory_store import AlmacenMemoria
+        return AlmacenMemoria()
+    raise ValueError(f"STORAGE_BACKEND desconocido: {nombre!r} (usa firestore, sqlite o memoria)")
+
+
+def obtener_almacen():
+    """Retorna el backend del proceso, creándolo una sola vez de forma thread-safe."""
+    global _almacen
+    if _almacen is None:
+        with _lock:
+            if _almacen is None:
+                _almacen = crear_almacen()
+    return _almacen
+
+
+def instalar(almacen):
+    """Reemplaza el backend del proceso (benchmarks y scripts)."""
+    global _almacen
+    with _lock:
+        _almacen = almacen
+    return almacen
+
+
+__all__ = [
+    'Almacen',
+    'AlmacenNoDisponible',
+    'ConflictoDeVersion',
+    'Incremento',
+    'Maximo',
+    'UnionArreglo',
+    'crear_almacen',
+    'obtener_almacen',
+    'instalar'
+]
@@ -0,0 +1,315 @@
+# storage/base.py
+# Interfaz común de los backends de persistencia.
+# database.py conserva la lógica del bot (caché de usuarios, unidad de trabajo,
+# qué va al dashboard) y delega en un Almacen la lectura y escritura.
+#
+# Las "versiones" que retornan los métodos son comparables entre sí dentro de
+# un mismo backend (update_time en Firestore, un entero en SQLite y memoria);
+# la caché de usuarios las usa para no reemplazar un documento por otro más viejo.
+#
+# En los `datos` de actualizar_usuario y del dashboard un campo puede llevar,
+# en vez de un valor, un Incremento, un Maximo o una UnionArreglo: el backend
+# lo aplica sobre el valor que tenga guardado en ese momento (Increment,
+# Maximum y ArrayUnion en Firestore, dentro de la transacción en SQLite), así
+# dos turnos concurrentes no se pisan. Un Borrado quita el campo
+# (DELETE_FIELD en Firestore).
+#
+# La clave puede ser también una tupla con la ruta a un campo anidado, ej:
+# ("progreso_temas", "Arrays (Arreglos)", "puntos"); solo se toca esa hoja del
+# mapa y el resto se conserva.
+#
+# Las variantes *_async sirven al código que corre en el event loop: por
+# defecto ejecutan el método bloqueante en un hilo (asyncio.to_thread); un
+# backend con cliente asíncrono propio (Firestore) las reemplaza.
+
+import asyncio
+from abc import ABC, abstractmethod
+
+
+class Incremento:
+    """Suma `valor` al campo guardado (0 si no existe)."""
+
+    __slots__ = ("valor",)
+
+    def __init__(self, valor):
+        self.valor = valor
+
+    def __eq__(self, otro):
+        return isinstance(otro, Incremento) and otro.valor == self.valor
+
+    def __repr__(self):
+        return f"Incremento({self.valor!r})"
+
+
+class Maximo:
+    """Deja en el campo el mayor entre `valor` y lo guardado (el nivel nunca baja)."""
+
+    __slots__ = ("valor",)
+
+    def __init__(self, valor):
+        self.valor = valor
+
+    def __eq__(self, otro):
+        return isinstance(otro, Maximo) and otro.valor == self.valor
+
+    def __repr__(self):
+        return f"Maximo({self.valor!r})"
+
+
+class UnionArreglo:
+    """Agrega al arreglo guardado los `valores` que todavía no tiene."""
+
+    __slots__ = ("valores",)
+
+    def __init__(self, valores):
+        self.valores = list(valores)
+
+    def __eq__(self, otro):
+        return isinstance(otro, UnionArreglo) and otro.valores == self.valores
+
+    def __repr__(self):
+        return f"UnionArreglo({self.valores!r})"
+
+
+class Borrado:
+    """Quita el campo guardado (o la hoja de la ruta); si no existe no hace nada."""
+
+    __slots__ = ()
+
+    def __eq__(self, otro):
+        return isinstance(otro, Borrado)
+
+    def __repr__(self):
+        return "Borrado()"
+
+
+def es_transformacion(valor):
+    return isinstance(valor, (Incremento, Maximo, UnionArreglo))
+
+
+def ruta(campo):
+    """Ruta de un campo como tupla: "puntos" -> ("puntos",)."""
+    return campo if isinstance(campo, tuple) else (campo,)
+
+
+def raiz(campo):
+    """Campo de primer nivel al que pertenece `campo`."""
+    return campo[0] if isinstance(campo, tuple) else campo
+
+
+def _aplicar(actual, valor):
+    if isinstance(valor, Incremento):
+        return (actual or 0) + valor.valor
+    if isinstance(valor, Maximo):
+        return valor.valor if actual is None else max(actual, valor.valor)
+    if isinstance(valor, UnionArreglo):
+        actual = list(actual or [])
+        return actual + [v for v in valor.valores if v not in actual]
+    return valor
+
+
+def resolver(documento, cambios):
+    """
+    Retorna una copia de `documento` con `cambios` aplicados (transformaciones
+    y rutas anidadas incluidas). Los mapas de la ruta se copian; `documento`
+    no se modifica.
+    """
+    resultado = dict(documento or {})
+    for campo, valor in cambios.items():
+        partes = ruta(campo)
+        nodo = resultado
+        for parte in partes[:-1]:
+            hijo = nodo.get(parte)
+            if isinstance(valor, Borrado) and not isinstance(hijo, dict):
+                break  # no hay nada que borrar: no se crea la ruta
+            nodo[parte] = dict(hijo) if isinstance(hijo, dict) else {}
+            nodo = nodo[parte]
+        else:
+            if isinstance(valor, Borrado):
+                nodo.pop(partes[-1], None)
+            else:
+                nodo[partes[-1]] = _aplicar(nodo.get(partes[-1]), valor)
+    return resultado
+
+
+def combinar(cambios, nuevos):
+    """
+    Acumula `nuevos` sobre `cambios` (in situ) como si se aplicaran en
+    secuencia: dos Incrementos se suman, un valor fijo absorbe la
+    transformación que le sigue y un valor fijo nuevo pisa al anterior.
+    Un campo nuevo reemplaza los cambios pendientes de sus subcampos, y un
+    subcampo de un mapa que ya se va a escribir entero se aplica sobre él
+    (Firestore no acepta "a" y "a.b" en la misma escritura).
+    """
+    for campo, valor in nuevos.items():
+        partes = ruta(campo)
+        for otro in [k for k in cambios if len(ruta(k)) > len(partes) and ruta(k)[:len(partes)] == partes]:
+            del cambios[otro]
+        padre = next((k for k in cambios if len(ruta(k)) < len(partes) and partes[:len(ruta(k))] == ruta(k)),
+                     None)
+        if padre is not None and not es_transformacion(cambios[padre]):
+            cambios[padre] = resolver({"": cambios[padre]}, {("",) + partes[len(ruta(padre)):]: valor})[""]
+            continue
+
+        anterior = cambios.get(campo)
+        if campo not in cambios or not es_transformacion(valor):
+            cambios[campo] = valor
+        elif isinstance(valor, Incremento) and isinstance(anterior, Incremento):
+            cambios[campo] = Incremento(anterior.valor + valor.valor)
+        elif isinstance(valor, Maximo) and isinstance(anterior, Maximo):
+            cambios[campo] = Maximo(max(anterior.valor, valor.valor))
+        elif isinstance(valor, UnionArreglo) and isinstance(anterior, UnionArreglo):
+            cambios[campo] = UnionArreglo(_aplicar(anterior.valores, valor))
+        elif not es_transformacion(anterior):
+            cambios[campo] = _aplicar(anterior, valor)
+        else:
+            # Dos transformaciones distintas sobre el mismo campo no caben en
+            # una sola escritura; no ocurre con los campos del bot
+            cambios[campo] = valor
+    return cambios
+
+
+class AlmacenNoDisponible(Exception):
+    """El backend no pudo conectarse (ej: faltan las credenciales de Firebase)."""
+
+
+class ConflictoDeVersion(Exception):
+    """Un usuario cambió desde que se leyó (ver Almacen.actualizar_usuarios)."""
+
+
+class Almacen(ABC):
+    """Operaciones de persistencia que usa el bot. Los errores se propagan como excepciones."""
+
+    nombre = "base"
+    # Otros procesos pueden escribir los mismos documentos (ver obtener_usuario)
+    compartido = True
+
+    def calentar(self):
+        """Abre las conexiones antes del primer turno. Por defecto no hace nada."""
+
+    # --- USUARIOS ---
+
+    @abstractmethod
+    def leer_usuario(self, numero):
+        """Retorna (datos | None, version); datos incluye 'numero_telefono'."""
+
+    @abstractmethod
+    def leer_usuarios(self, numeros):
+        """Lee varios usuarios en una sola operación: {numero: (datos | None, version)}."""
+
+    @abstractmethod
+    def crear_usuario(self, numero, datos, publicos):
+        """Crea (o reemplaza) al usuario y su copia del dashboard juntos. Retorna la versión."""
+
+    @abstractmethod
+    def actualizar_usuario(self, numero, datos, cambios_publicos=None):
+        """
+        Aplica `datos` al usuario (que debe existir) y, si se pasan, mezcla
+        `cambios_publicos` en su copia del dashboard en la misma operación
+        atómica. Ambos pueden traer transformaciones; `datos`, además, rutas
+        anidadas. Retorna la nueva versión.
+        """
+
+    @abstractmethod
+    def actualizar_usuarios(self, cambios_por_usuario, versiones=None):
+        """
+        Aplica {numero: datos} a varios usuarios en una sola escritura atómica
+        (hasta 500). Con `versiones` ({numero: version}) cada usuario debe
+        seguir en la versión leída; si alguno cambió, no se aplica nada y se
+        lanza una excepción.
+        """
+
+    @abstractmethod
+    def listar_usuarios(self, desde=None, limite=500):
+        """
+        Una página de usuarios ordenados por número, a partir del siguiente a
+        `desde`: lista de (numero, datos, version). Vacía al terminar.
+        """
+
+    # --- VARIANTES ASÍNCRONAS ---
+
+    async def leer_usuario_async(self, numero):
+        return await asyncio.to_thread(self.leer_usuario, numero)
+
+    async def leer_usuarios_async(self, numeros):
+        return await asyncio.to_thread(self.leer_usuarios, numeros)
+
+    async def crear_usuario_async(self, numero, datos, publicos):
+        return await asyncio.to_thread(self.crear_usuario, numero, datos, publicos)
+
+    async def actualizar_usuario_async(self, numero, datos, cambios_publicos=None):
+        return await asyncio.to_thread(self.actualizar_usuario, numero, datos, cambios_publicos)
+
+    # --- DASHBOARD (users_sync) ---
+
+    @abstractmethod
+    def escribir_dashboard(self, cambios_por_usuario):
+        """Mezcla campos en las copias de varios usuarios ({numero: {campo: valor}})."""
+
+    @abstractmethod
+    def reemplazar_dashboard(self, numero, publicos):
+        """Reescribe la copia completa de un usuario."""
+
+    @abstractmethod
+    def leer_dashboards(self, numeros):
+        """Copias de varios usuarios en una lectura: {numero: datos o None}."""
+
+    @abstractmethod
+    def reemplazar_dashboards(self, publicos_por_usuario):
+        """Reescribe las copias completas de varios usuarios ({numero: publicos})."""
+
+    # --- ESTADÍSTICAS POR CLASE (class_stats) ---
+
+    @abstractmethod
+    def escribir_clases(self, cambios_por_clase):
+        """
+        Mezcla cambios en los agregados de varias clases ({class_token:
+        {campo o ruta: valor}}), creando el documento si no existe.
+        """
+
+    @abstractmethod
+    def leer_clase(self, token):
+        """Retorna los agregados de la clase o None."""
+
+    @abstractmethod
+    def reemplazar_clase(self, token, datos):
+        """Reescribe los agregados completos de una clase."""
+
+    # --- REGISTROS DE ANALÍTICA (challenge_logs, alerts) ---
+
+    @abstractmethod
+    def escribir_registros(self, registros):
+        """Escribe juntos una lista de (coleccion, doc_id, datos); reescribir un ID no duplica."""
+
+    @abstractmethod
+    def listar_registros(self, coleccion, iguales=None, desde=None, hasta=None, despues_de=None, limite=500,
+                         campo="timestamp"):
+        """
+        Una página de registros ordenados por (`campo`, doc_id): lista de
+        (doc_id, datos). `iguales` filtra por {campo: valor}, `desde`/`hasta`
+        acotan `campo` (hasta excluido) y `despues_de` es el (valor, doc_id)
+        del último registro de la página anterior. Vacía al terminar.
+        """
+
+    @abstractmethod
+    def compactar_registros(self, acumulados, borrados):
+        """
+        En una sola escritura atómica (hasta 500 documentos): mezcla los
+        cambios de `acumulados` ({(coleccion, doc_id): {campo o ruta: valor}},
+        creando el documento si no existe) y borra los (coleccion, doc_id) de
+        `borrados`.
+        """
+
+    # --- COORDINACIÓN ENTRE PROCESOS ---
+
+    @abstractmethod
+    def reclamar_mensaje(self, message_id, ttl_segundos):
+        """Marca el messages[].id como procesado. False si otro ya lo había reclamado."""
+
+    @abstractmethod
+    def adquirir_turno(self, numero, propietario, ttl_segundos):
+        """Toma (o renueva) el lease del usuario. False si otro lo tiene vigente."""
+
+    @abstractmethod
+    def liberar_turno(self, numero, propietario):
+        """Libera el lease solo si todavía pertenece a `propietario`."""
@@ -0,0 +1,388 @@
+# storage/firestore_store.py
+# Backend de producción: Firebase Firestore.
+#
+# Las variantes *_async usan el AsyncClient de Firestore, que queda atado al
+# event loop donde se usa por primera vez: solo deben llamarse desde el loop
+# de FastAPI (los hilos de los turnos usan el cliente bloqueante).
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import firebase_admin
+from firebase_admin import credentials, firestore, firestore_async
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from src import metrics
+from src.storage.base import Almacen, AlmacenNoDisponible, Borrado, Incremento, Maximo, UnionArreglo
+
+CREDENTIALS_FILE = "firebase_credentials.json"
+
+COLLECTION_USERS = "usuarios"
+# IDs de mensajes de WhatsApp ya procesados (deduplicación entre procesos).
+# Configurar una política TTL de Firestore sobre el campo 'expira_en'.
+COLLECTION_MENSAJES_PROCESADOS = "mensajes_procesados"
+# Lease por usuario para que un solo proceso procese sus turnos a la vez
+COLLECTION_TURNOS_ACTIVOS = "turnos_activos"
+# ID de la app para sincronización con el Dashboard Web
+# Debe coincidir con el usado en el frontend React
+APP_ID_DASHBOARD = "default-logicbot"
+
+# Máximo de escrituras por WriteBatch
+_LIMITE_BATCH = 500
+
+
+def _conectar():
+    if not firebase_admin._apps:
+        try:
+            if os.path.exists(CREDENTIALS_FILE):
+                cred = credentials.Certificate(CREDENTIALS_FILE)
+                firebase_admin.initialize_app(cred)
+                print("🔥 Firebase inicializado con archivo local.")
+            else:
+                print("⚠️ No se encontró firebase_credentials.json. Intentando credenciales por defecto...")
+                firebase_admin.initialize_app()
+                print("🔥 Firebase inicializado (Default Credentials).")
+        except Exception as e:
+            print(f"❌ Error inicializando Firebase: {e}")
+
+    try:
+        return firestore.client()
+    except Exception:
+        print("❌ No se pudo conectar a Firestore. Verifica las credenciales.")
+        return None
+
+
+def _a_firestore(datos):
+    # Incremento/Maximo/UnionArreglo -> transformaciones que Firestore aplica en
+    # el servidor, Borrado -> DELETE_FIELD; rutas (tuplas) -> field paths con las partes entre backticks
+    # cuando hace falta (los temas llevan espacios y paréntesis)
+    convertidos = {}
+    for campo, valor in datos.items():
+        if isinstance(valor, Incremento):
+            valor = firestore.Increment(valor.valor)
+        elif isinstance(valor, Maximo):
+            valor = firestore.Maximum(valor.valor)
+        elif isinstance(valor, UnionArreglo):
+            valor = firestore.ArrayUnion(valor.valores)
+        elif isinstance(valor, Borrado):
+            valor = firestore.DELETE_FIELD
+        if isinstance(campo, tuple):
+            campo = FieldPath(*campo).to_api_repr()
+        convertidos[campo] = valor
+    return convertidos
+
+
+def _anidar(datos):
+    # set(merge=True) no interpreta field paths: las rutas van como mapas
+    # anidados (merge solo toca las hojas presentes)
+    anidados = {}
+    for campo, valor in datos.items():
+        partes = campo if isinstance(campo, tuple) else (campo,)
+        nodo = anidados
+        for parte in partes[:-1]:
+            nodo = nodo.setdefault(parte, {})
+        nodo[partes[-1]] = next(iter(_a_firestore({"": valor}).values()))
+    return anidados
+
+
+def ruta_publica(coleccion):
+    # Colecciones públicas del dashboard: artifacts/{APP_ID}/public/data/{coleccion}
+    return f"artifacts/{APP_ID_DASHBOARD}/public/data/{coleccion}"
+
+
+class AlmacenFirestore(Almacen):
+    nombre = "firestore"
+
+    def __init__(self, cliente=None, cliente_async=None):
+        # El cliente se crea en el primer uso (o en el warmup del arranque), no al importar
+        self._cliente = cliente
+        self._inicializado = cliente is not None
+        self._cliente_async = cliente_async
+        # Con un cliente inyectado sin su par asíncrono, las variantes async usan hilos
+        self._async_nativo = cliente is None or cliente_async is not None
+        self._lock = threading.Lock()
+
+    def cliente(self):
+        """Retorna el cliente de Firestore, creándolo una sola vez de forma thread-safe."""
+        if not self._inicializado:
+            with self._lock:
+                if not self._inicializado:
+                    self._cliente = _conectar()
+                    self._inicializado = True
+        if self._cliente is None:
+            raise AlmacenNoDisponible("Firestore no está conectado (revisa las credenciales)")
+        return self._cliente
+
+    def cliente_async(self):
+        """Retorna el AsyncClient de Firestore, creándolo en el primer uso."""
+        if self._cliente_async is None:
+            self.cliente()  # inicializa la app de Firebase (y valida credenciales)
+            with self._lock:
+                if self._cliente_async is None:
+                    self._cliente_async = firestore_async.client()
+        return self._cliente_async
+
+    def calentar(self):
+        # Lectura mínima para abrir el canal gRPC (autenticación incluida)
+        self.cliente().collection(COLLECTION_USERS).document("_warmup").get()
+
+    def _ref_usuario(self, numero, cliente=None):
+        return (cliente or self.cliente()).collection(COLLECTION_USERS).document(str(numero))
+
+    def _ref_dashboard(self, numero, cliente=None):
+        # Ruta: artifacts/{APP_ID}/public/data/users_sync/{numero_telefono}
+        # Esta ruta es legible por el frontend
+        return (cliente or self.cliente()).collection(ruta_publica("users_sync")).document(str(numero))
+
+    @staticmethod
+    def _leido(doc):
+        if not doc.exists:
+            return None, None
+        datos = doc.to_dict()
+        datos['numero_telefono'] = doc.id
+        return datos, getattr(doc, "update_time", None)
+
+    # --- USUARIOS ---
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def leer_usuario(self, numero):
+        return self._leido(self._ref_usuario(numero).get())
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def leer_usuarios(self, numeros):
+        refs = [self._ref_usuario(n) for n in numeros]
+        usuarios = {str(n): (None, None) for n in numeros}
+        for doc in self.cliente().get_all(refs):
+            usuarios[doc.id] = self._leido(doc)
+        return usuarios
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def crear_usuario(self, numero, datos, publicos):
+        # Usuario y copia del dashboard en un solo WriteBatch
+        batch = self.cliente().batch()
+        batch.set(self._ref_usuario(numero), datos)
+        batch.set(self._ref_dashboard(numero), publicos)
+        return self._version(batch.commit())
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def actualizar_usuario(self, numero, datos, cambios_publicos=None):
+        datos = _a_firestore(datos)
+        if not cambios_publicos:
+            return getattr(self._ref_usuario(numero).update(datos), "update_time", None)
+        # set con merge: solo toca esos campos y no falla si la copia aún no existe
+        # (un update fallido abortaría todo el batch, incluido el del usuario)
+        batch = self.cliente().batch()
+        batch.update(self._ref_usuario(numero), datos)
+        batch.set(self._ref_dashboard(numero), _a_firestore(cambios_publicos), merge=True)
+        return self._version(batch.commit())
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def actualizar_usuarios(self, cambios_por_usuario, versiones=None):
+        versiones = versiones or {}
+        numeros = list(cambios_por_usuario)
+        nuevas = {}
+        for i in range(0, len(numeros), _LIMITE_BATCH):
+            lote = numeros[i:i + _LIMITE_BATCH]
+            batch = self.cliente().batch()
+            for numero in lote:
+                # Precondición: el commit falla entero si el documento cambió desde la lectura
+                opcion = (self.cliente().write_option(last_update_time=versiones[numero])
+                          if versiones.get(numero) is not None else None)
+                batch.update(self._ref_usuario(numero), _a_firestore(cambios_por_usuario[numero]), option=opcion)
+            for numero, resultado in zip(lote, batch.commit()):
+                nuevas[numero] = getattr(resultado, "update_time", None)
+        return nuevas
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def listar_usuarios(self, desde=None, limite=500):
+        consulta = self.cliente().collection(COLLECTION_USERS).order_by("__name__").limit(limite)
+        if desde is not None:
+            consulta = consulta.start_after({"__name__": str(desde)})
+        return [(doc.id, *self._leido(doc)) for doc in consulta.stream()]
+
+    @staticmethod
+    def _version(resultados):
+        return getattr(resultados[0], "update_time", None) if resultados else None
+
+    # --- USUARIOS (AsyncClient) ---
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    async def leer_usuario_async(self, numero):
+        if not self._async_nativo:
+            return await super().leer_usuario_async(numero)
+        return self._leido(await self._ref_usuario(numero, self.cliente_async()).get())
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    async def leer_usuarios_async(self, numeros):
+        if not self._async_nativo:
+            return await super().leer_usuarios_async(numeros)
+        cliente = self.cliente_async()
+        usuarios = {str(n): (None, None) for n in numeros}
+        async for doc in cliente.get_all([self._ref_usuario(n, cliente) for n in numeros]):
+            usuarios[doc.id] = self._leido(doc)
+        return usuarios
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    async def crear_usuario_async(self, numero, datos, publicos):
+        if not self._async_nativo:
+            return await super().crear_usuario_async(numero, datos, publicos)
+        cliente = self.cliente_async()
+        batch = cliente.batch()
+        batch.set(self._ref_usuario(numero, cliente), datos)
+        batch.set(self._ref_dashboard(numero, cliente), publicos)
+        return self._version(await batch.commit())
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    async def actualizar_usuario_async(self, numero, datos, cambios_publicos=None):
+        if not self._async_nativo:
+            return await super().actualizar_usuario_async(numero, datos, cambios_publicos)
+        cliente = self.cliente_async()
+        batch = cliente.batch()
+        batch.update(self._ref_usuario(numero, cliente), _a_firestore(datos))
+        if cambios_publicos:
+            batch.set(self._ref_dashboard(numero, cliente), _a_firestore(cambios_publicos), merge=True)
+        return self._version(await batch.commit())
+
+    # --- DASHBOARD ---
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def escribir_dashboard(self, cambios_por_usuario):
+        numeros = list(cambios_por_usuario)
+        for i in range(0, len(numeros), _LIMITE_BATCH):
+            batch = self.cliente().batch()
+            for numero in numeros[i:i + _LIMITE_BATCH]:
+                batch.set(self._ref_dashboard(numero), _a_firestore(cambios_por_usuario[numero]), merge=True)
+            batch.commit()
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_dashboard(self, numero, publicos):
+        self._ref_dashboard(numero).set(publicos)
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def leer_dashboards(self, numeros):
+        copias = {str(n): None for n in numeros}
+        for doc in self.cliente().get_all([self._ref_dashboard(n) for n in numeros]):
+            if doc.exists:
+                copias[doc.id] = doc.to_dict()
+        return copias
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_dashboards(self, publicos_por_usuario):
+        numeros = list(publicos_por_usuario)
+        for i in range(0, len(numeros), _LIMITE_BATCH):
+            batch = self.cliente().batch()
+            for numero in numeros[i:i + _LIMITE_BATCH]:
+                # set sin merge: también borra los campos que ya no son públicos
+                batch.set(self._ref_dashboard(numero), publicos_por_usuario[numero])
+            batch.commit()
+
+    # --- ESTADÍSTICAS POR CLASE ---
+
+    def _ref_clase(self, token):
+        # Ruta: artifacts/{APP_ID}/public/data/class_stats/{class_token}
+        return self.cliente().collection(ruta_publica("class_stats")).document(str(token))
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def escribir_clases(self, cambios_por_clase):
+        tokens = list(cambios_por_clase)
+        for i in range(0, len(tokens), _LIMITE_BATCH):
+            batch = self.cliente().batch()
+            for token in tokens[i:i + _LIMITE_BATCH]:
+                batch.set(self._ref_clase(token), _anidar(cambios_por_clase[token]), merge=True)
+            batch.commit()
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def leer_clase(self, token):
+        doc = self._ref_clase(token).get()
+        return doc.to_dict() if doc.exists else None
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_clase(self, token, datos):
+        self._ref_clase(token).set(datos)
+
+    # --- REGISTROS DE ANALÍTICA ---
+
+    def _coleccion_publica(self, coleccion):
+        return self.cliente().collection(ruta_publica(coleccion))
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def escribir_registros(self, registros):
+        for i in range(0, len(registros), _LIMITE_BATCH):
+            batch = self.cliente().batch()
+            for coleccion, doc_id, datos in registros[i:i + _LIMITE_BATCH]:
+                batch.set(self._coleccion_publica(coleccion).document(doc_id), datos)
+            batch.commit()
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def listar_registros(self, coleccion, iguales=None, desde=None, hasta=None, despues_de=None, limite=500,
+                         campo="timestamp"):
+        # Con filtros de igualdad necesita un índice compuesto (ver README)
+        consulta = self._coleccion_publica(coleccion)
+        for filtro, valor in (iguales or {}).items():
+            consulta = consulta.where(filter=FieldFilter(filtro, "==", valor))
+        if desde is not None:
+            consulta = consulta.where(filter=FieldFilter(campo, ">=", desde))
+        if hasta is not None:
+            consulta = consulta.where(filter=FieldFilter(campo, "<", hasta))
+        consulta = consulta.order_by(campo).order_by("__name__").limit(limite)
+        if despues_de is not None:
+            consulta = consulta.start_after({campo: despues_de[0], "__name__": despues_de[1]})
+        return [(doc.id, doc.to_dict()) for doc in consulta.stream()]
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def compactar_registros(self, acumulados, borrados):
+        if len(acumulados) + len(borrados) > _LIMITE_BATCH:
+            raise ValueError(f"Más de {_LIMITE_BATCH} documentos en una compactación")
+        batch = self.cliente().batch()
+        for (coleccion, doc_id), cambios in acumulados.items():
+            batch.set(self._coleccion_publica(coleccion).document(doc_id), _anidar(cambios), merge=True)
+        for coleccion, doc_id in borrados:
+            batch.delete(self._coleccion_publica(coleccion).document(doc_id))
+        batch.commit()
+
+    # --- COORDINACIÓN ENTRE PROCESOS ---
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def reclamar_mensaje(self, message_id, ttl_segundos):
+        # create() es atómico: solo el primer proceso que lo intente gana
+        try:
+            self.cliente().collection(COLLECTION_MENSAJES_PROCESADOS).document(str(message_id)).create({
+                "procesado_en": datetime.now().isoformat(),
+                "expira_en": datetime.now() + timedelta(seconds=ttl_segundos)
+            })
+            return True
+        except AlreadyExists:
+            return False
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def adquirir_turno(self, numero, propietario, ttl_segundos):
+        ref = self.cliente().collection(COLLECTION_TURNOS_ACTIVOS).document(str(numero))
+
+        @firestore.transactional
+        def _adquirir(transaccion):
+            snapshot = ref.get(transaction=transaccion)
+            ahora = time.time()
+            if snapshot.exists:
+                lease = snapshot.to_dict()
+                if lease.get("propietario") != propietario and lease.get("expira", 0) > ahora:
+                    return False
+            transaccion.set(ref, {"propietario": propietario, "expira": ahora + ttl_segundos})
+            return True
+
+        return _adquirir(self.cliente().transaction())
+
+    @metrics.instrumentar("firestore", metrics.BUCKETS_RAPIDOS)
+    def liberar_turno(self, numero, propietario):
+        ref = self.cliente().collection(COLLECTION_TURNOS_ACTIVOS).document(str(numero))
+
+        @firestore.transactional
+        def _liberar(transaccion):
+            snapshot = ref.get(transaction=transaccion)
+            if snapshot.exists and snapshot.to_dict().get("propietario") == propietario:
+                transaccion.delete(ref)
+
+        _liberar(self.cliente().transaction())
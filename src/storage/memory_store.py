@@ -0,0 +1,236 @@
+# storage/memory_store.py
+# Backend en memoria: para benchmarks del throughput de los handlers y para
+# desarrollo local sin credenciales. Los datos se pierden al reiniciar y no se
+# comparten entre procesos de gunicorn.
+#
+# Cuenta lecturas y escrituras (`conteos`) para poder reportar cuánto
+# almacenamiento cuesta un turno, y puede simular latencia por operación.
+
+import copy
+import itertools
+import threading
+import time
+from collections import Counter
+
+from src import metrics
+from src.storage.base import Almacen, ConflictoDeVersion, resolver
+
+
+class AlmacenMemoria(Almacen):
+    nombre = "memoria"
+    compartido = False
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.usuarios = {}       # numero -> datos
+        self.versiones = {}      # numero -> entero creciente
+        self.dashboard = {}      # numero -> copia pública
+        self.clases = {}         # class_token -> agregados
+        self.registros = {}      # coleccion -> {doc_id: datos}
+        self._mensajes = {}      # message_id -> expira (time.time)
+        self._turnos = {}        # numero -> (propietario, expira)
+        # "lecturas"/"escrituras" (operaciones) y "<método>" (llamadas por método)
+        self.conteos = Counter()
+        self._reloj = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _operacion(self, metodo, lecturas=0, escrituras=0):
+        with self._lock:
+            self.conteos[metodo] += 1
+            self.conteos["lecturas"] += lecturas
+            self.conteos["escrituras"] += escrituras
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def reiniciar_conteos(self):
+        with self._lock:
+            self.conteos.clear()
+
+    def _leido(self, numero):
+        datos = self.usuarios.get(numero)
+        if datos is None:
+            return None, None
+        datos = copy.deepcopy(datos)
+        datos['numero_telefono'] = numero
+        return datos, self.versiones[numero]
+
+    def _nueva_version(self, numero):
+        self.versiones[numero] = next(self._reloj)
+        return self.versiones[numero]
+
+    # --- USUARIOS ---
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def leer_usuario(self, numero):
+        self._operacion("leer_usuario", lecturas=1)
+        with self._lock:
+            return self._leido(str(numero))
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def leer_usuarios(self, numeros):
+        self._operacion("leer_usuarios", lecturas=len(numeros))
+        with self._lock:
+            return {str(n): self._leido(str(n)) for n in numeros}
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def crear_usuario(self, numero, datos, publicos):
+        self._operacion("crear_usuario", escrituras=2)
+        numero = str(numero)
+        with self._lock:
+            self.usuarios[numero] = copy.deepcopy(datos)
+            self.dashboard[numero] = dict(publicos)
+            return self._nueva_version(numero)
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def actualizar_usuario(self, numero, datos, cambios_publicos=None):
+        self._operacion("actualizar_usuario", escrituras=2 if cambios_publicos else 1)
+        numero = str(numero)
+        with self._lock:
+            if numero not in self.usuarios:
+                raise KeyError(f"No existe el usuario {numero}")
+            self.usuarios[numero] = resolver(self.usuarios[numero], copy.deepcopy(datos))
+            if cambios_publicos:
+                self.dashboard[numero] = resolver(self.dashboard.get(numero), cambios_publicos)
+            return self._nueva_version(numero)
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def actualizar_usuarios(self, cambios_por_usuario, versiones=None):
+        self._operacion("actualizar_usuarios", escrituras=len(cambios_por_usuario))
+        versiones = versiones or {}
+        with self._lock:
+            for numero in map(str, cambios_por_usuario):
+                if numero not in self.usuarios:
+                    raise KeyError(f"No existe el usuario {numero}")
+                if versiones.get(numero) is not None and self.versiones[numero] != versiones[numero]:
+                    raise ConflictoDeVersion(f"El usuario {numero} cambió desde que se leyó")
+            nuevas = {}
+            for numero, datos in cambios_por_usuario.items():
+                numero = str(numero)
+                self.usuarios[numero] = resolver(self.usuarios[numero], copy.deepcopy(datos))
+                nuevas[numero] = self._nueva_version(numero)
+            return nuevas
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def listar_usuarios(self, desde=None, limite=500):
+        with self._lock:
+            numeros = sorted(n for n in self.usuarios if desde is None or n > str(desde))[:limite]
+            pagina = [(numero, *self._leido(numero)) for numero in numeros]
+        self._operacion("listar_usuarios", lecturas=len(pagina))
+        return pagina
+
+    # --- DASHBOARD ---
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def escribir_dashboard(self, cambios_por_usuario):
+        self._operacion("escribir_dashboard", escrituras=len(cambios_por_usuario))
+        with self._lock:
+            for numero, cambios in cambios_por_usuario.items():
+                self.dashboard[str(numero)] = resolver(self.dashboard.get(str(numero)), cambios)
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_dashboard(self, numero, publicos):
+        self._operacion("reemplazar_dashboard", escrituras=1)
+        with self._lock:
+            self.dashboard[str(numero)] = dict(publicos)
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def leer_dashboards(self, numeros):
+        self._operacion("leer_dashboards", lecturas=len(numeros))
+        with self._lock:
+            return {str(n): copy.deepcopy(self.dashboard.get(str(n))) for n in numeros}
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_dashboards(self, publicos_por_usuario):
+        self._operacion("reemplazar_dashboards", escrituras=len(publicos_por_usuario))
+        with self._lock:
+            for numero, publicos in publicos_por_usuario.items():
+                self.dashboard[str(numero)] = dict(publicos)
+
+    # --- ESTADÍSTICAS POR CLASE ---
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def escribir_clases(self, cambios_por_clase):
+        self._operacion("escribir_clases", escrituras=len(cambios_por_clase))
+        with self._lock:
+            for token, cambios in cambios_por_clase.items():
+                self.clases[str(token)] = resolver(self.clases.get(str(token)), cambios)
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def leer_clase(self, token):
+        self._operacion("leer_clase", lecturas=1)
+        with self._lock:
+            return copy.deepcopy(self.clases.get(str(token)))
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_clase(self, token, datos):
+        self._operacion("reemplazar_clase", escrituras=1)
+        with self._lock:
+            self.clases[str(token)] = copy.deepcopy(datos)
+
+    # --- REGISTROS DE ANALÍTICA ---
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def escribir_registros(self, registros):
+        self._operacion("escribir_registros", escrituras=len(registros))
+        with self._lock:
+            for coleccion, doc_id, datos in registros:
+                self.registros.setdefault(coleccion, {})[doc_id] = copy.deepcopy(datos)
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def listar_registros(self, coleccion, iguales=None, desde=None, hasta=None, despues_de=None, limite=500,
+                         campo="timestamp"):
+        def _incluido(doc_id, datos):
+            valor = datos.get(campo)
+            return (valor is not None
+                    and all(datos.get(filtro) == igual for filtro, igual in (iguales or {}).items())
+                    and (desde is None or valor >= desde)
+                    and (hasta is None or valor < hasta)
+                    and (despues_de is None or (valor, doc_id) > tuple(despues_de)))
+
+        with self._lock:
+            registros = self.registros.get(coleccion, {})
+            claves = sorted((datos[campo], doc_id) for doc_id, datos in registros.items()
+                            if _incluido(doc_id, datos))[:limite]
+            pagina = [(doc_id, copy.deepcopy(registros[doc_id])) for _, doc_id in claves]
+        self._operacion("listar_registros", lecturas=len(pagina))
+        return pagina
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def compactar_registros(self, acumulados, borrados):
+        self._operacion("compactar_registros", escrituras=len(acumulados) + len(borrados))
+        with self._lock:
+            for (coleccion, doc_id), cambios in acumulados.items():
+                registros = self.registros.setdefault(coleccion, {})
+                registros[doc_id] = resolver(registros.get(doc_id), copy.deepcopy(cambios))
+            for coleccion, doc_id in borrados:
+                self.registros.get(coleccion, {}).pop(doc_id, None)
+
+    # --- COORDINACIÓN (solo dentro de este proceso) ---
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def reclamar_mensaje(self, message_id, ttl_segundos):
+        self._operacion("reclamar_mensaje", lecturas=1, escrituras=1)
+        ahora = time.time()
+        with self._lock:
+            if self._mensajes.get(message_id, 0) > ahora:
+                return False
+            self._mensajes[message_id] = ahora + ttl_segundos
+            return True
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def adquirir_turno(self, numero, propietario, ttl_segundos):
+        self._operacion("adquirir_turno", lecturas=1, escrituras=1)
+        ahora = time.time()
+        with self._lock:
+            actual, expira = self._turnos.get(str(numero), (None, 0))
+            if actual not in (None, propietario) and expira > ahora:
+                return False
+            self._turnos[str(numero)] = (propietario, ahora + ttl_segundos)
+            return True
+
+    @metrics.instrumentar("memoria", metrics.BUCKETS_RAPIDOS)
+    def liberar_turno(self, numero, propietario):
+        self._operacion("liberar_turno", lecturas=1, escrituras=1)
+        with self._lock:
+            if self._turnos.get(str(numero), (None, 0))[0] == propietario:
+                del self._turnos[str(numero)]
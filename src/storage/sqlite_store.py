@@ -0,0 +1,328 @@
+# storage/sqlite_store.py
+# Backend SQLite: para correr el bot en un solo servidor con cohortes chicas,
+# o como capa local rápida. Todos los workers de gunicorn comparten el mismo
+# archivo (modo WAL); cada hilo usa su propia conexión.
+#
+# Los documentos se guardan como JSON. `version` crece con cada escritura del
+# usuario y hace de update_time para la caché de usuarios. Los Incremento y
+# Maximo se resuelven dentro de la transacción (BEGIN IMMEDIATE serializa a
+# los escritores), así ningún proceso pisa el puntaje de otro.
+
+import json
+import sqlite3
+import threading
+import time
+
+from src import metrics
+from src.storage.base import Almacen, ConflictoDeVersion, resolver
+
+# Cada cuánto un proceso borra de mensajes_procesados los IDs vencidos
+_PURGA_MENSAJES_SEGUNDOS = 300
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS usuarios (
+    numero TEXT PRIMARY KEY,
+    datos TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users_sync (
+    numero TEXT PRIMARY KEY,
+    datos TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS clases (
+    token TEXT PRIMARY KEY,
+    datos TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS registros (
+    coleccion TEXT NOT NULL,
+    id TEXT NOT NULL,
+    datos TEXT NOT NULL,
+    PRIMARY KEY (coleccion, id)
+);
+CREATE TABLE IF NOT EXISTS mensajes_procesados (
+    id TEXT PRIMARY KEY,
+    expira REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mensajes_procesados_expira ON mensajes_procesados (expira);
+CREATE TABLE IF NOT EXISTS turnos_activos (
+    numero TEXT PRIMARY KEY,
+    propietario TEXT NOT NULL,
+    expira REAL NOT NULL
+);
+"""
+
+
+def _a_json(datos):
+    return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class AlmacenSqlite(Almacen):
+    nombre = "sqlite"
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._esquema_creado = False
+        self._lock = threading.Lock()
+        self._proxima_purga = 0.0
+
+    def _conexion(self):
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            # isolation_level=None: las transacciones se abren explícitamente con BEGIN
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            if not self._esquema_creado:
+                with self._lock:
+                    conexion.executescript(_ESQUEMA)
+                    self._esquema_creado = True
+            self._local.conexion = conexion
+        return conexion
+
+    def _transaccion(self, funcion):
+        """Ejecuta `funcion(conexion)` dentro de BEGIN IMMEDIATE ... COMMIT."""
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            resultado = funcion(conexion)
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        conexion.execute("COMMIT")
+        return resultado
+
+    def calentar(self):
+        self._conexion()
+
+    @staticmethod
+    def _leido(numero, fila):
+        if fila is None:
+            return None, None
+        datos = json.loads(fila[0])
+        datos['numero_telefono'] = numero
+        return datos, fila[1]
+
+    @staticmethod
+    def _mezclar_dashboard(conexion, numero, cambios):
+        fila = conexion.execute("SELECT datos FROM users_sync WHERE numero = ?", (numero,)).fetchone()
+        publicos = resolver(json.loads(fila[0]) if fila else {}, cambios)
+        conexion.execute("INSERT OR REPLACE INTO users_sync (numero, datos) VALUES (?, ?)",
+                         (numero, _a_json(publicos)))
+
+    # --- USUARIOS ---
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def leer_usuario(self, numero):
+        fila = self._conexion().execute(
+            "SELECT datos, version FROM usuarios WHERE numero = ?", (str(numero),)).fetchone()
+        return self._leido(str(numero), fila)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def leer_usuarios(self, numeros):
+        numeros = [str(n) for n in numeros]
+        usuarios = {n: (None, None) for n in numeros}
+        marcas = ",".join("?" * len(numeros))
+        for numero, datos, version in self._conexion().execute(
+                f"SELECT numero, datos, version FROM usuarios WHERE numero IN ({marcas})", numeros):
+            usuarios[numero] = self._leido(numero, (datos, version))
+        return usuarios
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def crear_usuario(self, numero, datos, publicos):
+        numero = str(numero)
+
+        def _crear(conexion):
+            fila = conexion.execute("SELECT version FROM usuarios WHERE numero = ?", (numero,)).fetchone()
+            version = (fila[0] if fila else 0) + 1
+            conexion.execute("INSERT OR REPLACE INTO usuarios (numero, datos, version) VALUES (?, ?, ?)",
+                             (numero, _a_json(datos), version))
+            conexion.execute("INSERT OR REPLACE INTO users_sync (numero, datos) VALUES (?, ?)",
+                             (numero, _a_json(publicos)))
+            return version
+
+        return self._transaccion(_crear)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def actualizar_usuario(self, numero, datos, cambios_publicos=None):
+        numero = str(numero)
+
+        def _actualizar(conexion):
+            fila = conexion.execute("SELECT datos, version FROM usuarios WHERE numero = ?", (numero,)).fetchone()
+            if fila is None:
+                raise KeyError(f"No existe el usuario {numero}")
+            version = fila[1] + 1
+            conexion.execute("UPDATE usuarios SET datos = ?, version = ? WHERE numero = ?",
+                             (_a_json(resolver(json.loads(fila[0]), datos)), version, numero))
+            if cambios_publicos:
+                self._mezclar_dashboard(conexion, numero, cambios_publicos)
+            return version
+
+        return self._transaccion(_actualizar)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def actualizar_usuarios(self, cambios_por_usuario, versiones=None):
+        versiones = versiones or {}
+
+        def _actualizar(conexion):
+            nuevas = {}
+            for numero, datos in cambios_por_usuario.items():
+                numero = str(numero)
+                fila = conexion.execute("SELECT datos, version FROM usuarios WHERE numero = ?",
+                                        (numero,)).fetchone()
+                if fila is None:
+                    raise KeyError(f"No existe el usuario {numero}")
+                if versiones.get(numero) is not None and fila[1] != versiones[numero]:
+                    raise ConflictoDeVersion(f"El usuario {numero} cambió desde que se leyó")
+                nuevas[numero] = fila[1] + 1
+                conexion.execute("UPDATE usuarios SET datos = ?, version = ? WHERE numero = ?",
+                                 (_a_json(resolver(json.loads(fila[0]), datos)), nuevas[numero], numero))
+            return nuevas
+
+        return self._transaccion(_actualizar)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def listar_usuarios(self, desde=None, limite=500):
+        filas = self._conexion().execute(
+            "SELECT numero, datos, version FROM usuarios WHERE numero > ? ORDER BY numero LIMIT ?",
+            ("" if desde is None else str(desde), limite)).fetchall()
+        return [(numero, *self._leido(numero, (datos, version))) for numero, datos, version in filas]
+
+    # --- DASHBOARD ---
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def escribir_dashboard(self, cambios_por_usuario):
+        def _escribir(conexion):
+            for numero, cambios in cambios_por_usuario.items():
+                self._mezclar_dashboard(conexion, str(numero), cambios)
+
+        self._transaccion(_escribir)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_dashboard(self, numero, publicos):
+        self._conexion().execute("INSERT OR REPLACE INTO users_sync (numero, datos) VALUES (?, ?)",
+                                 (str(numero), _a_json(publicos)))
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def leer_dashboards(self, numeros):
+        numeros = [str(n) for n in numeros]
+        copias = {n: None for n in numeros}
+        marcas = ",".join("?" * len(numeros))
+        for numero, datos in self._conexion().execute(
+                f"SELECT numero, datos FROM users_sync WHERE numero IN ({marcas})", numeros):
+            copias[numero] = json.loads(datos)
+        return copias
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_dashboards(self, publicos_por_usuario):
+        def _reemplazar(conexion):
+            conexion.executemany("INSERT OR REPLACE INTO users_sync (numero, datos) VALUES (?, ?)",
+                                 [(str(n), _a_json(p)) for n, p in publicos_por_usuario.items()])
+
+        self._transaccion(_reemplazar)
+
+    # --- ESTADÍSTICAS POR CLASE ---
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def escribir_clases(self, cambios_por_clase):
+        def _escribir(conexion):
+            for token, cambios in cambios_por_clase.items():
+                fila = conexion.execute("SELECT datos FROM clases WHERE token = ?", (str(token),)).fetchone()
+                conexion.execute("INSERT OR REPLACE INTO clases (token, datos) VALUES (?, ?)",
+                                 (str(token), _a_json(resolver(json.loads(fila[0]) if fila else {}, cambios))))
+
+        self._transaccion(_escribir)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def leer_clase(self, token):
+        fila = self._conexion().execute("SELECT datos FROM clases WHERE token = ?", (str(token),)).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def reemplazar_clase(self, token, datos):
+        self._conexion().execute("INSERT OR REPLACE INTO clases (token, datos) VALUES (?, ?)",
+                                 (str(token), _a_json(datos)))
+
+    # --- REGISTROS DE ANALÍTICA ---
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def escribir_registros(self, registros):
+        self._transaccion(lambda conexion: conexion.executemany(
+            "INSERT OR REPLACE INTO registros (coleccion, id, datos) VALUES (?, ?, ?)",
+            [(coleccion, doc_id, _a_json(datos)) for coleccion, doc_id, datos in registros]))
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def listar_registros(self, coleccion, iguales=None, desde=None, hasta=None, despues_de=None, limite=500,
+                         campo="timestamp"):
+        orden = f"json_extract(datos, '$.\"{campo}\"')"
+        condiciones, parametros = ["coleccion = ?", f"{orden} IS NOT NULL"], [coleccion]
+        for filtro, valor in (iguales or {}).items():
+            condiciones.append("json_extract(datos, ?) = ?")
+            parametros += [f'$."{filtro}"', valor]
+        if desde is not None:
+            condiciones.append(f"{orden} >= ?")
+            parametros.append(desde)
+        if hasta is not None:
+            condiciones.append(f"{orden} < ?")
+            parametros.append(hasta)
+        if despues_de is not None:
+            condiciones.append(f"({orden} > ? OR ({orden} = ? AND id > ?))")
+            parametros += [despues_de[0], despues_de[0], despues_de[1]]
+        filas = self._conexion().execute(
+            f"SELECT id, datos FROM registros WHERE {' AND '.join(condiciones)} "
+            f"ORDER BY {orden}, id LIMIT ?", (*parametros, limite)).fetchall()
+        return [(doc_id, json.loads(datos)) for doc_id, datos in filas]
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def compactar_registros(self, acumulados, borrados):
+        def _compactar(conexion):
+            for (coleccion, doc_id), cambios in acumulados.items():
+                fila = conexion.execute("SELECT datos FROM registros WHERE coleccion = ? AND id = ?",
+                                        (coleccion, doc_id)).fetchone()
+                conexion.execute("INSERT OR REPLACE INTO registros (coleccion, id, datos) VALUES (?, ?, ?)",
+                                 (coleccion, doc_id, _a_json(resolver(json.loads(fila[0]) if fila else {}, cambios))))
+            conexion.executemany("DELETE FROM registros WHERE coleccion = ? AND id = ?", list(borrados))
+
+        self._transaccion(_compactar)
+
+    # --- COORDINACIÓN ENTRE PROCESOS ---
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def reclamar_mensaje(self, message_id, ttl_segundos):
+        ahora = time.time()
+
+        purgar = ahora >= self._proxima_purga
+        if purgar:
+            self._proxima_purga = ahora + _PURGA_MENSAJES_SEGUNDOS
+
+        def _reclamar(conexion):
+            if purgar:
+                # Los IDs que no vuelven a llegar no se pisan nunca: sin esto la tabla solo crece
+                conexion.execute("DELETE FROM mensajes_procesados WHERE expira <= ?", (ahora,))
+            else:
+                conexion.execute("DELETE FROM mensajes_procesados WHERE id = ? AND expira <= ?", (message_id, ahora))
+            cursor = conexion.execute("INSERT OR IGNORE INTO mensajes_procesados (id, expira) VALUES (?, ?)",
+                                      (message_id, ahora + ttl_segundos))
+            return cursor.rowcount == 1
+
+        return self._transaccion(_reclamar)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def adquirir_turno(self, numero, propietario, ttl_segundos):
+        ahora = time.time()
+
+        def _adquirir(conexion):
+            fila = conexion.execute("SELECT propietario, expira FROM turnos_activos WHERE numero = ?",
+                                    (str(numero),)).fetchone()
+            if fila and fila[0] != propietario and fila[1] > ahora:
+                return False
+            conexion.execute("INSERT OR REPLACE INTO turnos_activos (numero, propietario, expira) VALUES (?, ?, ?)",
+                             (str(numero), propietario, ahora + ttl_segundos))
+            return True
+
+        return self._transaccion(_adquirir)
+
+    @metrics.instrumentar("sqlite", metrics.BUCKETS_RAPIDOS)
+    def liberar_turno(self, numero, propietario):
+        self._conexion().execute("DELETE FROM turnos_activos WHERE numero = ? AND propietario = ?",
+                                 (str(numero), propietario))
@@ -0,0 +1,222 @@
+# tracing.py
+# Trazas livianas por turno: cada mensaje entrante abre un span raíz y cada
+# llamada a Firestore, Gemini o la Graph API cuelga de él como span hijo.
+# Un turno continúa la traza de la entrega del webhook que lo trajo (su span
+# raíz es hijo del span "entrega", aunque corra en otro hilo).
+# Las trazas terminadas se exportan en formato OTLP/JSON a un archivo (una
+# línea por lote, como el file exporter del OpenTelemetry Collector) o a un
+# collector por HTTP (POST a .../v1/traces).
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+
+from src.config.config import TRACING_EXPORTAR, TRACING_MUESTREO, TRACING_SERVICIO
+
+# Span abierto en el contexto actual (dict) o None
+_span_actual = ContextVar("span_actual", default=None)
+
+# Trazas terminadas a la espera del exportador
+_cola = queue.Queue(maxsize=1000)
+_exportador = None
+_lock_exportador = threading.Lock()
+_TAMANO_LOTE = 50
+_ESPERA_LOTE_SEGUNDOS = 2
+
+_STATUS_OK = 1
+_STATUS_ERROR = 2
+# Spans de llamadas a servicios externos (kind CLIENT); el resto son INTERNAL
+_PREFIJOS_EXTERNOS = ("firestore.", "gemini.", "whatsapp.")
+
+
+def activo():
+    return bool(TRACING_EXPORTAR)
+
+
+def _nuevo_id(bytes_):
+    return os.urandom(bytes_).hex()
+
+
+def _abrir(nombre, atributos, padre):
+    span = {
+        "traceId": padre["traceId"] if padre else _nuevo_id(16),
+        "spanId": _nuevo_id(8),
+        "parentSpanId": padre["spanId"] if padre else "",
+        "name": nombre,
+        "inicio": time.time_ns(),
+        "atributos": dict(atributos or {}),
+        "error": None,
+        # Todos los spans de la traza comparten la misma lista
+        "spans": padre["spans"] if padre else [],
+    }
+    span["spans"].append(span)
+    return span
+
+
+def contexto():
+    """(traceId, spanId) del span actual, para continuar la traza en otro hilo; None fuera de una traza."""
+    actual = _span_actual.get()
+    return (actual["traceId"], actual["spanId"]) if actual is not None else None
+
+
+@contextmanager
+def traza(nombre, atributos=None, padre=None):
+    """
+    Abre el span raíz de una traza (ej: un turno). Al cerrarse, la traza
+    completa se encola para exportarse. No hace nada si el tracing está
+    apagado o la traza no entra en el muestreo. Con `padre` (un contexto()
+    tomado en otro hilo) el span es su hijo y sigue su muestreo.
+    """
+    if not activo() or (padre is None and random.random() >= TRACING_MUESTREO):
+        yield None
+        return
+
+    raiz = _abrir(nombre, atributos, None)
+    if padre is not None:
+        raiz["traceId"], raiz["parentSpanId"] = padre
+    token = _span_actual.set(raiz)
+    try:
+        yield raiz
+    except Exception as e:
+        raiz["error"] = str(e)
+        raise
+    finally:
+        _span_actual.reset(token)
+        raiz["fin"] = time.time_ns()
+        _encolar(raiz["spans"])
+
+
+@contextmanager
+def span(nombre, atributos=None):
+    """Abre un span hijo del span actual. Fuera de una traza no registra nada."""
+    padre = _span_actual.get()
+    if padre is None:
+        yield None
+        return
+
+    actual = _abrir(nombre, atributos, padre)
+    token = _span_actual.set(actual)
+    try:
+        yield actual
+    except Exception as e:
+        actual["error"] = str(e)
+        raise
+    finally:
+        _span_actual.reset(token)
+        actual["fin"] = time.time_ns()
+
+
+def agregar_atributos(**atributos):
+    """Agrega atributos al span actual (ej: el resultado de un turno)."""
+    actual = _span_actual.get()
+    if actual is not None:
+        actual["atributos"].update(atributos)
+
+
+def marcar_error(mensaje):
+    """Marca el span actual como fallido sin propagar una excepción."""
+    actual = _span_actual.get()
+    if actual is not None:
+        actual["error"] = mensaje
+
+
+# --- EXPORTACIÓN OTLP/JSON ---
+
+def _valor_otlp(valor):
+    if isinstance(valor, bool):
+        return {"boolValue": valor}
+    if isinstance(valor, int):
+        return {"intValue": str(valor)}
+    if isinstance(valor, float):
+        return {"doubleValue": valor}
+    return {"stringValue": str(valor)}
+
+
+def _span_otlp(span):
+    return {
+        "traceId": span["traceId"],
+        "spanId": span["spanId"],
+        "parentSpanId": span["parentSpanId"],
+        "name": span["name"],
+        # 1 = INTERNAL, 3 = CLIENT
+        "kind": 3 if span["name"].startswith(_PREFIJOS_EXTERNOS) else 1,
+        "startTimeUnixNano": str(span["inicio"]),
+        "endTimeUnixNano": str(span.get("fin", span["inicio"])),
+        "attributes": [{"key": k, "value": _valor_otlp(v)}
+                       for k, v in span["atributos"].items() if v is not None],
+        "status": ({"code": _STATUS_ERROR, "message": span["error"]} if span["error"]
+                   else {"code": _STATUS_OK}),
+    }
+
+
+def _documento_otlp(trazas):
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": TRACING_SERVICIO}},
+            {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+        ]},
+        "scopeSpans": [{
+            "scope": {"name": "src.tracing"},
+            "spans": [_span_otlp(s) for spans in trazas for s in spans],
+        }],
+    }]}
+
+
+def _encolar(spans):
+    _iniciar_exportador()
+    try:
+        _cola.put_nowait(spans)
+    except queue.Full:
+        print("⚠️ Cola de trazas llena, se descarta una traza")
+
+
+def _iniciar_exportador():
+    global _exportador
+    with _lock_exportador:
+        if _exportador:
+            return
+        _exportador = threading.Thread(target=_bucle_exportador, name="tracing-export", daemon=True)
+        _exportador.start()
+
+
+def _bucle_exportador():
+    while True:
+        lote = [_cola.get()]
+        limite = time.monotonic() + _ESPERA_LOTE_SEGUNDOS
+        while len(lote) < _TAMANO_LOTE:
+            try:
+                lote.append(_cola.get(timeout=max(0, limite - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            exportar(lote)
+        except Exception as e:
+            print(f"⚠️ Error exportando trazas: {e}")
+        finally:
+            for _ in lote:
+                _cola.task_done()
+
+
+def exportar(trazas):
+    """Envía un lote de trazas al collector o lo agrega al archivo configurado."""
+    documento = _documento_otlp(trazas)
+    if TRACING_EXPORTAR.startswith(("http://", "https://")):
+        respuesta = requests.post(TRACING_EXPORTAR, json=documento, timeout=5)
+        respuesta.raise_for_status()
+    else:
+        with open(TRACING_EXPORTAR, "a", encoding="utf-8") as archivo:
+            archivo.write(json.dumps(documento, ensure_ascii=False) + "\n")
+
+
+def vaciar(timeout=5):
+    """Exporta lo pendiente antes de apagar el proceso."""
+    limite = time.monotonic() + timeout
+    while _cola.unfinished_tasks and time.monotonic() < limite:
+        time.sleep(0.05)
@@ -0,0 +1,29 @@
+# turn_context.py
+# Contexto del turno en curso: qué mensaje entrante lo originó y cuándo llegó.
+# Cada worker lo fija antes de ejecutar el handler, de modo que las capas
+# inferiores (envíos, métricas) puedan asociar su trabajo al turno.
+
+import contextvars
+
+_turno_actual = contextvars.ContextVar("turno_actual", default=None)
+
+
+def iniciar_turno(numero_telefono, message_id, recibido_en):
+    """Marca el inicio de un turno. Retorna un token para `finalizar_turno`."""
+    return _turno_actual.set({
+        "numero_telefono": str(numero_telefono),
+        "message_id": message_id,
+        # Hora (epoch) en que el webhook recibió el mensaje
+        "recibido_en": recibido_en,
+        # Lo completa el handler al cargar al usuario (ver procesar_mensaje_entrante)
+        "estado_conversacion": None
+    })
+
+
+def finalizar_turno(token):
+    _turno_actual.reset(token)
+
+
+def turno_actual():
+    """Retorna el turno en curso o None si no estamos dentro de uno."""
+    return _turno_actual.get()
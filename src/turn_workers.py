@@ -0,0 +1,312 @@
+# turn_workers.py
+# Pool de workers en segundo plano que ejecutan los turnos del chatbot.
+# El webhook solo valida y encola; la IA, Firestore y los envíos a WhatsApp
+# corren aquí, fuera del event loop de FastAPI.
+#
+# Cada número de teléfono tiene un buzón: sus mensajes se procesan
+# estrictamente en orden y de a uno, mientras que usuarios distintos
+# se atienden en paralelo.
+#
+# Hay dos carriles con workers propios: "rapido" para comandos que no usan
+# la IA (menú, perfil, logros...) y "llm" para los turnos que llaman a Gemini.
+# Así la navegación no espera detrás de evaluaciones cuando Gemini está lento.
+#
+# Cuando la entrega llega desde el event loop, su lectura batch se hace ahí
+# mismo con el cliente async de Firestore y no ocupa un worker rápido.
+
+import asyncio
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+import src.database as db
+import src.message_handler as handler
+from src import dedup, diario, metrics, tracing
+from src.unit_of_work import unidad_de_trabajo
+from src.turn_context import iniciar_turno, finalizar_turno, turno_actual
+from src.config.config import (
+    TURN_WORKERS, TURN_WORKERS_RAPIDOS, TURN_QUEUE_MAX, MAILBOX_LEASE, MAILBOX_LEASE_TTL_SEGUNDOS
+)
+
+CARRIL_RAPIDO = handler.CARRIL_RAPIDO
+CARRIL_LLM = handler.CARRIL_LLM
+
+# Tareas listas para los workers de cada carril: entregas por repartir y buzones con mensajes
+_colas = {CARRIL_RAPIDO: queue.Queue(), CARRIL_LLM: queue.Queue()}
+_hilos = []
+_lock = threading.Lock()
+
+# numero -> deque de (encolado_en, recibido_en, message_data, nombre_usuario, usuario_precargado,
+# contexto de la traza de la entrega, carril).
+# Un buzón existe mientras tenga mensajes o esté siendo atendido; eso garantiza
+# que nunca haya dos workers procesando al mismo usuario.
+_buzones = {}
+# Mensajes aceptados por el webhook que aún no terminan de procesarse
+_pendientes = 0
+_en_proceso = {CARRIL_RAPIDO: 0, CARRIL_LLM: 0}
+
+# Identifica a este proceso al reclamar el turno de un usuario en Firestore
+_ID_PROCESO = f"{socket.gethostname()}:{os.getpid()}"
+# "firestore" es el nombre anterior de "compartido"
+_LEASE = MAILBOX_LEASE in ("compartido", "firestore")
+# Espera antes de reintentar un buzón cuyo usuario está ocupado en otro proceso
+_REINTENTO_LEASE_SEGUNDOS = 0.5
+
+# Marca que le indica a un worker que debe terminar
+_FIN = object()
+# Tipos de tarea: una entrega completa del webhook, o el buzón de un remitente
+_ENTREGA = "entrega"
+_BUZON = "buzon"
+
+# Repartos async en vuelo (el loop solo guarda referencias débiles a las tareas)
+_repartos = set()
+
+
+def iniciar_workers(cantidad=TURN_WORKERS, cantidad_rapidos=TURN_WORKERS_RAPIDOS):
+    """Arranca los hilos consumidores de ambos carriles. Es idempotente."""
+    if _hilos:
+        return
+
+    for carril, total in ((CARRIL_LLM, cantidad), (CARRIL_RAPIDO, cantidad_rapidos)):
+        for i in range(total):
+            hilo = threading.Thread(target=_bucle_worker, args=(carril,),
+                                    name=f"turn-worker-{carril}-{i}", daemon=True)
+            hilo.start()
+            _hilos.append((carril, hilo))
+        metrics.fijar_gauge("turn_workers_configurados", total, {"carril": carril})
+        metrics.registrar_gauge("turn_workers_ocupados", lambda c=carril: _en_proceso[c], etiquetas={"carril": carril})
+        metrics.registrar_gauge("turn_carril_depth", lambda c=carril: _colas[c].qsize(), etiquetas={"carril": carril})
+
+    metrics.registrar_gauge("turn_queue_depth", lambda: _pendientes)
+    metrics.registrar_gauge("turn_queue_capacity", lambda: TURN_QUEUE_MAX)
+    metrics.registrar_gauge("turn_buzones_activos", lambda: len(_buzones))
+    print(f"🧵 Workers de turnos iniciados: {cantidad} LLM + {cantidad_rapidos} rápidos "
+          f"(cola máx: {TURN_QUEUE_MAX})")
+
+
+def detener_workers(timeout=10):
+    """Pide a los workers que terminen y los espera hasta `timeout` segundos."""
+    limite = time.monotonic() + timeout
+    # Damos tiempo a que se vacíen los buzones antes de apagar
+    while _pendientes and time.monotonic() < limite:
+        time.sleep(0.1)
+
+    for carril, _ in _hilos:
+        _colas[carril].put(_FIN)
+    for _, hilo in _hilos:
+        hilo.join(max(0, limite - time.monotonic()))
+    _hilos.clear()
+    print("🧵 Workers de turnos detenidos")
+
+
+def encolar_entrega(grupos):
+    """
+    Encola una entrega del webhook ya agrupada por remitente
+    ({numero: [(message_data, nombre_usuario), ...]}).
+    Retorna False si se supera TURN_QUEUE_MAX (el webhook debe pedir reintento).
+    """
+    global _pendientes
+    cantidad = sum(len(m) for m in grupos.values())
+
+    with _lock:
+        aceptada = _pendientes + cantidad <= TURN_QUEUE_MAX
+        if aceptada:
+            _pendientes += cantidad
+
+    if not aceptada:
+        metrics.incrementar("turnos_rechazados_total", cantidad)
+        print(f"⚠️ Cola de turnos llena ({TURN_QUEUE_MAX}). Se pide reintento a Meta.")
+        return False
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        tarea = loop.create_task(_repartir_async(grupos, time.time()))
+        _repartos.add(tarea)
+        tarea.add_done_callback(_repartos.discard)
+    else:
+        # Sin event loop (scripts): la lectura batch va por el carril rápido
+        _colas[CARRIL_RAPIDO].put((time.monotonic(), _ENTREGA, (grupos, time.time())))
+    metrics.incrementar("entregas_encoladas_total")
+    metrics.incrementar("turnos_encolados_total", cantidad)
+    return True
+
+
+def _procesar_entrega(grupos, recibido_en):
+    """
+    Carga en UNA lectura batch a todos los remitentes de la entrega y
+    deposita los mensajes de cada uno en su buzón.
+    Con lease no hay lectura: el turno relee al usuario una vez que lo toma.
+    """
+    usuarios = {}
+    with tracing.traza("entrega", {"entrega.remitentes": len(grupos)}):
+        if not _LEASE:
+            usuarios = db.obtener_usuarios(list(grupos))
+        # Los turnos de la entrega cuelgan de este span
+        contexto = tracing.contexto()
+    for numero, mensajes in grupos.items():
+        _depositar(numero, mensajes, usuarios.get(numero, handler.NO_PRECARGADO), recibido_en, contexto)
+
+
+async def _repartir_async(grupos, recibido_en):
+    """Como _procesar_entrega, pero la lectura batch corre en el event loop."""
+    try:
+        usuarios = {}
+        with tracing.traza("entrega", {"entrega.remitentes": len(grupos)}):
+            if not _LEASE:
+                usuarios = await db.obtener_usuarios_async(list(grupos))
+            contexto = tracing.contexto()
+        for numero, mensajes in grupos.items():
+            _depositar(numero, mensajes, usuarios.get(numero, handler.NO_PRECARGADO), recibido_en, contexto)
+    except Exception as e:
+        print(f"❌ Error repartiendo entrega: {e}")
+
+
+async def esperar_repartos(timeout=5):
+    """Espera a que las entregas en reparto lleguen a sus buzones (al apagar)."""
+    if _repartos:
+        await asyncio.wait(list(_repartos), timeout=timeout)
+
+
+def _depositar(numero, mensajes, usuario_precargado, recibido_en, contexto=None):
+    """Agrega mensajes al buzón del usuario y lo programa si estaba inactivo."""
+    ahora = time.monotonic()
+    with _lock:
+        buzon = _buzones.get(numero)
+        programar = buzon is None
+        if programar:
+            buzon = _buzones[numero] = deque()
+        else:
+            # Hay turnos previos en vuelo: el documento precargado ya no es confiable
+            usuario_precargado = handler.NO_PRECARGADO
+
+        for i, (message_data, nombre_usuario) in enumerate(mensajes):
+            # Solo el primer mensaje puede usar el documento precargado;
+            # los siguientes deben ver los cambios que hizo el anterior.
+            usuario = usuario_precargado if i == 0 else handler.NO_PRECARGADO
+            carril = handler.clasificar_turno(message_data, usuario)
+            buzon.append((ahora, recibido_en, message_data, nombre_usuario, usuario, contexto, carril))
+        carril_siguiente = buzon[0][-1]
+
+    if programar:
+        _colas[carril_siguiente].put((ahora, _BUZON, numero))
+
+
+def _reprogramar(numero):
+    """Vuelve a encolar el buzón en el carril de su próximo mensaje."""
+    with _lock:
+        carril = _buzones[numero][0][-1]
+    _colas[carril].put((time.monotonic(), _BUZON, numero))
+
+
+def _atender_buzon(numero):
+    """
+    Procesa UN mensaje del buzón y, si quedan más, lo vuelve a poner al final
+    de la cola de su carril para que un usuario muy activo no acapare un worker.
+    """
+    global _pendientes
+
+    if _LEASE and not db.adquirir_turno(numero, _ID_PROCESO, MAILBOX_LEASE_TTL_SEGUNDOS):
+        # Otro proceso de gunicorn está atendiendo a este usuario: reintentamos luego
+        metrics.incrementar("turn_lease_ocupado_total")
+        threading.Timer(_REINTENTO_LEASE_SEGUNDOS, _reprogramar, args=(numero,)).start()
+        return
+
+    with _lock:
+        encolado_en, recibido_en, message_data, nombre_usuario, usuario, contexto, carril = _buzones[numero].popleft()
+    inicio = time.monotonic()
+    metrics.observar("turno_espera_segundos", inicio - encolado_en, {"carril": carril})
+    if _LEASE:
+        # Lo leído antes del lease (o la caché) puede no tener el último
+        # turno que otro proceso hizo con este usuario
+        usuario = db.leer_usuario(numero)
+
+    token = iniciar_turno(numero, message_data.get('id'), recibido_en)
+    resultado = "ok"
+    estado = "desconocido"
+    try:
+        with tracing.traza("turno", {"messaging.message.id": message_data.get('id'),
+                                     "mensaje.tipo": message_data.get('type'),
+                                     "turno.carril": carril,
+                                     "turno.espera_segundos": round(inicio - encolado_en, 3)},
+                           padre=contexto):
+            try:
+                # Segunda barrera de dedup, compartida entre procesos de gunicorn
+                if message_data.get('id') and not dedup.reclamar_compartido(message_data['id']):
+                    print(f"♻️ Mensaje {message_data['id']} ya procesado por otro worker")
+                    resultado = "duplicado"
+                else:
+                    # Los cambios del turno se escriben juntos al final (o se descartan si falla)
+                    with unidad_de_trabajo():
+                        handler.procesar_mensaje_entrante(message_data, nombre_usuario, usuario)
+            except Exception as e:
+                resultado = "error"
+                tracing.marcar_error(str(e))
+                print(f"❌ Error procesando turno de {numero}: {e}")
+            finally:
+                estado = turno_actual().get("estado_conversacion") or estado
+                tracing.agregar_atributos(**{"turno.estado_conversacion": estado, "turno.resultado": resultado})
+    finally:
+        metrics.incrementar("turnos_total", etiquetas={"estado_conversacion": estado, "resultado": resultado})
+        metrics.observar("turno_duracion_segundos", time.monotonic() - inicio,
+                         {"resultado": resultado, "carril": carril})
+        finalizar_turno(token)
+
+        with _lock:
+            _pendientes -= 1
+            quedan = bool(_buzones[numero])
+            if not quedan:
+                del _buzones[numero]
+        if _LEASE:
+            _soltar_lease(numero)
+        if quedan:
+            _reprogramar(numero)
+
+
+def _soltar_lease(numero):
+    """
+    Libera el lease del usuario al terminar su turno, salvo que un cambio haya
+    quedado diferido en el diario: entonces lo retiene el diario hasta
+    escribirlo, para que otro proceso no atienda al usuario sin ese cambio.
+    """
+    def _renovar():
+        return db.adquirir_turno(numero, _ID_PROCESO, MAILBOX_LEASE_TTL_SEGUNDOS)
+
+    def _liberar():
+        # Con lock: un turno nuevo del usuario no puede empezar a mitad de la
+        # liberación; si ya hay uno en el buzón, lo libera él al terminar
+        with _lock:
+            if numero not in _buzones:
+                db.liberar_turno(numero, _ID_PROCESO)
+
+    if not diario.retener(numero, _renovar, _liberar):
+        db.liberar_turno(numero, _ID_PROCESO)
+
+
+def _bucle_worker(carril):
+    cola = _colas[carril]
+
+    while True:
+        item = cola.get()
+        if item is _FIN:
+            return
+
+        _, tipo, carga = item
+        with _lock:
+            _en_proceso[carril] += 1
+
+        try:
+            if tipo is _ENTREGA:
+                _procesar_entrega(*carga)
+            else:
+                _atender_buzon(carga)
+        except Exception as e:
+            print(f"❌ Error en worker de turnos: {e}")
+        finally:
+            with _lock:
+                _en_proceso[carril] -= 1
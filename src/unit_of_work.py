@@ -0,0 +1,125 @@
+# unit_of_work.py
+# Unidad de trabajo por turno: los cambios que los handlers hacen con
+# db.actualizar_usuario durante un mensaje entrante se acumulan aquí y se
+# escriben en Firestore UNA sola vez al terminar el turno.
+#
+# - Lecturas dentro del turno (db.obtener_usuario) retornan la SesionUsuario
+#   del turno (ver sesion.py), que ya ve los cambios pendientes.
+# - Los campos que los handlers asignan en la sesión se recogen antes de cada
+#   cambio registrado y al confirmar, en el orden en que se hicieron.
+# - Si el turno lanza una excepción, los cambios se descartan (rollback).
+# - Fuera de un turno (scripts, startup) actualizar_usuario escribe directo.
+
+import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from src import metrics
+from src.storage.base import combinar
+
+_unidad_actual = ContextVar("unidad_de_trabajo", default=None)
+
+
+class UnidadDeTrabajo:
+    """Cambios pendientes por usuario, en el orden en que se hicieron."""
+
+    def __init__(self):
+        # numero -> {campo: valor}; una actualización posterior pisa a la anterior,
+        # igual que si se hubieran aplicado en secuencia con update(), salvo
+        # los Incremento del mismo campo, que se suman (ver storage.base.combinar)
+        self.cambios = {}
+        self.actualizaciones = 0
+        # numero -> documento tal como estaba al empezar el turno. Con él la
+        # copia del dashboard se calcula como base + cambios, sin releer.
+        self.bases = {}
+        # numero -> SesionUsuario del turno (una sola por usuario)
+        self.sesiones = {}
+
+    def registrar(self, numero_telefono, datos):
+        numero = str(numero_telefono)
+        sesion = self.sesiones.get(numero)
+        if sesion is not None:
+            # Lo asignado antes en la sesión va primero
+            self._recoger(numero, sesion)
+            sesion.aplicar(datos)
+        combinar(self.cambios.setdefault(numero, {}), datos)
+        self.actualizaciones += 1
+
+    def _recoger(self, numero, sesion):
+        cambios = sesion.tomar_cambios()
+        if cambios:
+            combinar(self.cambios.setdefault(numero, {}), cambios)
+            self.actualizaciones += 1
+
+    def recoger_sesiones(self):
+        """Pasa a los cambios pendientes lo asignado en las sesiones del turno."""
+        for numero, sesion in self.sesiones.items():
+            self._recoger(numero, sesion)
+
+    def sesion(self, numero_telefono, documento):
+        """
+        SesionUsuario del turno sobre `documento` (el usuario leído, sin
+        copiar); se crea con la primera lectura y luego se reutiliza.
+        """
+        from src.sesion import SesionUsuario
+
+        numero = str(numero_telefono)
+        sesion = self.sesiones.get(numero)
+        if sesion is None:
+            # La sesión nunca modifica el documento: sirve de base sin copiarlo
+            self.bases.setdefault(numero, documento)
+            sesion = self.sesiones[numero] = SesionUsuario(documento)
+            if numero in self.cambios:
+                sesion.aplicar(self.cambios[numero])
+        return sesion
+
+    def registrar_base(self, numero_telefono, usuario):
+        """Recuerda el estado del usuario antes del turno (solo la primera lectura cuenta)."""
+        # Copia profunda: los handlers pueden modificar los mapas y arreglos que leyeron
+        if usuario is not None and str(numero_telefono) not in self.bases:
+            self.bases[str(numero_telefono)] = copy.deepcopy(usuario)
+
+    def pendientes(self, numero_telefono):
+        sesion = self.sesiones.get(str(numero_telefono))
+        if sesion is not None:
+            self._recoger(str(numero_telefono), sesion)
+        return self.cambios.get(str(numero_telefono), {})
+
+
+def unidad_actual():
+    """Retorna la unidad de trabajo del turno en curso o None."""
+    return _unidad_actual.get()
+
+
+@contextmanager
+def unidad_de_trabajo():
+    """
+    Abre una unidad de trabajo para el bloque. Al salir sin errores confirma
+    los cambios (un update por usuario); si hay una excepción los descarta.
+    """
+    unidad = UnidadDeTrabajo()
+    token = _unidad_actual.set(unidad)
+    try:
+        yield unidad
+    except Exception:
+        _unidad_actual.reset(token)
+        if unidad.cambios:
+            metrics.incrementar("uow_descartadas_total")
+            print(f"↩️ Turno fallido: se descartan los cambios de {len(unidad.cambios)} usuario(s)")
+        raise
+    _unidad_actual.reset(token)
+    confirmar(unidad)
+
+
+def confirmar(unidad):
+    """Escribe los cambios acumulados de cada usuario en una sola operación."""
+    unidad.recoger_sesiones()
+    if not unidad.cambios:
+        return
+    import src.database as db
+
+    for numero_telefono, datos in unidad.cambios.items():
+        exito = db.guardar_cambios_usuario(numero_telefono, datos, unidad.bases.get(numero_telefono))
+        metrics.incrementar("uow_confirmaciones_total", etiquetas={"resultado": "ok" if exito else "error"})
+    # Escrituras que se ahorraron al agrupar los cambios del turno
+    metrics.incrementar("uow_escrituras_ahorradas_total", unidad.actualizaciones - len(unidad.cambios))
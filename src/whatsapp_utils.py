@@ -1,39 +1,92 @@
 # whatsapp_utils.py
 
 import os
-import json
+import time
 import requests
 from src.database import actualizar_usuario
-from src.config.config import CURSOS
+from src.config.config import CURSOS, TURN_WORKERS, TURN_WORKERS_RAPIDOS
+from src import delivery_metrics, metrics, tracing
 
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 ID_NUMERO_TELEFONO = os.getenv("ID_NUMERO_TELEFONO")
+GRAPH_API_URL = "https://graph.facebook.com/v19.0"
+
+# Sesión compartida: reutiliza las conexiones TLS con la Graph API en lugar
+# de abrir una nueva por envío. Un slot del pool por worker de turnos (de
+# los dos carriles: todos envían por esta sesión).
+_sesion = requests.Session()
+_sesion.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=TURN_WORKERS + TURN_WORKERS_RAPIDOS))
+
+
+def calentar():
+    """Abre la conexión con la Graph API antes del primer envío."""
+    inicio = time.perf_counter()
+    try:
+        _sesion.get(GRAPH_API_URL, timeout=5)
+        print(f"✅ Conexión con la Graph API lista ({(time.perf_counter() - inicio) * 1000:.0f} ms).")
+    except requests.exceptions.RequestException as e:
+        print(f"⚠️ Warmup de la Graph API falló: {e}")
+
+
+def _enviar(numero_destinatario, data, descripcion):
+    """
+    Envía un mensaje por la Graph API.
+    Retorna el ID (wamid) que asigna Meta, o None si el envío falló.
+    """
+    url = f"{GRAPH_API_URL}/{ID_NUMERO_TELEFONO}/messages"
+    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
+
+    # Meta nos devuelve este dato en los callbacks de estado (sent/delivered/read),
+    # así cualquier proceso puede calcular la latencia de la respuesta.
+    enviado_en = time.time()
+    callback = delivery_metrics.datos_callback(enviado_en)
+    if callback:
+        data["biz_opaque_callback_data"] = callback
+
+    # Tipo de envío para las métricas: text, interactive_list, interactive_button
+    # (la Graph API asume "text" cuando no se indica)
+    tipo = data.get("type", "text")
+    if tipo == "interactive":
+        tipo = f"interactive_{data['interactive'].get('type')}"
+
+    response = None
+    with tracing.span("whatsapp.enviar", {"whatsapp.tipo": tipo}):
+        try:
+            response = _sesion.post(url, headers=headers, json=data, timeout=30)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            tracing.marcar_error(str(e))
+            print(f"Error al enviar {descripcion} a {numero_destinatario}: {e}")
+            if response is not None and response.text:
+                print(f"Respuesta de la API: {response.text}")
+            return None
+        finally:
+            metrics.observar("whatsapp_duracion_segundos", time.time() - enviado_en,
+                             {"operacion": tipo, "resultado": "ok" if response is not None and response.ok else "error"})
+
+    try:
+        wamid = response.json()["messages"][0]["id"]
+    except (ValueError, KeyError, IndexError):
+        wamid = None
+    delivery_metrics.registrar_envio(wamid, enviado_en)
+    return wamid
 
 
 def responder_mensaje(numero_destinatario, texto_respuesta, historial_actual=[]):
     if not WHATSAPP_TOKEN or not ID_NUMERO_TELEFONO: return
 
     nuevo_historial = historial_actual + [{"bot": texto_respuesta}]
-    actualizar_usuario(numero_destinatario, {"historial_chat": json.dumps(nuevo_historial[-6:])})
+    actualizar_usuario(numero_destinatario, {"historial_chat": nuevo_historial[-6:]})
 
-    url = f"https://graph.facebook.com/v19.0/{ID_NUMERO_TELEFONO}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
     data = {"messaging_product": "whatsapp", "to": numero_destinatario,
             "text": {"preview_url": False, "body": texto_respuesta}}
 
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error al enviar mensaje a {numero_destinatario}: {e}")
-        if response.text:
-            print(f"Respuesta de la API: {response.text}")
+    return _enviar(numero_destinatario, data, "mensaje")
 
 
 def enviar_menu_interactivo(numero_destinatario):
     if not WHATSAPP_TOKEN or not ID_NUMERO_TELEFONO: return
-    url = f"https://graph.facebook.com/v19.0/{ID_NUMERO_TELEFONO}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
     data = {
         "messaging_product": "whatsapp",
         "to": numero_destinatario,
@@ -68,22 +121,13 @@ def enviar_menu_interactivo(numero_destinatario):
             }
         }
     }
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error al enviar menú a {numero_destinatario}: {e}")
-        if response.text:
-            print(f"Respuesta de la API: {response.text}")
+    return _enviar(numero_destinatario, data, "menú")
 
 
 def enviar_menu_temas_java(numero_destinatario):
     """Envía un menú interactivo con los temas del curso de Java."""
     if not WHATSAPP_TOKEN or not ID_NUMERO_TELEFONO: return
 
-    url = f"https://graph.facebook.com/v19.0/{ID_NUMERO_TELEFONO}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-
     filas_temas = []
     for i, leccion in enumerate(CURSOS["java"]["lecciones"]):
         filas_temas.append({
@@ -111,13 +155,7 @@ def enviar_menu_temas_java(numero_destinatario):
             }
         }
     }
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error al enviar menú de temas a {numero_destinatario}: {e}")
-        if response.text:
-            print(f"Respuesta de la API: {response.text}")
+    return _enviar(numero_destinatario, data, "menú de temas")
 
 
 # --- ✅ NUEVA FUNCIÓN PARA MOSTRAR FICHAS DESBLOQUEADAS ---
@@ -125,9 +163,6 @@ def enviar_lista_recursos(numero_destinatario, recursos_desbloqueados):
     """Envía un menú lista con las fichas que el usuario ya desbloqueó."""
     if not WHATSAPP_TOKEN or not ID_NUMERO_TELEFONO: return
 
-    url = f"https://graph.facebook.com/v19.0/{ID_NUMERO_TELEFONO}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-
     filas_recursos = []
     # recursos_desbloqueados es una lista de tuplas (indice, nombre_tema)
     for idx, tema in recursos_desbloqueados:
@@ -157,17 +192,11 @@ def enviar_lista_recursos(numero_destinatario, recursos_desbloqueados):
             }
         }
     }
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error al enviar lista de recursos: {e}")
+    return _enviar(numero_destinatario, data, "lista de recursos")
 
 
 def enviar_botones_basicos(numero_destinatario, texto_principal, botones):
     if not WHATSAPP_TOKEN or not ID_NUMERO_TELEFONO: return
-    url = f"https://graph.facebook.com/v19.0/{ID_NUMERO_TELEFONO}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
 
     action_buttons = []
     for boton in botones:
@@ -189,8 +218,4 @@ def enviar_botones_basicos(numero_destinatario, texto_principal, botones):
             "action": {"buttons": action_buttons}
         }
     }
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error al enviar botones a {numero_destinatario}: {e}")
\ No newline at end of file
+    return _enviar(numero_destinatario, data, "botones")